@@ -0,0 +1,41 @@
+"""
+app_config.py
+
+Shared access to config.ini, which holds the database and SSH details used by the scripts.
+
+The config file is read the first time a setting is needed rather than when modules are imported, so that scripts
+start quickly (e.g. for --help) and the file is only parsed once per run however many modules use it.
+"""
+import os
+import threading
+from ConfigParser import ConfigParser
+
+# Config file (must be called config.ini and stored in same directory as script)
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini")
+
+# Parsed config, created on first use
+_config = None
+_config_lock = threading.Lock()
+
+def get_config():
+    """
+    Returns the ConfigParser for config.ini, reading the file on first use
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            config = ConfigParser()
+            config.read(CONFIG_PATH)
+            _config = config
+        return _config
+
+def get_number(section, option, default):
+    """
+    Returns an optional numeric setting from config.ini, or default if it isn't set. Integer defaults return integers.
+    """
+    config = get_config()
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, int):
+        return config.getint(section, option)
+    return config.getfloat(section, option)
@@ -0,0 +1,291 @@
+"""
+fake_databases.py
+
+SQLite stand-ins for the Moka and Geneworks SQL Server databases, used by the benchmarks.
+
+install() registers a module named pyodbc, so db_connections.py and gel_cover_report.py connect to SQLite files
+instead of SQL Server. The DATABASE value of the connection string is used as the path to the SQLite file. The
+Geneworks database includes the gwv-* views that gel_cover_report.py queries directly, and the Moka database
+includes the same data as the linked gwv-*linked views.
+
+SQLite understands most of the SQL used by gel_cover_report.py as is. The few SQL Server statements it doesn't
+(the UPDATE ... FROM used to sign off tests and the spInsertLabReportCostDetail stored procedure) are translated
+by FakeCursor before they are executed.
+"""
+import re
+import sys
+import imp
+import sqlite3
+import datetime
+
+# Moka tables and the Geneworks views queried through Moka
+MOKA_SCHEMA = [
+    'CREATE TABLE NGSTest (NGSTestID INTEGER PRIMARY KEY, InternalPatientID INTEGER, BookBy INTEGER, ResultCode INTEGER, '
+    'BlockAutomatedReporting INTEGER, GELProbandID TEXT, IRID TEXT, StatusID INTEGER, '
+    'Check2ID INTEGER, Check2Date TIMESTAMP, Check3ID INTEGER, Check3Date TIMESTAMP, Check4ID INTEGER, Check4Date TIMESTAMP)',
+    'CREATE TABLE Patients (InternalPatientID INTEGER PRIMARY KEY, PatientID TEXT, s_StatusOverall INTEGER)',
+    'CREATE TABLE Checker (Check1ID INTEGER PRIMARY KEY, Name TEXT, ReportEmail TEXT, Address INTEGER, UserName TEXT)',
+    'CREATE TABLE Item (ItemID INTEGER PRIMARY KEY, Item TEXT)',
+    'CREATE TABLE NGSTestFile (NGSTestFileID INTEGER PRIMARY KEY, NGSTestID INTEGER, Description TEXT, NGSTestFile TEXT, DateAdded TIMESTAMP)',
+    'CREATE TABLE PatientLog (PatientLogID INTEGER PRIMARY KEY, InternalPatientID INTEGER, LogEntry TEXT, Date TIMESTAMP, Login TEXT, PCName TEXT)',
+    'CREATE TABLE "gwv-patientlinked" (PatientID INTEGER PRIMARY KEY, PatientTrustID TEXT, FirstName TEXT, LastName TEXT, DoB TIMESTAMP, Gender TEXT, NHSNo TEXT)',
+    'CREATE TABLE "gwv-specimenlinked" (SpecimenID INTEGER PRIMARY KEY, PatientID INTEGER, SpecimenTrustID TEXT)',
+    'CREATE TABLE "gwv-testlinked" (TestID INTEGER PRIMARY KEY, SpecimenID INTEGER)',
+    'CREATE TABLE "gwv-dnatestrequestlinked" (TestID INTEGER, DisorderID INTEGER, TestDescriptionID INTEGER)',
+    'CREATE TABLE "gwv-dnanumberlinked" (SpecimenID INTEGER, DNANumber TEXT)',
+]
+
+# Geneworks views queried by gel_cover_report.py, and the table populated by spInsertLabReportCostDetail
+GENEWORKS_SCHEMA = [
+    'CREATE TABLE "gwv-patient" (PatientID INTEGER PRIMARY KEY, PatientTrustID TEXT, FirstName TEXT, LastName TEXT, DoB TIMESTAMP, Gender TEXT, NHSNo TEXT)',
+    'CREATE TABLE "gwv-specimen" (SpecimenID INTEGER PRIMARY KEY, PatientID INTEGER, SpecimenTrustID TEXT)',
+    'CREATE TABLE "gwv-test" (TestID INTEGER PRIMARY KEY, SpecimenID INTEGER)',
+    'CREATE TABLE "gwv-dnatestrequest" (TestID INTEGER, DisorderID INTEGER, TestDescriptionID INTEGER)',
+    'CREATE TABLE "gwv-dnanumber" (SpecimenID INTEGER, DNANumber TEXT)',
+    'CREATE TABLE LabReportCostDetail (RecordNo INTEGER PRIMARY KEY, SpecimenNo TEXT, TestType TEXT, Cost REAL, TestID INTEGER, DateReported TIMESTAMP, EnteredByID INTEGER)',
+]
+
+# GENEWORKS options in config.ini naming the Geneworks views above
+GENEWORKS_VIEW_NAMES = {
+    'PATIENT_VIEW': 'gwv-patient',
+    'SPECIMEN_VIEW': 'gwv-specimen',
+    'TEST_VIEW': 'gwv-test',
+    'DNATESTREQUEST_VIEW': 'gwv-dnatestrequest',
+    'DNANUMBER_VIEW': 'gwv-dnanumber',
+}
+
+# Result code and patient status used by gel_cover_report.py for negneg cases
+NEGNEG_RESULT_CODE = 1189679668
+PATIENT_STATUS_100K = 1202218839
+
+class Error(Exception):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class ProgrammingError(DatabaseError):
+    pass
+
+class Row(object):
+    '''Row supporting access by column name and index, like pyodbc.Row'''
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = tuple(values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[self._columns[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def __len__(self):
+        return len(self._values)
+
+def _translate_ngstest_update(sql, params):
+    """
+    Translate the SQL Server UPDATE ... FROM used to sign off a test. Parameters are (date, date, date, username, NGSTestID).
+    """
+    check2_date, check3_date, check4_date, username, ngs_test_id = params
+    checker = '(SELECT Check1ID FROM Checker WHERE UserName = ?)'
+    return (
+        'UPDATE NGSTest SET Check2ID = {checker}, Check2Date = ?, Check3ID = {checker}, Check3Date = ?, '
+        'Check4ID = {checker}, Check4Date = ?, StatusID = 4 '
+        'WHERE NGSTestID = ? AND EXISTS (SELECT 1 FROM Checker WHERE UserName = ?);'
+    ).format(checker=checker), (username, check2_date, username, check3_date, username, check4_date, ngs_test_id, username)
+
+def _translate_patients_update(sql, params):
+    """
+    SQLite doesn't allow table names on columns being SET
+    """
+    return sql.replace('SET Patients.', 'SET '), params
+
+# SQL Server statements that need translating, as (pattern, function taking and returning (sql, params))
+TRANSLATIONS = [
+    (re.compile(r'^UPDATE n SET '), _translate_ngstest_update),
+    (re.compile(r'^UPDATE Patients SET Patients\.'), _translate_patients_update),
+]
+
+# Parameters of the spInsertLabReportCostDetail call used to insert a charge, e.g. '@TestID = ?'
+CHARGE_PARAMETERS = re.compile(r'@(\w+) = \?')
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursor = connection._cnxn.cursor()
+        self._rows = []
+        self.description = None
+        self.rowcount = -1
+
+    def _execute(self, sql, params):
+        for pattern, translate in TRANSLATIONS:
+            if pattern.search(sql):
+                sql, params = translate(sql, params)
+        self.connection._begin()
+        try:
+            self._cursor.execute(sql, params)
+        except sqlite3.Error as e:
+            raise ProgrammingError(str(e))
+        self.rowcount = self._cursor.rowcount
+
+    def _insert_charge(self, sql, params):
+        """
+        Emulate the spInsertLabReportCostDetail stored procedure, returning the new record number
+        """
+        fields = dict(zip(CHARGE_PARAMETERS.findall(sql), params))
+        if len(fields) != len(params) or not all(name in fields for name in ('SpecimenNo', 'TestType', 'Cost', 'TestID')):
+            raise ProgrammingError("Unrecognised call to spInsertLabReportCostDetail")
+        self._execute(
+            'INSERT INTO LabReportCostDetail (SpecimenNo, TestType, Cost, TestID, DateReported, EnteredByID) VALUES (?, ?, ?, ?, ?, 888);',
+            (fields['SpecimenNo'], fields['TestType'], float(fields['Cost']), int(fields['TestID']), datetime.datetime.now())
+        )
+        self.description = (('record_no',),)
+        self._rows = [Row({'record_no': 0}, (self._cursor.lastrowid,))]
+
+    def execute(self, sql, *params):
+        # pyodbc accepts parameters either as a single sequence or as separate arguments
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self._rows = []
+        self.description = None
+        if 'spInsertLabReportCostDetail' in sql:
+            self._insert_charge(sql, tuple(params))
+            return self
+        self._execute(sql, tuple(params))
+        if self._cursor.description:
+            self.description = self._cursor.description
+            columns = dict((column[0], i) for i, column in enumerate(self._cursor.description))
+            self._rows = [Row(columns, values) for values in self._cursor.fetchall()]
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        for params in seq_of_params:
+            self.execute(sql, params)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def close(self):
+        self._cursor.close()
+
+class FakeConnection(object):
+    '''pyodbc-like connection to an SQLite database, emulating pyodbc's autocommit attribute'''
+    def __init__(self, path, autocommit=False):
+        # Transactions are managed here rather than by the sqlite3 module, so that autocommit behaves as in pyodbc
+        self._cnxn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._in_transaction = False
+        self._autocommit = autocommit
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if value and self._in_transaction:
+            self.commit()
+        self._autocommit = value
+
+    def _begin(self):
+        if not self._autocommit and not self._in_transaction:
+            self._cnxn.execute('BEGIN IMMEDIATE')
+            self._in_transaction = True
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        if self._in_transaction:
+            self._cnxn.execute('COMMIT')
+            self._in_transaction = False
+
+    def rollback(self):
+        if self._in_transaction:
+            self._cnxn.execute('ROLLBACK')
+            self._in_transaction = False
+
+    def close(self):
+        self.rollback()
+        self._cnxn.close()
+
+def connect(connection_string, autocommit=False, **kwargs):
+    """
+    Connect to the SQLite file given as the DATABASE in an ODBC connection string
+    """
+    match = re.search(r'DATABASE=([^;]+);', connection_string)
+    if not match:
+        raise Error("No DATABASE in connection string")
+    return FakeConnection(match.group(1).strip(), autocommit=autocommit)
+
+def install():
+    """
+    Register this module as pyodbc, so that it is used by modules imported afterwards
+    """
+    pyodbc = imp.new_module('pyodbc')
+    for name in ('Error', 'DatabaseError', 'ProgrammingError', 'Row', 'connect'):
+        setattr(pyodbc, name, globals()[name])
+    sys.modules['pyodbc'] = pyodbc
+    return pyodbc
+
+def create_databases(moka_path, geneworks_path, tests, checker_username):
+    """
+    Create the Moka and Geneworks databases, populated with a negneg test ready to be reported for each test in tests.
+    Args:
+        moka_path: Path to create the Moka SQLite database
+        geneworks_path: Path to create the Geneworks SQLite database
+        tests: List of dictionaries with ngs_test_id, gel_id, irid, pru, first_name, last_name, dob (datetime) and nhs_number
+        checker_username: Moka username that tests are signed off by
+    """
+    moka = sqlite3.connect(moka_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    # Use write-ahead logging so that worker threads can read while another writes
+    moka.execute('PRAGMA journal_mode=WAL')
+    for sql in MOKA_SCHEMA:
+        moka.execute(sql)
+    moka.execute('INSERT INTO Item (ItemID, Item) VALUES (1, ?)', ('Clinical Genetics, Guy\'s Hospital, London',))
+    moka.execute('INSERT INTO Checker (Check1ID, Name, ReportEmail, Address, UserName) VALUES (1, ?, ?, 1, NULL)', ('Dr Clinician', 'clinician@example.com'))
+    moka.execute('INSERT INTO Checker (Check1ID, Name, ReportEmail, Address, UserName) VALUES (2, ?, ?, 1, ?)', ('Benchmark User', 'benchmark@example.com', checker_username))
+    for i, test in enumerate(tests, 1):
+        moka.execute(
+            'INSERT INTO "gwv-patientlinked" (PatientID, PatientTrustID, FirstName, LastName, DoB, Gender, NHSNo) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (i, test['pru'], test['first_name'], test['last_name'], test['dob'], 'Female', test['nhs_number'])
+        )
+        moka.execute('INSERT INTO Patients (InternalPatientID, PatientID, s_StatusOverall) VALUES (?, ?, ?)', (i, test['pru'], PATIENT_STATUS_100K))
+        moka.execute(
+            'INSERT INTO NGSTest (NGSTestID, InternalPatientID, BookBy, ResultCode, BlockAutomatedReporting, GELProbandID, IRID, StatusID) VALUES (?, ?, 1, ?, 0, ?, ?, 1)',
+            (test['ngs_test_id'], i, NEGNEG_RESULT_CODE, test['gel_id'], test['irid'])
+        )
+        moka.execute('INSERT INTO "gwv-specimenlinked" (SpecimenID, PatientID, SpecimenTrustID) VALUES (?, ?, ?)', (i, i, 'S{i:07d}'.format(i=i)))
+        moka.execute('INSERT INTO "gwv-testlinked" (TestID, SpecimenID) VALUES (?, ?)', (i, i))
+        moka.execute('INSERT INTO "gwv-dnatestrequestlinked" (TestID, DisorderID, TestDescriptionID) VALUES (?, 60, 18)', (i,))
+        moka.execute('INSERT INTO "gwv-dnanumberlinked" (SpecimenID, DNANumber) VALUES (?, ?)', (i, 'D{i:07d}'.format(i=i)))
+    moka.commit()
+    moka.close()
+    geneworks = sqlite3.connect(geneworks_path, detect_types=sqlite3.PARSE_DECLTYPES)
+    for sql in GENEWORKS_SCHEMA:
+        geneworks.execute(sql)
+    # Copy the Geneworks data from the linked views in Moka, so both databases hold the same records
+    geneworks.execute('ATTACH DATABASE ? AS moka', (moka_path,))
+    for view in ('patient', 'specimen', 'test', 'dnatestrequest', 'dnanumber'):
+        geneworks.execute('INSERT INTO "gwv-{view}" SELECT * FROM moka."gwv-{view}linked"'.format(view=view))
+    geneworks.commit()
+    geneworks.execute('DETACH DATABASE moka')
+    geneworks.close()
+
+def count_rows(path, table):
+    """
+    Return the number of rows in a table, used to check the work done by a benchmark run
+    """
+    cnxn = sqlite3.connect(path)
+    try:
+        return cnxn.execute('SELECT COUNT(*) FROM "{table}"'.format(table=table)).fetchone()[0]
+    finally:
+        cnxn.close()
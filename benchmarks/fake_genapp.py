@@ -0,0 +1,209 @@
+"""
+fake_genapp.py
+
+In-process stand-in for the GENAPP01 server, used by the benchmarks.
+
+FakeGenapp runs a paramiko SSH server on localhost that accepts any password and answers the commands sent by
+ssh_run_labkey.py, ssh_run_exit_questionnaire.py and ssh_run_summary_findings.py:
+
+    LabKey.py               Returns the demographics supplied for each participant (single or batch invocation)
+    exit_questionnaire.py   Succeeds without output
+    summary_findings.py     Writes a summary of findings PDF to the -o path, or streams it when run by the
+                            ssh_run_summary_findings.STREAM_SCRIPT wrapper
+    sha256sum               Returns the checksum of a file, used by sftp_transfer.py to verify copies
+
+Files written by summary_findings.py are stored under a local root folder and served over SFTP. A fixed latency can
+be added to every command and SFTP request to simulate the network and remote interpreter start-up.
+"""
+import os
+import re
+import time
+import shlex
+import socket
+import hashlib
+import threading
+import paramiko
+
+class FakeGenappServer(paramiko.ServerInterface):
+    def __init__(self, genapp):
+        self.genapp = genapp
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.genapp.run_command, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    '''Read-only SFTP server for files under the FakeGenapp root folder'''
+    def __init__(self, server, *args, **kwargs):
+        super(FakeSFTPServer, self).__init__(server, *args, **kwargs)
+        self.genapp = server.genapp
+
+    def stat(self, path):
+        time.sleep(self.genapp.latency)
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.genapp.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        time.sleep(self.genapp.latency)
+        try:
+            readfile = open(self.genapp.local_path(path), 'rb')
+        except IOError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = FakeSFTPHandle(flags)
+        handle.readfile = readfile
+        return handle
+
+class FakeGenapp(object):
+    '''In-process SSH/SFTP server standing in for GENAPP01.
+
+    Args:
+        root: Local folder used as the root of the server's filesystem
+        demographics: Dictionary of (name, dob, nhsid) tuples keyed by GEL participant ID, returned by LabKey.py
+        summary_pdf: Bytes of the PDF returned by summary_findings.py
+        latency: Seconds added to every command and SFTP request
+    Attributes:
+        port: Port the server is listening on
+        connections: Number of SSH connections accepted
+        commands: Number of commands run, keyed by script name
+    '''
+    def __init__(self, root, demographics, summary_pdf, latency=0.0):
+        self.root = root
+        self.demographics = demographics
+        self.summary_pdf = summary_pdf
+        self.latency = latency
+        self.connections = 0
+        self.commands = {}
+        self._lock = threading.Lock()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        self._closed = False
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                client, address = self._socket.accept()
+            except socket.error:
+                return
+            # Disable Nagle's algorithm so that small packets aren't delayed on the loopback interface
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, FakeSFTPServer)
+            transport.start_server(server=FakeGenappServer(self))
+            with self._lock:
+                self.connections += 1
+                self._transports.append(transport)
+
+    def local_path(self, path):
+        """
+        Return the local path for a path on the server
+        """
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def _count(self, name):
+        with self._lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def run_command(self, channel, command):
+        """
+        Run a command received on an exec channel, sending its output and exit status
+        """
+        try:
+            # Read stdin until the client closes it
+            stdin = ''
+            chunk = channel.recv(32768)
+            while chunk:
+                stdin += chunk
+                chunk = channel.recv(32768)
+            time.sleep(self.latency)
+            stdout, stderr, status = self.respond(command, stdin)
+            if stdout:
+                channel.sendall(stdout)
+            if stderr:
+                channel.sendall_stderr(stderr)
+            channel.send_exit_status(status)
+        finally:
+            channel.close()
+
+    def respond(self, command, stdin):
+        """
+        Returns (stdout, stderr, exit status) for a command
+        """
+        if 'LabKey.py' in command:
+            self._count('LabKey.py')
+            return self._labkey(shlex.split(command)), '', 0
+        if 'exit_questionnaire.py' in command:
+            self._count('exit_questionnaire.py')
+            return '', '', 0
+        if 'summary_findings.py' in command and 'mktemp' in command:
+            # Streamed download: size and checksum line followed by the PDF
+            self._count('summary_findings.py (stream)')
+            header = '{size} {sha256}\n'.format(size=len(self.summary_pdf), sha256=hashlib.sha256(self.summary_pdf).hexdigest())
+            return header + self.summary_pdf, '', 0
+        if 'summary_findings.py' in command:
+            self._count('summary_findings.py')
+            output_path = self.local_path(re.search(r' -o (\S+)', command).group(1))
+            if not os.path.isdir(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            with open(output_path, 'wb') as pdf:
+                pdf.write(self.summary_pdf)
+            return '', '', 0
+        if command.startswith('sha256sum '):
+            self._count('sha256sum')
+            path = shlex.split(command)[1]
+            try:
+                with open(self.local_path(path), 'rb') as checked_file:
+                    return '{sha256}  {path}\n'.format(sha256=hashlib.sha256(checked_file.read()).hexdigest(), path=path), '', 0
+            except IOError as e:
+                return '', 'sha256sum: {path}: {error}\n'.format(path=path, error=e.strerror), 1
+        return '', 'Unknown command: {command}\n'.format(command=command), 127
+
+    def _labkey(self, argv):
+        """
+        Output of LabKey.py for a single participant (-i ID), or of the batch runner (- script ID ID ...)
+        """
+        if '-i' in argv:
+            return "'{}'\n".format(','.join(self.demographics[argv[argv.index('-i') + 1]]))
+        lines = []
+        for participant_id in argv[argv.index('-') + 2:]:
+            if participant_id in self.demographics:
+                lines.append('{}\tOK\t{}\n'.format(participant_id, ','.join(self.demographics[participant_id])))
+            else:
+                lines.append('{}\tERROR\tParticipant not found\n'.format(participant_id))
+        return ''.join(lines)
+
+    def close(self):
+        self._closed = True
+        self._socket.close()
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
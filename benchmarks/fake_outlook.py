@@ -0,0 +1,66 @@
+"""
+fake_outlook.py
+
+Stand-in for the win32com Outlook automation used by generate_email.py, used by the benchmarks.
+
+install() registers modules named win32com and win32com.client. Emails are counted rather than opened or saved in
+Outlook.
+"""
+import sys
+import imp
+import threading
+
+class FakeAttachments(object):
+    def __init__(self):
+        self.sources = []
+
+    def Add(self, Source):
+        self.sources.append(Source)
+
+class FakeMailItem(object):
+    def __init__(self, outlook):
+        self.outlook = outlook
+        self.To = None
+        self.Subject = None
+        self.HtmlBody = None
+        self.Attachments = FakeAttachments()
+
+    def Display(self, modal=True):
+        with self.outlook.lock:
+            self.outlook.displayed.append(self)
+
+    def Save(self):
+        with self.outlook.lock:
+            self.outlook.saved.append(self)
+
+    def SaveAs(self, Path, Type=None):
+        with self.outlook.lock:
+            self.outlook.saved.append(self)
+
+class FakeOutlook(object):
+    '''Records the emails displayed, and those saved as drafts or .msg files'''
+    def __init__(self):
+        self.displayed = []
+        self.saved = []
+        self.lock = threading.Lock()
+
+    def CreateItem(self, item_type):
+        return FakeMailItem(self)
+
+# Outlook application shared by all calls to Dispatch
+outlook = FakeOutlook()
+
+def Dispatch(name):
+    return outlook
+
+def install():
+    """
+    Register win32com and win32com.client modules, so that they are used by modules imported afterwards
+    """
+    win32com = imp.new_module('win32com')
+    client = imp.new_module('win32com.client')
+    client.Dispatch = Dispatch
+    win32com.client = client
+    sys.modules['win32com'] = win32com
+    sys.modules['win32com.client'] = client
+    return client
@@ -0,0 +1,66 @@
+"""
+fake_wkhtmltopdf.py
+
+Stand-in for the wkhtmltopdf executable, used by the benchmarks and tests.
+
+Called with the same arguments pdfkit passes to wkhtmltopdf. Writes a PDF with one blank A4 page for each input
+(an HTML file, or '-' for HTML on stdin) to the output path, or to stdout if the output path is '-'. As wkhtmltopdf
+does, an input starts a new page wherever its HTML contains PAGE_BREAK. The HTML for each page is written to the
+page's content stream as PDF comments, so that the pages for different inputs can be told apart.
+"""
+import os
+import sys
+import io
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+
+# A4 page size in points
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+# CSS that starts a new page
+PAGE_BREAK = 'page-break-before: always'
+
+def install(folder):
+    """
+    Write an executable script to folder that runs this module with the current Python interpreter, for use in
+    place of wkhtmltopdf. Returns the path to the script.
+    """
+    wkhtmltopdf = os.path.join(folder, 'wkhtmltopdf')
+    with open(wkhtmltopdf, 'w') as script:
+        script.write('#!/bin/sh\nexec "{python}" "{fake}" "$@"\n'.format(python=sys.executable, fake=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_wkhtmltopdf.py')))
+    os.chmod(wkhtmltopdf, 0o755)
+    return wkhtmltopdf
+
+def page_contents(html):
+    """
+    Returns the content stream for a page showing html, with each line of the html as a PDF comment
+    """
+    return ''.join('% {line}\n'.format(line=line) for line in html.splitlines())
+
+def main(argv):
+    # The last argument is the output path. Inputs are the HTML files (or '-') before it, ignoring options and their values.
+    output_path = argv[-1]
+    inputs = [arg for arg in argv[:-1] if arg == '-' or (arg.endswith('.html') and os.path.exists(arg))]
+    writer = PdfFileWriter()
+    for html_input in inputs:
+        if html_input == '-':
+            html = sys.stdin.read()
+        else:
+            with open(html_input, 'rb') as html_file:
+                html = html_file.read()
+        for page_html in html.split(PAGE_BREAK):
+            page = writer.addBlankPage(PAGE_WIDTH, PAGE_HEIGHT)
+            contents = DecodedStreamObject()
+            contents.setData(page_contents(page_html))
+            page[NameObject('/Contents')] = writer._addObject(contents)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    if output_path == '-':
+        sys.stdout.write(pdf.getvalue())
+        sys.stdout.flush()
+    else:
+        with open(output_path, 'wb') as output_file:
+            output_file.write(pdf.getvalue())
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
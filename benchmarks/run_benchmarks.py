@@ -0,0 +1,263 @@
+#!/usr/bin/env python2
+"""
+run_benchmarks.py
+
+Runs the gel_cover_report.py pipeline offline against local stand-ins for its external systems, and records how long
+it takes so that changes in throughput can be tracked:
+
+    Moka and Geneworks     SQLite databases with the tables and gwv-* views used (fake_databases.py)
+    GENAPP01               In-process paramiko SSH/SFTP server with configurable latency (fake_genapp.py)
+    wkhtmltopdf            Script writing one blank page per cover (fake_wkhtmltopdf.py)
+    Outlook                Emails are counted rather than displayed or saved (fake_outlook.py)
+    Network shares         Temporary folders
+
+Each scenario creates negneg tests ready for reporting and runs gel_cover_report.main() for all of them with
+--submit_exit_q and --download_summary, in a separate Python process so that every scenario starts from a clean state.
+Results are appended to benchmarks/results.jsonl as JSON lines. The change in throughput from the last saved result
+for the same scenario is printed.
+
+usage: run_benchmarks.py [-h] [--tests N [N ...]] [--workers N]
+                         [--latency SECONDS] [--stream_summary]
+                         [--email_backend {outlook,drafts,msg,eml}]
+                         [--results FILE] [--no_save] [--keep]
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --tests N [N ...]     Number of tests in each scenario (default 1 100 1000)
+  --workers N           Value of gel_cover_report.py --workers (default 1)
+  --latency SECONDS     Latency added to each GENAPP01 command and SFTP request
+                        (default 0.01)
+  --stream_summary      Use gel_cover_report.py --stream_summary
+  --email_backend {outlook,drafts,msg,eml}
+                        Value of gel_cover_report.py --email_backend (default
+                        outlook). The outbox for msg and eml is a temporary
+                        folder.
+  --results FILE        JSON lines file results are appended to (default
+                        benchmarks/results.jsonl)
+  --no_save             Print results without saving them
+  --keep                Keep the temporary folder created for each scenario
+"""
+import os
+import sys
+import io
+import glob
+import json
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description='Runs gel_cover_report.py against local stand-ins and records throughput')
+    parser.add_argument('--tests', metavar='N', type=int, nargs='+', default=[1, 100, 1000], help='Number of tests in each scenario (default 1 100 1000)')
+    parser.add_argument('--workers', metavar='N', type=int, default=1, help='Value of gel_cover_report.py --workers (default 1)')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.01, help='Latency added to each GENAPP01 command and SFTP request (default 0.01)')
+    parser.add_argument('--stream_summary', action='store_true', help='Use gel_cover_report.py --stream_summary')
+    parser.add_argument(
+            '--email_backend',
+            choices=['outlook', 'drafts', 'msg', 'eml'],
+            default='outlook',
+            help='Value of gel_cover_report.py --email_backend (default outlook). The outbox for msg and eml is a temporary folder.'
+        )
+    parser.add_argument('--results', metavar='FILE', default=os.path.join(BENCHMARK_DIR, 'results.jsonl'), help='JSON lines file results are appended to (default benchmarks/results.jsonl)')
+    parser.add_argument('--no_save', action='store_true', help='Print results without saving them')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder created for each scenario')
+    # Used internally to run a single scenario in a child process
+    parser.add_argument('--run_scenario', metavar='JSON', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def make_tests(count):
+    """
+    Returns a list of test dictionaries used to populate the fake databases
+    """
+    tests = []
+    for i in range(count):
+        tests.append({
+            'ngs_test_id': 10000 + i,
+            'gel_id': str(110000000 + i),
+            'irid': '{ir_id}-1'.format(ir_id=50000 + i),
+            'pru': 'RJ1:{i:07d}'.format(i=i),
+            'first_name': 'Test',
+            'last_name': 'Patient{i}'.format(i=i),
+            'dob': datetime.datetime(1970, 1, 1) + datetime.timedelta(days=i),
+            'nhs_number': '{nhs:010d}'.format(nhs=4000000000 + i),
+        })
+    return tests
+
+def make_pdf(pages):
+    """
+    Returns the bytes of a PDF with the given number of blank A4 pages
+    """
+    from PyPDF2 import PdfFileWriter
+    writer = PdfFileWriter()
+    for i in range(pages):
+        writer.addBlankPage(595, 842)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    return pdf.getvalue()
+
+def run_scenario(scenario):
+    """
+    Runs gel_cover_report.main() for one scenario in the current process and returns the result dictionary.
+    Must be run in a fresh process, as it replaces pyodbc and win32com and configures the imported modules.
+    """
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+    import fake_databases
+    import fake_outlook
+    import fake_wkhtmltopdf
+    # Stand-ins must be registered before the modules that import them
+    fake_databases.install()
+    fake_outlook.install()
+    from fake_genapp import FakeGenapp
+    import app_config
+    import db_connections
+    import timing
+    import gel_cover_report
+
+    workdir = scenario['workdir']
+    tests = make_tests(scenario['tests'])
+    # Create the databases
+    moka_path = os.path.join(workdir, 'moka.sqlite')
+    geneworks_path = os.path.join(workdir, 'geneworks.sqlite')
+    fake_databases.create_databases(moka_path, geneworks_path, tests, checker_username='benchmark')
+    # Start the fake GENAPP01 server
+    genapp = FakeGenapp(
+        root=os.path.join(workdir, 'genapp01'),
+        demographics=dict((test['gel_id'], ('', test['dob'].strftime(r'%d/%m/%Y'), test['nhs_number'])) for test in tests),
+        summary_pdf=make_pdf(2),
+        latency=scenario['latency']
+    )
+    # Point the config at the stand-ins
+    config = app_config.get_config()
+    for section, options in (
+            ('MOKA', {'SERVER': 'localhost', 'DATABASE': moka_path}),
+            ('GENEWORKS', dict(fake_databases.GENEWORKS_VIEW_NAMES, SERVER='localhost', DATABASE=geneworks_path, USER='benchmark', PASSWORD='benchmark')),
+            ('GENAPP01', {'SERVER': '127.0.0.1', 'USER': 'benchmark', 'PASSWORD': 'benchmark', 'PORT': str(genapp.port)}),
+            ):
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value)
+    # Use temporary folders in place of the network shares, and the fake wkhtmltopdf
+    gel_cover_report.WKHTMLTOPDF = fake_wkhtmltopdf.install(workdir)
+    gel_cover_report.TECHNICAL_REPORTS_FOLDER = os.path.join(workdir, 'technical_reports')
+    gel_cover_report.COVER_TEMPLATE = os.path.join(REPO_DIR, 'gel_cover_report_template.html')
+    gel_cover_report.GEL_REPORT_OUTPUT_FOLDER = os.path.join(workdir, 'ngs', '{year}', '{month}')
+    output_folder = gel_cover_report.GEL_REPORT_OUTPUT_FOLDER.format(year=datetime.datetime.now().year, month=datetime.datetime.now().month)
+    for folder in (gel_cover_report.TECHNICAL_REPORTS_FOLDER, output_folder):
+        os.makedirs(folder)
+    # Moka username and computer name recorded against updates
+    os.environ['username'] = 'benchmark'
+    os.environ['computername'] = 'benchmark'
+
+    sys.argv = ['gel_cover_report.py', '-n'] + [str(test['ngs_test_id']) for test in tests] + [
+        '--submit_exit_q',
+        '--download_summary',
+        '--journal', os.path.join(workdir, 'journal.sqlite'),
+        '--labkey_cache', os.path.join(workdir, 'labkey_cache.sqlite'),
+        '--summary_cache', os.path.join(workdir, 'summary_cache'),
+        '--workers', str(scenario['workers']),
+        '--email_backend', scenario['email_backend'],
+        '--email_outbox', os.path.join(workdir, 'outbox'),
+    ]
+    if scenario['stream_summary']:
+        sys.argv.append('--stream_summary')
+    # Run the pipeline, writing its output to a log file
+    log_path = os.path.join(workdir, 'gel_cover_report.log')
+    stdout = sys.stdout
+    start = time.time()
+    with open(log_path, 'w') as log:
+        sys.stdout = log
+        try:
+            gel_cover_report.main()
+        finally:
+            sys.stdout = stdout
+    seconds = time.time() - start
+    with open(log_path) as log:
+        output = log.read().splitlines()
+    genapp.close()
+    return {
+        'seconds': seconds,
+        'tests_per_second': len(tests) / seconds,
+        'reports': len(os.listdir(output_folder)),
+        'moka_files': fake_databases.count_rows(moka_path, 'NGSTestFile'),
+        'charges': fake_databases.count_rows(geneworks_path, 'LabReportCostDetail'),
+        'emails': len(fake_outlook.outlook.displayed) + len(fake_outlook.outlook.saved) + len(glob.glob(os.path.join(workdir, 'outbox', '*.eml'))),
+        'errors': [line for line in output if line.startswith('ERROR')][:10],
+        'ssh_connections': genapp.connections,
+        'genapp_commands': genapp.commands,
+        'db_connections': dict((pool.name, pool.connects) for pool in db_connections.pools()),
+        'stages': timing.summary(),
+    }
+
+def git_commit():
+    """
+    Returns the current git commit of the repository, or None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_result(results_file, scenario):
+    """
+    Returns the last saved result for the same scenario, or None
+    """
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as results:
+            for line in results:
+                # Results saved before --email_backend was added used Outlook
+                result = dict({'email_backend': 'outlook'}, **json.loads(line))
+                if all(result.get(key) == scenario[key] for key in ('tests', 'workers', 'latency', 'stream_summary', 'email_backend')):
+                    previous = result
+    return previous
+
+def main():
+    args = process_arguments()
+    # Child process: run one scenario and write the result to the given file
+    if args.run_scenario:
+        scenario = json.loads(args.run_scenario)
+        with open(scenario['result_file'], 'w') as result_file:
+            json.dump(run_scenario(scenario), result_file)
+        return
+    commit = git_commit()
+    for tests in args.tests:
+        scenario = {'tests': tests, 'workers': args.workers, 'latency': args.latency, 'stream_summary': args.stream_summary, 'email_backend': args.email_backend}
+        workdir = tempfile.mkdtemp(prefix='gel_cover_report_benchmark_')
+        try:
+            child_scenario = dict(scenario, workdir=workdir, result_file=os.path.join(workdir, 'result.json'))
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--run_scenario', json.dumps(child_scenario)])
+            with open(child_scenario['result_file']) as result_file:
+                result = dict(scenario, **json.load(result_file))
+        finally:
+            if args.keep:
+                print "INFO\tScenario files kept in {workdir}".format(workdir=workdir)
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+        result.update({'date': datetime.datetime.now().isoformat(), 'commit': commit, 'python': sys.version.split()[0]})
+        # Report the result, and the change in throughput from the previous result for this scenario
+        print "INFO\t{tests} tests, {workers} workers: {seconds:.2f}s ({tests_per_second:.2f} tests/s), {reports} reports, {charges} charges, {emails} emails, {ssh_connections} SSH connections".format(**result)
+        for error in result['errors']:
+            print "ERROR\t{error}".format(error=error)
+        previous = previous_result(args.results, scenario)
+        if previous:
+            print "INFO\tChange from {commit} ({date}): {change:+.1f}% tests/s".format(
+                commit=previous['commit'],
+                date=previous['date'],
+                change=100.0 * (result['tests_per_second'] - previous['tests_per_second']) / previous['tests_per_second']
+            )
+        for stage in sorted(result['stages']):
+            print "\t{stage:<20} {count:>6} {total:>9.3f} {p50:>8.3f} {p95:>8.3f} {max:>8.3f}".format(stage=stage, **result['stages'][stage])
+        if not args.no_save:
+            with open(args.results, 'a') as results:
+                results.write(json.dumps(result, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
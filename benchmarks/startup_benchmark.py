@@ -0,0 +1,184 @@
+#!/usr/bin/env python2
+"""
+startup_benchmark.py
+
+Measures how long each command line entry point takes to start, by running it with --help in a new Python process,
+and lists the heavy dependencies (pyodbc, win32com, pdfkit, PyPDF2, jinja2, paramiko) loaded by the time it exits.
+None of these should be needed to print the help message, so an entry point that loads one is importing more than
+it uses. Where pyodbc or win32com aren't installed, the stand-ins from fake_databases.py and fake_outlook.py are
+loaded in their place if an entry point imports them.
+
+Results are appended to benchmarks/startup_results.jsonl as JSON lines. The change in median start-up time from the
+last saved result for the same entry point is printed.
+
+usage: startup_benchmark.py [-h] [--repeat N] [--results FILE] [--no_save]
+                            [script [script ...]]
+
+positional arguments:
+  script          Entry points to measure (default gel_cover_report.py
+                  generate_email.py ssh_run_labkey.py
+                  ssh_run_exit_questionnaire.py ssh_run_summary_findings.py
+                  sftp_transfer.py)
+
+optional arguments:
+  -h, --help      show this help message and exit
+  --repeat N      Number of times to start each entry point (default 10)
+  --results FILE  JSON lines file results are appended to (default
+                  benchmarks/startup_results.jsonl)
+  --no_save       Print results without saving them
+"""
+import os
+import sys
+import imp
+import json
+import time
+import argparse
+import runpy
+import datetime
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+ENTRY_POINTS = [
+    'gel_cover_report.py',
+    'generate_email.py',
+    'ssh_run_labkey.py',
+    'ssh_run_exit_questionnaire.py',
+    'ssh_run_summary_findings.py',
+    'sftp_transfer.py',
+]
+
+# Top level packages that are slow to import or only available on the Windows reporting machines
+HEAVY_MODULES = ['pyodbc', 'win32com', 'pdfkit', 'PyPDF2', 'jinja2', 'paramiko']
+
+class StandIns(object):
+    '''Import hook providing the benchmark stand-ins for the Windows-only modules when they aren't installed, so that
+    entry points can be measured on any machine. The stand-ins are only loaded if the entry point imports them.'''
+    def __init__(self):
+        self.modules = {}
+        for name, fake in (('pyodbc', 'fake_databases'), ('win32com', 'fake_outlook')):
+            try:
+                imp.find_module(name)
+            except ImportError:
+                self.modules[name] = fake
+
+    def find_module(self, name, path=None):
+        if name.split('.')[0] in self.modules:
+            return self
+
+    def load_module(self, name):
+        if name not in sys.modules:
+            __import__(self.modules[name.split('.')[0]]).install()
+        return sys.modules[name]
+
+def probe(script):
+    """
+    Runs the script with --help in the current process and returns the heavy modules loaded and any error raised.
+    Must be run in a fresh process.
+    """
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCHMARK_DIR)
+    sys.meta_path.append(StandIns())
+    sys.argv = [os.path.join(REPO_DIR, script), '--help']
+    # Discard the help message
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    error = None
+    try:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code:
+            error = 'Exited with status {code}'.format(code=e.code)
+    except Exception as e:
+        error = '{name}: {message}'.format(name=type(e).__name__, message=e)
+    finally:
+        sys.stdout = stdout
+    return {'loaded': [name for name in HEAVY_MODULES if name in sys.modules], 'error': error}
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description='Measures the start-up time of each gel_cover_report entry point')
+    parser.add_argument('scripts', metavar='script', nargs='*', default=ENTRY_POINTS, help='Entry points to measure (default {scripts})'.format(scripts=' '.join(ENTRY_POINTS)))
+    parser.add_argument('--repeat', metavar='N', type=int, default=10, help='Number of times to start each entry point (default 10)')
+    parser.add_argument('--results', metavar='FILE', default=os.path.join(BENCHMARK_DIR, 'startup_results.jsonl'), help='JSON lines file results are appended to (default benchmarks/startup_results.jsonl)')
+    parser.add_argument('--no_save', action='store_true', help='Print results without saving them')
+    # Used internally to start a single entry point in a child process
+    parser.add_argument('--probe', metavar='SCRIPT', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def measure(script, repeat):
+    """
+    Starts the script with --help repeat times and returns the result dictionary
+    """
+    seconds = []
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--probe', script], cwd=REPO_DIR, stderr=open(os.devnull, 'w'))
+        seconds.append(time.time() - start)
+        result = json.loads(output.splitlines()[-1])
+    seconds.sort()
+    return {
+        'script': script,
+        'repeat': repeat,
+        'min': seconds[0],
+        'median': seconds[len(seconds) // 2],
+        'max': seconds[-1],
+        'loaded': result['loaded'],
+        'error': result['error'],
+    }
+
+def git_commit():
+    """
+    Returns the current git commit of the repository, or None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_result(results_file, script):
+    """
+    Returns the last saved result for the same entry point, or None
+    """
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as results:
+            for line in results:
+                result = json.loads(line)
+                if result.get('script') == script:
+                    previous = result
+    return previous
+
+def main():
+    args = process_arguments()
+    # Child process: start one entry point and print the modules it loaded
+    if args.probe:
+        print json.dumps(probe(args.probe))
+        return
+    commit = git_commit()
+    for script in args.scripts:
+        result = measure(script, args.repeat)
+        result.update({'date': datetime.datetime.now().isoformat(), 'commit': commit, 'python': sys.version.split()[0]})
+        print "INFO\t{script}: median {median:.3f}s (min {min:.3f}s, max {max:.3f}s over {repeat} runs), heavy modules loaded: {loaded}".format(
+            script=script,
+            median=result['median'],
+            min=result['min'],
+            max=result['max'],
+            repeat=result['repeat'],
+            loaded=', '.join(result['loaded']) or 'none'
+        )
+        if result['error']:
+            print "ERROR\t{script} --help failed: {error}".format(script=script, error=result['error'])
+        previous = previous_result(args.results, script)
+        if previous:
+            print "INFO\tChange from {commit} ({date}): {change:+.1f}% median start-up time".format(
+                commit=previous['commit'],
+                date=previous['date'],
+                change=100.0 * (result['median'] - previous['median']) / previous['median']
+            )
+        if not args.no_save:
+            with open(args.results, 'a') as results:
+                results.write(json.dumps(result, sort_keys=True) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""
+db_connections.py
+
+Shared ODBC connection pools for the Moka and Geneworks databases. Requires a config file with database details.
+
+All database access goes through get_pool(), so connections are reused for the whole run rather than being opened
+for each query. Each pool holds at most MAX_SIZE connections (set for the run with set_pool_size()), and threads
+wait for a connection to be checked in once that many are open. Connections that have been idle for longer than
+IDLE_CHECK seconds are checked with a lightweight query when they are checked out of the pool, and the time spent
+connecting and checking out connections is recorded for each pool. pyodbc is imported when the first connection is
+opened. close_pools() closes the idle connections held by all pools.
+
+Opening a connection is bounded by a login timeout and retried with jittered backoff if it fails, and queries are
+bounded by a query timeout. Each data source has a circuit breaker, which stops connection attempts after repeated
+failures so that the rest of the run fails fast. These can be set in the data source's section of the config file
+(CONNECT_TIMEOUT, QUERY_TIMEOUT, RETRIES, FAILURE_THRESHOLD and RESET_TIMEOUT).
+"""
+import time
+import threading
+from contextlib import contextmanager
+from app_config import get_config, get_number
+from resilience import CircuitBreaker, TransientError, retry_call
+
+# Defaults for the optional settings in the MOKA and GENEWORKS sections of the config file
+CONNECT_TIMEOUT = 30
+QUERY_TIMEOUT = 300
+RETRIES = 2
+RETRY_DELAY = 2.0
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 300
+# Seconds a connection can be idle before it is checked with a query when checked out
+IDLE_CHECK = 60
+# Default maximum number of connections in each pool
+MAX_SIZE = 2
+
+def connection_string(data_source):
+    """
+    Returns the ODBC connection string for a data source (MOKA or GENEWORKS) using details from the config file
+    """
+    config = get_config()
+    if data_source == "MOKA":
+        return 'DRIVER={{SQL Server}}; SERVER={server}; DATABASE={database};'.format(
+            server=config.get("MOKA", "SERVER"),
+            database=config.get("MOKA", "DATABASE")
+            )
+    elif data_source == "GENEWORKS":
+        return 'DRIVER={{SQL Server}}; SERVER={server}; DATABASE={database}; UID={user}; PWD={password};'.format(
+            server=config.get("GENEWORKS", "SERVER"),
+            database=config.get("GENEWORKS", "DATABASE"),
+            user=config.get("GENEWORKS", "USER"),
+            password=config.get("GENEWORKS", "PASSWORD")
+            )
+    raise ValueError("Unknown data source {data_source}".format(data_source=data_source))
+
+def print_message(message):
+    """
+    Default log function for connection pools, which prints the message to the caller's output
+    """
+    print(message)
+
+class ConnectionPool(object):
+    '''Pool of reusable pyodbc connections to a single data source.
+
+    Args:
+        name: Name of the data source, used when reporting statistics
+        connection_string: ODBC connection string
+        connect_timeout: Seconds to wait when opening a connection (0 for no timeout)
+        query_timeout: Seconds to wait for each query (0 for no timeout)
+        retries: Number of times opening a connection is retried after it fails
+        breaker: Optional CircuitBreaker for connection attempts
+        max_size: Maximum number of connections open at once (checked out or idle)
+        idle_check: Seconds a connection can be idle before it is checked with a query when checked out
+        log: Optional function called with a message before each retry. Defaults to printing the message.
+    Attributes:
+        connects: Number of connections opened
+        connect_time: Total seconds spent opening connections
+        checkouts: Number of connections checked out
+        checkout_time: Total seconds spent checking out connections (including any connects)
+    Methods:
+        checkout(autocommit): Returns a live connection from the pool, opening one if none are idle, or waiting for one
+            to be checked in if max_size connections are open
+        checkin(cnxn): Returns a connection to the pool
+        connection(autocommit): Context manager that checks a connection out and back in
+        close(): Closes all idle connections
+    '''
+    # Query used to check that an idle connection is still usable
+    liveness_sql = 'SELECT 1;'
+
+    def __init__(self, name, connection_string, connect_timeout=CONNECT_TIMEOUT, query_timeout=QUERY_TIMEOUT, retries=RETRIES, breaker=None,
+                 max_size=MAX_SIZE, idle_check=IDLE_CHECK, log=None):
+        self.name = name
+        self.connection_string = connection_string
+        self.connect_timeout = connect_timeout
+        self.query_timeout = query_timeout
+        self.retries = retries
+        self.breaker = breaker or CircuitBreaker(name)
+        self.max_size = max_size
+        self.idle_check = idle_check
+        self.log = log or print_message
+        self.connects = 0
+        self.connect_time = 0.0
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        # List of (connection, time checked in) tuples
+        self._idle = []
+        # Number of connections open, whether checked out or idle
+        self._size = 0
+        self._lock = threading.Lock()
+        # Notified when a connection is checked in or discarded
+        self._available = threading.Condition(self._lock)
+
+    def _open(self):
+        import pyodbc
+        try:
+            cnxn = pyodbc.connect(self.connection_string, autocommit=True, timeout=self.connect_timeout)
+        except pyodbc.Error as e:
+            raise TransientError("Unable to connect to {name}: {error}".format(name=self.name, error=e))
+        # Queries raise pyodbc.OperationalError if they take longer than query_timeout seconds
+        cnxn.timeout = self.query_timeout
+        return cnxn
+
+    def _connect(self):
+        start = time.time()
+        cnxn = retry_call(
+            lambda: self.breaker.call(self._open),
+            attempts=self.retries + 1,
+            base_delay=RETRY_DELAY,
+            description='{name} connection'.format(name=self.name),
+            log=self.log
+            )
+        with self._lock:
+            self.connects += 1
+            self.connect_time += time.time() - start
+        return cnxn
+
+    def _is_alive(self, cnxn):
+        import pyodbc
+        try:
+            cnxn.cursor().execute(self.liveness_sql).fetchall()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _reserve(self):
+        """
+        Returns an idle (connection, time checked in) tuple, or None if a new connection can be opened. Waits for a
+        connection to be checked in if max_size connections are open.
+        """
+        deadline = time.time() + self.query_timeout if self.query_timeout else None
+        with self._available:
+            while not self._idle and self._size >= self.max_size:
+                # Connections are held for at most one query or transaction, so give up if none are checked in
+                # within the query timeout rather than waiting forever
+                if deadline is not None and time.time() >= deadline:
+                    raise TransientError("No {name} connections available: all {size} are in use".format(name=self.name, size=self._size))
+                self._available.wait(None if deadline is None else max(deadline - time.time(), 0))
+            if self._idle:
+                return self._idle.pop()
+            self._size += 1
+            return None
+
+    def _discard(self, cnxn):
+        """
+        Closes a connection that won't be returned to the pool, so that another can be opened
+        """
+        import pyodbc
+        with self._available:
+            self._size -= 1
+            self._available.notify()
+        if cnxn is not None:
+            try:
+                cnxn.close()
+            except pyodbc.Error:
+                pass
+
+    def checkout(self, autocommit=True):
+        """
+        Returns a live connection from the pool, opening a new one if there are no idle connections
+        """
+        start = time.time()
+        cnxn = None
+        while cnxn is None:
+            idle = self._reserve()
+            if idle is None:
+                try:
+                    cnxn = self._connect()
+                except Exception:
+                    self._discard(None)
+                    raise
+            # Only check connections that may have been dropped by the server while idle
+            elif time.time() - idle[1] < self.idle_check or self._is_alive(idle[0]):
+                cnxn = idle[0]
+            else:
+                # Discard connections that have dropped while idle
+                self._discard(idle[0])
+        cnxn.autocommit = autocommit
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_time += time.time() - start
+        return cnxn
+
+    def checkin(self, cnxn):
+        """
+        Returns a connection to the pool. Any uncommitted changes are rolled back.
+        """
+        import pyodbc
+        try:
+            if not cnxn.autocommit:
+                cnxn.rollback()
+                cnxn.autocommit = True
+        except pyodbc.Error:
+            # Don't return broken connections to the pool
+            self._discard(cnxn)
+            return
+        with self._available:
+            self._idle.append((cnxn, time.time()))
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, autocommit=True):
+        """
+        Context manager that checks out a connection and checks it back in when finished
+        """
+        cnxn = self.checkout(autocommit=autocommit)
+        try:
+            yield cnxn
+        finally:
+            self.checkin(cnxn)
+
+    def close(self):
+        """
+        Closes all idle connections in the pool
+        """
+        import pyodbc
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._available.notify_all()
+        for cnxn, checked_in in idle:
+            try:
+                cnxn.close()
+            except pyodbc.Error:
+                pass
+
+    def __str__(self):
+        return "{name} connections: {connects} opened in {connect_time:.3f}s, {checkouts} checkouts in {checkout_time:.3f}s".format(
+            name=self.name,
+            connects=self.connects,
+            connect_time=self.connect_time,
+            checkouts=self.checkouts,
+            checkout_time=self.checkout_time
+            )
+
+# Connection pools for each data source, created on first use
+_pools = {}
+_pools_lock = threading.Lock()
+# Maximum number of connections in each pool, set by set_pool_size()
+_max_size = [MAX_SIZE]
+
+def set_pool_size(max_size):
+    """
+    Sets the maximum number of connections held by each pool, including pools that have already been created
+    """
+    with _pools_lock:
+        _max_size[0] = max_size
+        for pool in _pools.values():
+            pool.max_size = max_size
+
+def get_pool(data_source):
+    """
+    Returns the connection pool for a data source (MOKA or GENEWORKS), creating it on first use
+    """
+    with _pools_lock:
+        if data_source not in _pools:
+            _pools[data_source] = ConnectionPool(
+                data_source,
+                connection_string(data_source),
+                connect_timeout=get_number(data_source, "CONNECT_TIMEOUT", CONNECT_TIMEOUT),
+                query_timeout=get_number(data_source, "QUERY_TIMEOUT", QUERY_TIMEOUT),
+                retries=get_number(data_source, "RETRIES", RETRIES),
+                max_size=_max_size[0],
+                breaker=CircuitBreaker(
+                    data_source,
+                    failure_threshold=get_number(data_source, "FAILURE_THRESHOLD", FAILURE_THRESHOLD),
+                    reset_timeout=get_number(data_source, "RESET_TIMEOUT", RESET_TIMEOUT)
+                    )
+                )
+        return _pools[data_source]
+
+def pools():
+    """
+    Returns list of all connection pools that have been created
+    """
+    with _pools_lock:
+        return [_pools[data_source] for data_source in sorted(_pools)]
+
+def close_pools():
+    """
+    Closes the idle connections in all pools. The pools (and their statistics) are kept, and open new connections if
+    used again.
+    """
+    for pool in pools():
+        pool.close()
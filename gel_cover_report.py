@@ -8,9 +8,23 @@ Requirements:
     PyPDF2
     jinja2
 
-usage: gel_cover_report.py [-h] -n NGSTestID [NGSTestID ...] [--skip_labkey]
-                           [--ignore_block] [--submit_exit_q]
-                           [--download_summary]
+usage: gel_cover_report.py [-h]
+                           (-n NGSTestID [NGSTestID ...] | --worklist FILE | --ready | --watch)
+                           [--poll_interval SECONDS] [--chunk_size N]
+                           [--preflight]
+                           [--skip_labkey]
+                           [--labkey_cache FILE] [--labkey_cache_ttl HOURS]
+                           [--labkey_cache_names] [--no_labkey_cache]
+                           [--invalidate_labkey_cache] [--ignore_block]
+                           [--submit_exit_q]
+                           [--download_summary] [--stream_summary]
+                           [--summary_cache DIR] [--no_summary_cache]
+                           [--prune_summary_cache DAYS]
+                           [--report_index_cache FILE]
+                           [--email_backend {outlook,drafts,msg,eml}]
+                           [--email_outbox DIR]
+                           [--journal FILE] [--resume] [--moka_batch_size N]
+                           [--timings FILE] [--profile] [--workers N]
 
 Creates cover page for GeL results and attaches to report provided by GeL
 
@@ -18,10 +32,45 @@ optional arguments:
   -h, --help            show this help message and exit
   -n NGSTestID [NGSTestID ...]
                         Moka NGSTestID from NGSTest table
+  --worklist FILE       File of Moka NGSTestIDs to report ('-' for stdin),
+                        separated by new lines, spaces or commas. Anything
+                        after a # on a line is ignored.
+  --ready               Report all negneg tests in Moka with an interpretation
+                        request ID that are not blocked and have not been
+                        reported
+  --watch               Run as a service, polling Moka for negneg tests that are
+                        ready to report and reporting them once their summary
+                        of findings is available. Completed stages recorded in
+                        the journal are always skipped.
+  --poll_interval SECONDS
+                        Number of seconds between polls of Moka in watch mode
+                        (default 300)
+  --chunk_size N        Number of tests fetched from Moka and processed
+                        together (default 100). A progress line is printed
+                        after each chunk.
+  --preflight           Optional flag to run the pre-flight checks for all
+                        tests and print which would be reported and why the
+                        others would not, without submitting, downloading,
+                        rendering or updating anything (dry run)
   --skip_labkey         Optional flag to skip the check that DOB and NHS
                         number in LIMS match labkey before reporting. This can
                         also be used for cases where DOB/NHS number is
                         missing.
+  --labkey_cache FILE   SQLite file used to cache LabKey demographics between
+                        runs (default gel_labkey_cache.sqlite in the home
+                        folder)
+  --labkey_cache_ttl HOURS
+                        Number of hours cached LabKey demographics are used
+                        for before being retrieved from LabKey again (default
+                        168)
+  --labkey_cache_names  Optional flag to include patient names in the LabKey
+                        cache. By default names are not cached.
+  --no_labkey_cache     Optional flag to bypass the LabKey cache and always
+                        retrieve demographics from LabKey
+  --invalidate_labkey_cache
+                        Optional flag to remove the participants in this run
+                        from the LabKey cache, so their demographics are
+                        retrieved from LabKey again
   --ignore_block        Optional flag to allow reporting of cases where
                         automated reporting in blocked in Moka. NOTE
                         unblocking cases in Moka is preferable to using this.
@@ -30,6 +79,52 @@ optional arguments:
   --download_summary    Optional flag to download summary of findings
                         automatically from CIP-API to
                         P:\Bioinformatics\GeL\technical_reports
+  --stream_summary      Optional flag to stream summary of findings downloaded
+                        with --download_summary straight back over SSH,
+                        instead of saving them on GENAPP01 and copying them
+                        with SFTP
+  --summary_cache DIR   Folder used to cache summary of findings downloaded
+                        with --download_summary (default gel_summary_cache in
+                        the home folder). A report already downloaded for the
+                        same IR ID, IR version and header is copied from the
+                        cache instead of contacting GENAPP01.
+  --no_summary_cache    Optional flag to bypass the summary of findings cache
+                        and always download from GENAPP01
+  --prune_summary_cache DAYS
+                        Remove reports not used in the last DAYS days from the
+                        summary of findings cache at the start of the run
+  --report_index_cache FILE
+                        Optional JSON file used to cache the index of summary
+                        of findings reports in
+                        P:\Bioinformatics\GeL\technical_reports between runs.
+                        The cache is rebuilt if the folder has been modified.
+  --email_backend {outlook,drafts,msg,eml}
+                        How emails to clinicians are generated (default
+                        outlook). outlook opens each email in an Outlook
+                        window, drafts saves them to the Outlook Drafts
+                        folder, msg saves them as .msg files in the
+                        --email_outbox folder using Outlook, and eml writes
+                        them as .eml files to the --email_outbox folder
+                        without using Outlook.
+  --email_outbox DIR    Folder that .msg and .eml files are written to
+                        (required for the msg and eml email backends)
+  --journal FILE        SQLite file recording the stages completed for each
+                        test (default gel_cover_report_journal.sqlite in the
+                        home folder)
+  --resume              Optional flag to skip stages recorded in the journal
+                        as completed by a previous run (e.g. when rerunning a
+                        batch that failed part way through)
+  --moka_batch_size N   Number of tests to apply Moka updates for in each
+                        transaction (default 50). All updates for a test are
+                        always applied together, and if a transaction fails
+                        each of its tests is retried on its own.
+  --timings FILE        Optional file to write timing spans for each stage to
+                        as JSON lines ('-' for stderr)
+  --profile             Optional flag to print a table of the time spent in
+                        each stage at the end of the run
+  --workers N           Number of tests to process concurrently (default 1).
+                        Output is printed grouped per test in the order the
+                        NGSTestIDs were supplied.
 """
 import sys
 import os
@@ -37,21 +132,41 @@ import io
 import re
 import argparse
 import datetime
-import fnmatch
-from ConfigParser import ConfigParser
-import win32com.client as win32
-import pyodbc
-import pdfkit
-from PyPDF2 import PdfFileMerger
-from jinja2 import Environment, FileSystemLoader
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from functools import partial
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+# pyodbc, pdfkit, PyPDF2, jinja2, paramiko and win32com are imported where they're first used, so that --help and
+# runs that skip stages don't pay for loading them
 from ssh_run_exit_questionnaire import ExitQuestionnaire_SSH
 from ssh_run_summary_findings import SummaryFindings_SSH
-from ssh_run_labkey import LabKey_SSH
-from generate_email import generate_email
+from ssh_run_labkey import LabKey_SSH, LabKeyBatch_SSH
+from generate_email import get_mailer, BACKENDS as EMAIL_BACKENDS
+from report_index import ReportIndex
+from summary_cache import SummaryCache
+from labkey_cache import LabKeyCache
+import timing
+import sql_statements
+from db_connections import get_pool, pools, set_pool_size, close_pools
+from genapp_session import get_breaker, close_sessions
+from resilience import RemoteCallError, TransientError
+from run_journal import RunJournal
 
-# Read config file (must be called config.ini and stored in same directory as script)
-config = ConfigParser()
-config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"))
+# Path to wkhtmltopdf executable used by pdfkit
+WKHTMLTOPDF = r'\\gstt.local\shared\Genetics_Data2\Array\Software\wkhtmltopdf\bin\wkhtmltopdf.exe'
+# Folder containing the summary of findings reports downloaded from the interpretation portal
+TECHNICAL_REPORTS_FOLDER = r'\\gstt.local\shared\Genetics\Bioinformatics\GeL\technical_reports'
+# HTML template for cover report
+COVER_TEMPLATE = r'\\gstt.local\apps\Moka\Files\Software\100K\gel_cover_report_template.html'
+# Folder that combined reports are saved to, formatted with the current year and month
+GEL_REPORT_OUTPUT_FOLDER = r'\\gstt.local\apps\Moka\Files\ngs\{year}\{month}'
+# Seconds after which watch mode retries a test that failed, if the technical reports folder hasn't changed
+RETRY_INTERVAL = 3600
 
 def process_arguments():
     """
@@ -61,12 +176,68 @@ def process_arguments():
     parser = argparse.ArgumentParser(description='Creates cover page for GeL results and attaches to report provided by GeL')
     # Define the arguments that will be taken. nargs='+' allows multiple NGSTestIDs from NGSTest table in Moka can be passed as arguments.
     # action='store_true' makes the argument into a boolean flag (i.e. if it is used, it will be set to true, if it isn't used, it will be set to false)
-    parser.add_argument('-n', metavar='NGSTestID', required=True, type=int, nargs='+', help='Moka NGSTestID from NGSTest table')
+    # Either NGSTestIDs must be supplied (as arguments, in a worklist file or selected from Moka), or the script must be run in watch mode
+    tests = parser.add_mutually_exclusive_group(required=True)
+    tests.add_argument('-n', metavar='NGSTestID', type=int, nargs='+', help='Moka NGSTestID from NGSTest table')
+    tests.add_argument(
+            '--worklist',
+            metavar='FILE',
+            help=r"File of Moka NGSTestIDs to report ('-' for stdin), separated by new lines, spaces or commas. Anything after a # on a line is ignored."
+        )
+    tests.add_argument(
+            '--ready',
+            action='store_true',
+            help=r'Report all negneg tests in Moka with an interpretation request ID that are not blocked and have not been reported'
+        )
+    tests.add_argument(
+            '--watch',
+            action='store_true',
+            help=r'Run as a service, polling Moka for negneg tests that are ready to report and reporting them once their summary of findings is available. Completed stages recorded in the journal are always skipped.'
+        )
+    parser.add_argument(
+            '--poll_interval',
+            metavar='SECONDS',
+            type=float,
+            default=300,
+            help=r'Number of seconds between polls of Moka in watch mode (default 300)'
+        )
+    parser.add_argument(
+            '--chunk_size',
+            metavar='N',
+            type=int,
+            default=100,
+            help=r'Number of tests fetched from Moka and processed together (default 100). A progress line is printed after each chunk.'
+        )
+    parser.add_argument(
+            '--preflight',
+            action='store_true',
+            help=r'Optional flag to run the pre-flight checks for all tests and print which would be reported and why the others would not, without submitting, downloading, rendering or updating anything (dry run)'
+        )
     parser.add_argument(
             '--skip_labkey',
             action='store_true',
             help=r'Optional flag to skip the check that DOB and NHS number in LIMS match labkey before reporting. This can also be used for cases where DOB/NHS number is missing.'
         )
+    parser.add_argument(
+            '--labkey_cache',
+            metavar='FILE',
+            default=os.path.join(os.path.expanduser('~'), 'gel_labkey_cache.sqlite'),
+            help=r'SQLite file used to cache LabKey demographics between runs (default gel_labkey_cache.sqlite in the home folder)'
+        )
+    parser.add_argument(
+            '--labkey_cache_ttl',
+            metavar='HOURS',
+            type=float,
+            default=24 * 7,
+            help=r'Number of hours cached LabKey demographics are used for before being retrieved from LabKey again (default 168)'
+        )
+    parser.add_argument('--labkey_cache_names', action='store_true', help=r'Optional flag to include patient names in the LabKey cache. By default names are not cached.')
+    parser.add_argument('--no_labkey_cache', action='store_true', help=r'Optional flag to bypass the LabKey cache and always retrieve demographics from LabKey')
+    parser.add_argument(
+            '--invalidate_labkey_cache',
+            action='store_true',
+            help=r'Optional flag to remove the participants in this run from the LabKey cache, so their demographics are retrieved from LabKey again'
+        )
     parser.add_argument(
             '--ignore_block',
             action='store_true',
@@ -74,127 +245,263 @@ def process_arguments():
         )
     parser.add_argument('--submit_exit_q', action='store_true', help=r'Optional flag to submit a negneg clinical report and exit questionnaire automatically to CIP-API')
     parser.add_argument('--download_summary', action='store_true', help=r'Optional flag to download summary of findings automatically from CIP-API to P:\Bioinformatics\GeL\technical_reports')
+    parser.add_argument(
+            '--stream_summary',
+            action='store_true',
+            help=r'Optional flag to stream summary of findings downloaded with --download_summary straight back over SSH, instead of saving them on GENAPP01 and copying them with SFTP'
+        )
+    parser.add_argument(
+            '--summary_cache',
+            metavar='DIR',
+            default=os.path.join(os.path.expanduser('~'), 'gel_summary_cache'),
+            help=r'Folder used to cache summary of findings downloaded with --download_summary (default gel_summary_cache in the home folder). A report already downloaded for the same IR ID, IR version and header is copied from the cache instead of contacting GENAPP01.'
+        )
+    parser.add_argument('--no_summary_cache', action='store_true', help=r'Optional flag to bypass the summary of findings cache and always download from GENAPP01')
+    parser.add_argument(
+            '--prune_summary_cache',
+            metavar='DAYS',
+            type=float,
+            help=r'Remove reports not used in the last DAYS days from the summary of findings cache at the start of the run'
+        )
+    parser.add_argument(
+            '--report_index_cache',
+            metavar='FILE',
+            help=r'Optional JSON file used to cache the index of summary of findings reports in P:\Bioinformatics\GeL\technical_reports between runs. The cache is rebuilt if the folder has been modified.'
+        )
+    parser.add_argument(
+            '--email_backend',
+            choices=EMAIL_BACKENDS,
+            default='outlook',
+            help=r'How emails to clinicians are generated (default outlook). outlook opens each email in an Outlook window, drafts saves them to the Outlook Drafts folder, msg saves them as .msg files in the --email_outbox folder using Outlook, and eml writes them as .eml files to the --email_outbox folder without using Outlook.'
+        )
+    parser.add_argument('--email_outbox', metavar='DIR', help=r'Folder that .msg and .eml files are written to (required for the msg and eml email backends)')
+    parser.add_argument(
+            '--journal',
+            metavar='FILE',
+            default=os.path.join(os.path.expanduser('~'), 'gel_cover_report_journal.sqlite'),
+            help=r'SQLite file recording the stages completed for each test (default gel_cover_report_journal.sqlite in the home folder)'
+        )
+    parser.add_argument(
+            '--resume',
+            action='store_true',
+            help=r'Optional flag to skip stages recorded in the journal as completed by a previous run (e.g. when rerunning a batch that failed part way through)'
+        )
+    parser.add_argument(
+            '--moka_batch_size',
+            metavar='N',
+            type=int,
+            default=50,
+            help=r'Number of tests to apply Moka updates for in each transaction (default 50). All updates for a test are always applied together, and if a transaction fails each of its tests is retried on its own.'
+        )
+    parser.add_argument(
+            '--timings',
+            metavar='FILE',
+            help=r"Optional file to write timing spans for each stage to as JSON lines ('-' for stderr)"
+        )
+    parser.add_argument('--profile', action='store_true', help=r'Optional flag to print a table of the time spent in each stage at the end of the run')
+    parser.add_argument(
+            '--workers',
+            metavar='N',
+            type=int,
+            default=1,
+            help=r'Number of tests to process concurrently (default 1). Output is printed grouped per test in the order the NGSTestIDs were supplied.'
+        )
     # Return the arguments
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error('--chunk_size must be at least 1')
+    if args.preflight and args.watch:
+        parser.error('--preflight cannot be used with --watch')
+    if args.email_backend in ('msg', 'eml') and not args.email_outbox:
+        parser.error('--email_outbox is required for the {backend} email backend'.format(backend=args.email_backend))
+    return args
 
-class GeLGeneworksCharge(object):
-    def __init__(self):
-        # PRU
-        self.pru = None
-        # Geneworks test ID for adding charge
-        self.test_id = None
-        # Geneworks specimen ID for adding charge
-        self.specimen_id = None
-
-    def get_test_details(self, pru):
-        """
-        Retrieves required Geneworks details for entering charge
-        """
-        # Store the PRU for use by other functions
-        self.pru = pru
-        # establish pyodbc connection to Moka
-        cnxn = pyodbc.connect('DRIVER={{SQL Server}}; SERVER={server}; DATABASE={database};'.format(
-            server=config.get("MOKA", "SERVER"),
-            database=config.get("MOKA", "DATABASE")
-            ), 
-            autocommit=True
-        )
-        # return cursor to execute query
-        cursor = cnxn.cursor()
-        # query to retrieve the test ID and specimen number for the test. These are required for the stored procedure that adds the charge.
-        # DisorderID 60 is 'Whole Genome Sequencing' 
-        # TestDescriptionID 18 is 'GeL'
-        # There can be multiple specimens/tests per patient with these Disorder and TestDescriptionIDs, (where the omics samples that are stored have also had these tests added)
-        # Therefore need to select the sample that has actually had DNA extracted, hence the inner join to the dnanumberlinked view.
-        test_details_sql = (
-            'SELECT "gwv-testlinked".TestID, "gwv-specimenlinked".SpecimenTrustID '
-            'FROM ("gwv-dnatestrequestlinked" INNER JOIN (("gwv-testlinked" INNER JOIN "gwv-specimenlinked" ON "gwv-testlinked".SpecimenID = "gwv-specimenlinked".SpecimenID) '
-            'INNER JOIN "gwv-patientlinked" ON "gwv-specimenlinked".PatientID = "gwv-patientlinked".PatientID) ON "gwv-dnatestrequestlinked".TestID = "gwv-testlinked".TestID) '
-            'INNER JOIN "gwv-dnanumberlinked" ON "gwv-specimenlinked".SpecimenID = "gwv-dnanumberlinked".SpecimenID '
-            'WHERE "gwv-patientlinked".PatientTrustID = \'{pru}\' AND "gwv-dnatestrequestlinked".DisorderID = 60 AND "gwv-dnatestrequestlinked".TestDescriptionID = 18'
-        ).format(pru=pru)
-        # Exexute the query
-        rows = cursor.execute(test_details_sql).fetchall()
-        # Check that there is only 1 record returned and set the test id and spec id attributes. If a different number were returned, leave as None and print error message.
-        if len(rows) == 1:
-            self.test_id = rows[0].TestID
-            self.specimen_id = rows[0].SpecimenTrustID
-        elif len(rows) == 0:
-            print "ERROR\tUnable to find GeL test in Geneworks for {pru}.".format(pru=pru)
-        elif len(rows) > 1:
-            print "ERROR\tMultiple GeL tests found in Geneworks for {pru}.".format(pru=pru)
-
-    def insert_charge(self, test_type, cost):
-        """
-        Inserts GeL charge to GeneWorks for given PRU
-        """
-        if self.test_id and self.specimen_id:
-            # establish pyodbc connection to Geneworks
-            cnxn = pyodbc.connect('DRIVER={{SQL Server}}; SERVER={server}; DATABASE={database}; UID={user}; PWD={password};'.format(
-                server=config.get("GENEWORKS", "SERVER"),
-                database=config.get("GENEWORKS", "DATABASE"),
-                user=config.get("GENEWORKS", "USER"),
-                password=config.get("GENEWORKS", "PASSWORD")
-                ), 
-            autocommit=True
-            )
+class GeLGeneworksChargeBatch(object):
+    """
+    Enters GeL charges into Geneworks for all tests in a run.
+    Geneworks test and specimen IDs are retrieved directly from Geneworks for every PRU with one query per chunk of PRUs, then all charges
+    are inserted over a single Geneworks connection, committing after every batch_size charges.
+    """
+    def __init__(self, batch_size=50, chunk_size=500):
+        # Number of charges inserted per transaction
+        self.batch_size = batch_size
+        # Number of PRUs included in each query for test details
+        self.chunk_size = chunk_size
+        # List of charge dictionaries, in the order they were added
+        self.charges = []
+        # Charges are added from worker threads
+        self._lock = threading.Lock()
+
+    def add(self, pru, test_type, cost, ngs_test_id=None, irid=None):
+        """
+        Adds a charge to be entered for the given PRU
+        """
+        with self._lock:
+            self.charges.append({
+                'pru': pru,
+                'ngs_test_id': ngs_test_id,
+                'irid': irid,
+                'test_type': test_type,
+                'cost': cost,
+                # Geneworks test ID and specimen ID for adding charge
+                'test_id': None,
+                'specimen_id': None,
+                # Record number returned by Geneworks when the charge is inserted
+                'record_no': None,
+                # Error message if the charge couldn't be inserted
+                'error': None
+            })
+
+    def get_test_details(self, geneworks=None):
+        """
+        Retrieves required Geneworks details for entering charges for all PRUs, querying Geneworks directly
+        """
+        geneworks = geneworks or GeneworksQueryExecuter()
+        rows_by_pru = geneworks.get_gel_tests([charge['pru'] for charge in self.charges], chunk_size=self.chunk_size)
+        # Check that there is only 1 record returned for each PRU and set the test id and spec id. If a different number were returned, record an error.
+        for charge in self.charges:
+            rows = rows_by_pru.get(trust_id_key(charge['pru']), [])
+            if len(rows) == 1:
+                charge['test_id'] = rows[0].TestID
+                charge['specimen_id'] = rows[0].SpecimenTrustID
+            elif len(rows) == 0:
+                charge['error'] = "Unable to find GeL test in Geneworks for {pru}.".format(pru=charge['pru'])
+            elif len(rows) > 1:
+                charge['error'] = "Multiple GeL tests found in Geneworks for {pru}.".format(pru=charge['pru'])
+
+    def insert_charges(self):
+        """
+        Inserts all charges for which Geneworks test and specimen IDs were determined, over a single Geneworks connection
+        """
+        for charge in self.charges:
+            if not charge['error'] and not (charge['test_id'] and charge['specimen_id']):
+                charge['error'] = "Unable to insert charge for {pru}. Test ID or Specimen ID not determined. Please add manually.".format(pru=charge['pru'])
+        pending = [charge for charge in self.charges if not charge['error']]
+        if not pending:
+            return
+        import pyodbc
+        # Check out a connection to Geneworks from the pool. Autocommit is off so that each batch of charges is committed in one transaction.
+        with get_pool("GENEWORKS").connection(autocommit=False) as cnxn:
             # return cursor to execute query
             cursor = cnxn.cursor()
-            # Add in sql for spInsertLabReportCostDetail
-            # Necessary to use SET NOCOUNT ON to prevent 'pyodbc.ProgrammingError: No results.  Previous SQL was not a query.' error, see:
-            # https://stackoverflow.com/questions/7753830/mssql2008-pyodbc-previous-sql-was-not-a-query
-            charge_sql = (
-                'SET NOCOUNT ON; '
-                'DECLARE @return_value int, @RecordNo int, @timestamp datetime; '
-                'set @timestamp = getdate(); '
-                'EXEC @return_value = [dbo].[spInsertLabReportCostDetail] '
-                '@SpecimenNo = \'{specimen_id}\', '
-                '@CostTypeID = NULL, '
-                '@Destination = NULL, '
-                '@DateReported = @timestamp, '
-                '@TestType = N\'{test_type}\', '
-                '@Cost = {cost}, '
-                '@DNAUnitsSample = NULL, '
-                '@DNAUnitsAnalysis = NULL, '
-                '@DNAUnitsReport = NULL, '
-                '@DNAUnitsTotal = 1, '
-                '@CytoUnits = NULL, '
-                '@EnteredByID = 888, ' # This is the user 'moka' in geneworks
-                '@PCRFee = NULL, '
-                '@TestID = {test_id}, '
-                '@RecordNo = @RecordNo OUTPUT; '
-                'SELECT @RecordNo as record_no;'
-            ).format(
-                specimen_id=self.specimen_id, 
-                test_id=self.test_id,
-                test_type=test_type,
-                cost=cost
-                )            
-            try:
-                # Insert the charge and capture the returned record number
-                rows = cursor.execute(charge_sql).fetchall()
-                # Check that one and only one record has been updated: 
-                # Print error message if anything other than 1 record number is returned from the query
-                if len(rows) != 1:
-                    print "ERROR\tWhen inserting charge for {pru}, {records} were updated.".format(pru=self.pru, records=len(rows))
-            except:
-                # Error message if theres an error inserting charge
-                print "ERROR\tEncountered error when inserting charge for {pru}.".format(pru=self.pru)
+            for i in range(0, len(pending), self.batch_size):
+                batch = pending[i:i + self.batch_size]
+                for charge in batch:
+                    try:
+                        # Insert the charge and capture the returned record number. The same parameterised statement is used for every charge.
+                        rows = cursor.execute(sql_statements.get('geneworks_insert_charge'), (charge['specimen_id'], charge['test_type'], charge['cost'], charge['test_id'])).fetchall()
+                        # Check that one and only one record has been updated: 
+                        # Record error message if anything other than 1 record number is returned from the query
+                        if len(rows) != 1:
+                            charge['error'] = "When inserting charge for {pru}, {records} were updated.".format(pru=charge['pru'], records=len(rows))
+                        else:
+                            charge['record_no'] = rows[0].record_no
+                    except pyodbc.Error:
+                        # Error message if theres an error inserting charge
+                        charge['error'] = "Encountered error when inserting charge for {pru}.".format(pru=charge['pru'])
+                try:
+                    cnxn.commit()
+                except pyodbc.Error:
+                    for charge in batch:
+                        if not charge['error']:
+                            charge['record_no'] = None
+                            charge['error'] = "Encountered error when committing charge for {pru}. Please check Geneworks and add manually if required.".format(pru=charge['pru'])
 
-        else:
-            print "ERROR\tUnable to insert charge for {pru}. Test ID or Specimen ID not determined. Please add manually.".format(pru=self.pru)        
+    def print_report(self):
+        """
+        Prints the outcome of every charge, in the order the charges were added
+        """
+        for charge in self.charges:
+            if charge['error']:
+                print "ERROR\t{error} (NGSTestID {ngs_test_id})".format(**charge)
+            else:
+                print "SUCCESS\tCharge entered into Geneworks for {pru} (NGSTestID {ngs_test_id}). Record number: {record_no}".format(**charge)
+
+    def run(self):
+        """
+        Retrieves Geneworks details, inserts all charges and prints the outcome of every charge
+        """
+        if self.charges:
+            with timing.span('geneworks_charge', charges=len(self.charges)):
+                self.get_test_details()
+                self.insert_charges()
+            self.print_report()
+
+def trust_id_key(pru):
+    """
+    Returns the key used to match a PatientTrustID (PRU) between Moka and Geneworks.
+    SQL Server compares strings ignoring case and trailing spaces, so keys are normalised the same way to match the
+    same records that the linked view joins did.
+    """
+    return pru.rstrip().upper() if pru is not None else None
+
+class GeneworksQueryExecuter(object):
+    """
+    Read-only queries run directly against Geneworks, rather than through the linked gwv-*linked views in Moka.
+    A connection is checked out of the GENEWORKS pool for each call. Results are returned as dictionaries keyed by
+    trust_id_key(PatientTrustID), so they can be joined to Moka records in Python.
+    The queries use the GENEWORKS login from config.ini, which needs SELECT permission on the views named in the
+    GENEWORKS section. check_access() checks this before any tests are processed.
+    """
+    def check_access(self):
+        """
+        Runs each Geneworks query for a PRU that can't match any patient, so that a missing view name, a view without
+        the expected columns or a login without read access is reported before any test is processed.
+        Raises ValueError if a view name isn't set, or RemoteCallError if the views can't be read.
+        """
+        import pyodbc
+        with get_pool("GENEWORKS").connection() as cnxn:
+            cursor = cnxn.cursor()
+            for statement in ('geneworks_patients', 'geneworks_gel_tests'):
+                try:
+                    cursor.execute(*sql_statements.in_list(statement, [''])).fetchall()
+                except pyodbc.Error as e:
+                    raise RemoteCallError("Unable to read the Geneworks views with the GENEWORKS login in config.ini. "
+                                          "The login needs SELECT permission on the views named in the GENEWORKS section: {error}".format(error=e))
+
+    def _fetch_by_pru(self, statement, prus, chunk_size, span):
+        """
+        Executes the named statement for each chunk of chunk_size PRUs.
+        Returns a dictionary of the list of rows for each PatientTrustID key.
+        """
+        # Remove duplicate and missing PRUs
+        prus = sorted(set(pru for pru in prus if pru))
+        rows_by_pru = {}
+        with get_pool("GENEWORKS").connection() as cnxn:
+            cursor = cnxn.cursor()
+            for i in range(0, len(prus), chunk_size):
+                with timing.span(span, prus=len(prus[i:i + chunk_size])):
+                    rows = cursor.execute(*sql_statements.in_list(statement, prus[i:i + chunk_size])).fetchall()
+                for row in rows:
+                    rows_by_pru.setdefault(trust_id_key(row.PatientTrustID), []).append(row)
+        return rows_by_pru
+
+    def get_patients(self, prus, chunk_size=500):
+        """
+        Returns a dictionary of the Geneworks patient demographics rows for each PatientTrustID key, for the supplied PRUs
+        """
+        return self._fetch_by_pru('geneworks_patients', prus, chunk_size, 'geneworks_patients')
+
+    def get_gel_tests(self, prus, chunk_size=500):
+        """
+        Returns a dictionary of the Geneworks GeL test rows (PatientTrustID, TestID and SpecimenTrustID) for each PatientTrustID key, for the supplied PRUs.
+        The test ID and specimen number are required for the stored procedure that adds the charge.
+        """
+        # All of the views joined are in Geneworks, so the join is run by Geneworks rather than across the linked server
+        return self._fetch_by_pru('geneworks_gel_tests', prus, chunk_size, 'geneworks_gel_tests')
 
 class MokaQueryExecuter(object):
     def __init__(self):
-        # establish pyodbc connection to Moka
-        cnxn = pyodbc.connect('DRIVER={{SQL Server}}; SERVER={server}; DATABASE={database};'.format(
-            server=config.get("MOKA", "SERVER"),
-            database=config.get("MOKA", "DATABASE")
-            ), 
-            autocommit=True
-        )
+        # check out a pyodbc connection to Moka from the pool
+        self.cnxn = get_pool("MOKA").checkout()
         # return cursor to execute query
-        self.cursor = cnxn.cursor()
+        self.cursor = self.cnxn.cursor()
+
+    def close(self):
+        """
+        Returns the connection to the pool
+        """
+        get_pool("MOKA").checkin(self.cnxn)
 
     def execute_query(self, sql):
         """
@@ -202,108 +509,401 @@ class MokaQueryExecuter(object):
         """
         self.cursor.execute(sql)
 
+    def execute_transaction(self, statements):
+        """
+        Takes a list of (sql, list of parameter tuples) and executes each statement with executemany in a single transaction.
+        If any statement fails, all changes are rolled back and the exception is raised.
+        """
+        self.cnxn.autocommit = False
+        # Send all the parameter sets for each statement to SQL Server together, rather than one round trip per row
+        self.cursor.fast_executemany = True
+        try:
+            for sql, params in statements:
+                if params:
+                    self.cursor.executemany(sql, params)
+            self.cnxn.commit()
+        except Exception:
+            self.cnxn.rollback()
+            raise
+        finally:
+            self.cnxn.autocommit = True
+
+    def get_ready_tests(self):
+        """
+        Returns list of (NGSTestID, IRID) tuples for tests that are ready to report:
+        negneg tests with an interpretation request ID that aren't blocked from automated reporting, aren't complete and have no 100k results file.
+        """
+        with timing.span('moka_get_ready_tests'):
+            rows = self.cursor.execute(sql_statements.get('moka_ready_tests')).fetchall()
+        return [(row.NGSTestID, row.IRID) for row in rows]
+
     def get_data(self, ngs_test_id):
         """
         Takes a Moka NSGTestID as input.
         Pulls out details from Moka needed to populate the cover page. 
         """
-        data_sql = (
-            'SELECT NGSTest.NGSTestID, NGSTest.BlockAutomatedReporting, NGSTest.InternalPatientID, NGSTest.ResultCode, Checker.Name AS clinician_name, Checker.ReportEmail, Item_Address.Item AS clinician_address, '
-            '"gwv-patientlinked".FirstName, "gwv-patientlinked".LastName, "gwv-patientlinked".DoB, "gwv-patientlinked".Gender, "gwv-patientlinked".NHSNo, '
-            '"gwv-patientlinked".PatientTrustID, NGSTest.GELProbandID, NGSTest.IRID, Patients.s_StatusOverall '
-            'FROM (((NGSTest INNER JOIN Patients ON NGSTest.InternalPatientID = Patients.InternalPatientID) '
-            'INNER JOIN "gwv-patientlinked" ON "gwv-patientlinked".PatientTrustID = Patients.PatientID) INNER JOIN Checker ON NGSTest.BookBy = Checker.Check1ID) '
-            'INNER JOIN Item AS Item_Address ON Checker.Address = Item_Address.ItemID '
-            'WHERE NGSTestID = {ngs_test_id};'
-            ).format(ngs_test_id=ngs_test_id)
-        # Execute the query to get patient data
-        row = self.cursor.execute(data_sql).fetchone()
-        # If results have been returned from the query...
-        if row:
-            # Populate data dictionaries with values returned by query
-            data = {
-                'block_auto_report': row.BlockAutomatedReporting,
-                'clinician': row.clinician_name,
-                'clinician_report_email': row.ReportEmail,
-                'clinician_address': row.clinician_address,
-                'internal_patient_id': row.InternalPatientID,
-                'patient_name': '{first_name} {last_name}'.format(first_name=row.FirstName, last_name=row.LastName),
-                'sex': row.Gender,
-                'DOB': row.DoB,
-                'NHSNumber': row.NHSNo,
-                'PRU': row.PatientTrustID,
-                'GELID': row.GELProbandID,
-                'IRID': row.IRID,
-                'date_reported': datetime.datetime.now().strftime(r'%d/%m/%Y'), # Current date in format dd/mm/yyyy
-                'result_code': row.ResultCode,
-                'patient_status_id': row.s_StatusOverall
-            }
-            # If None has been returned for gender (because there isn't one in geneworks) change value to 'Unknown'
-            if not data['sex']: 
-                data['sex'] = 'Unknown'
-            return data
+        return self.get_data_many([ngs_test_id]).get(ngs_test_id)
+
+    def get_data_many(self, ngs_test_ids, chunk_size=500, geneworks=None):
+        """
+        Takes a list of Moka NGSTestIDs as input.
+        Pulls out details needed to populate the cover page for all tests, returning a dictionary keyed by NGSTestID
+        containing the same data dictionaries returned by get_data().
+        Test, patient and clinician details are read from Moka's own tables and patient demographics directly from
+        Geneworks, with one query to each per chunk of chunk_size IDs. The two are joined in Python on PatientTrustID,
+        which gives the same records as joining to the linked "gwv-patientlinked" view in Moka without a query across
+        the linked server.
+        NGSTestIDs that return no results from Moka, or whose patient isn't found in Geneworks, are not included in the dictionary.
+        If a test's PRU matches more than one Geneworks patient, the number matched is returned as geneworks_patient_count
+        so that the test can be rejected by the pre-flight checks.
+        """
+        geneworks = geneworks or GeneworksQueryExecuter()
+        all_data = {}
+        # Remove duplicate IDs and ensure they're integers
+        ngs_test_ids = sorted(set(int(ngs_test_id) for ngs_test_id in ngs_test_ids))
+        for i in range(0, len(ngs_test_ids), chunk_size):
+            # Execute the query to get test data for this chunk of tests
+            with timing.span('moka_get_data', tests=len(ngs_test_ids[i:i + chunk_size])):
+                rows = self.cursor.execute(*sql_statements.in_list('moka_test_data', ngs_test_ids[i:i + chunk_size])).fetchall()
+            # Look up the Geneworks demographics for all patients in the chunk, indexed by PatientTrustID
+            patients = geneworks.get_patients([row.PatientID for row in rows], chunk_size=chunk_size)
+            for row in rows:
+                # Tests for patients that aren't in Geneworks are excluded, as they were by the inner join to the view
+                patient_rows = patients.get(trust_id_key(row.PatientID))
+                # Only use the first row returned for each test. The number of Geneworks patients matched is included so
+                # that tests matching more than one aren't reported with the wrong patient's demographics.
+                if patient_rows and row.NGSTestID not in all_data:
+                    all_data[row.NGSTestID] = self._row_to_data(row, patient_rows[0], len(patient_rows))
+        return all_data
+
+    def _row_to_data(self, row, patient, patient_count=1):
+        """
+        Converts a row returned by the get_data_many() Moka query and the patient's Geneworks row into a data dictionary used to populate the cover page.
+        patient_count is the number of Geneworks patients matching the PRU.
+        """
+        # Populate data dictionaries with values returned by query
+        data = {
+            'block_auto_report': row.BlockAutomatedReporting,
+            'clinician': row.clinician_name,
+            'clinician_report_email': row.ReportEmail,
+            'clinician_address': row.clinician_address,
+            'internal_patient_id': row.InternalPatientID,
+            'patient_name': '{first_name} {last_name}'.format(first_name=patient.FirstName, last_name=patient.LastName),
+            'sex': patient.Gender,
+            'DOB': patient.DoB,
+            'NHSNumber': patient.NHSNo,
+            'PRU': patient.PatientTrustID,
+            'geneworks_patient_count': patient_count,
+            'GELID': row.GELProbandID,
+            'IRID': row.IRID,
+            'date_reported': datetime.datetime.now().strftime(r'%d/%m/%Y'), # Current date in format dd/mm/yyyy
+            'result_code': row.ResultCode,
+            'patient_status_id': row.s_StatusOverall
+        }
+        # If None has been returned for gender (because there isn't one in geneworks) change value to 'Unknown'
+        if not data['sex']: 
+            data['sex'] = 'Unknown'
+        return data
+
+class MokaWriteBack(object):
+    """
+    Collects the Moka updates made for each reported test and applies them in explicit transactions.
+    Updates are applied every batch_size tests, with each statement executed once for the batch using executemany.
+    All updates for a test succeed or fail together. If a batch fails, each test in it is retried in its own transaction.
+    Updates are applied by whichever thread fills the batch, so each test supplies callbacks for the outcome of its
+    own updates rather than the outcome being printed in another test's output.
+    """
+    # Names of the statements in sql_statements used for updates, in the order they're applied
+    statements = ['ngstestfile_insert', 'ngstest_update', 'patients_update', 'patientlog_insert']
+
+    def __init__(self, batch_size=1):
+        # Number of tests to apply updates for in each transaction
+        self.batch_size = batch_size
+        # List of (NGSTestID, list of (statement name, parameters), on_commit, on_error) tuples waiting to be applied
+        self.pending = []
+        # Updates are added from worker threads
+        self._lock = threading.Lock()
+
+    def add(self, ngs_test_id, writes, moka, on_commit=None, on_error=None):
+        """
+        Queues the updates for a test, applying all queued updates using the supplied MokaQueryExecuter once batch_size tests are queued.
+        on_commit is called once the test's updates have been committed. If they fail, on_error is called with the error
+        message (which is printed if on_error is None).
+        Returns False if the test's updates were applied and failed, otherwise True.
+        """
+        with self._lock:
+            self.pending.append((ngs_test_id, writes, on_commit, on_error))
+            if len(self.pending) < self.batch_size:
+                return True
+            batch, self.pending = self.pending, []
+        return ngs_test_id not in self.apply(batch, moka)
+
+    def flush(self, moka):
+        """
+        Applies all queued updates using the supplied MokaQueryExecuter
+        """
+        with self._lock:
+            batch, self.pending = self.pending, []
+        self.apply(batch, moka)
+
+    def apply(self, batch, moka):
+        """
+        Applies the updates for a batch of tests in a single transaction. If this fails, each test is retried in its own transaction.
+        Returns list of NGSTestIDs for which the updates failed.
+        """
+        if not batch:
+            return []
+        try:
+            with timing.span('moka_write_back', tests=len(batch)):
+                moka.execute_transaction(self._group_statements(batch))
+        except Exception as e:
+            if len(batch) == 1:
+                ngs_test_id, writes, on_commit, on_error = batch[0]
+                message = "ERROR\tMoka updates for NGSTestID {ngs_test_id} failed and have been rolled back: {error}".format(ngs_test_id=ngs_test_id, error=e)
+                if on_error:
+                    on_error(message)
+                else:
+                    print message
+                return [ngs_test_id]
+            # Retry each test on its own so that one failed test doesn't prevent the others from being updated
+            failed = []
+            for test in batch:
+                failed.extend(self.apply([test], moka))
+            return failed
+        for ngs_test_id, writes, on_commit, on_error in batch:
+            if on_commit:
+                on_commit()
+        return []
+
+    def _group_statements(self, batch):
+        """
+        Returns list of (sql, list of parameter tuples) containing the parameters for every test in the batch, for use with MokaQueryExecuter.execute_transaction()
+        """
+        params = dict((name, []) for name in self.statements)
+        for ngs_test_id, writes, on_commit, on_error in batch:
+            for name, write_params in writes:
+                params[name].append(write_params)
+        return [(sql_statements.get(name), params[name]) for name in self.statements]
 
 class GelReportGenerator(object):
-    def __init__(self, path_to_wkhtmltopdf):
+    def __init__(self, path_to_wkhtmltopdf, scratch_dir=None):
         # path to wkhtmltopdf executable used by pdfkit
         self.path_to_wkhtmltopdf = path_to_wkhtmltopdf
+        # Local folder where merged reports are written before being published. Defaults to the system temp folder.
+        self.scratch_dir = scratch_dir
         # Attribute to hold the in-memory cover file
         self.cover_pdf = None
+        # Compiled html templates, keyed by template filepath
+        self.templates = {}
+        # pdfkit configuration, created when the first cover is converted to pdf
+        self._pdfkit_config = None
+        # Specify options. 'quiet' turns off verbose stdout when writing to pdf.
+        self.pdfkit_options = {'quiet':''}
+
+    @property
+    def pdfkit_config(self):
+        """
+        pdfkit configuration specifying the path to the wkhtmltopdf executable
+        """
+        import pdfkit
+        if self._pdfkit_config is None:
+            self._pdfkit_config = pdfkit.configuration(wkhtmltopdf=self.path_to_wkhtmltopdf)
+        return self._pdfkit_config
+
+    def get_template(self, template):
+        """
+        Returns the compiled html template, loading and compiling it the first time it's requested
+        """
+        from jinja2 import Environment, FileSystemLoader
+        if template not in self.templates:
+            # specify the folder containing the html template for cover report 
+            html_template_dir = Environment(loader=FileSystemLoader(os.path.dirname(template)))
+            # specify which html template to use
+            self.templates[template] = html_template_dir.get_template(os.path.basename(template))
+        return self.templates[template]
 
     def create_cover_pdf(self, data, template):
         """
         Populate html template with data and store as pdf
+        Returns the in-memory cover pdf (also stored in the cover_pdf attribute)
         """
-        # specify the folder containing the html template for cover report 
-        html_template_dir = Environment(loader=FileSystemLoader(os.path.dirname(template)))
-        # specify which html template to use
-        html_template = html_template_dir.get_template(os.path.basename(template))
+        import pdfkit
         # populate the template with values from data dictionary
-        cover_html = html_template.render(data)
-        # Specify path to wkhtmltopdf executable (used by pdfkit)
-        pdfkit_config = pdfkit.configuration(wkhtmltopdf=self.path_to_wkhtmltopdf)
-        # Specify options. 'quiet' turns off verbose stdout when writing to pdf.
-        pdfkit_options = {'quiet':''}
+        with timing.span('template_render', covers=1):
+            cover_html = self.get_template(template).render(data)
         # Convert html to PDF. Set output_path to False so that it returns a byte string rather than writing out to file.
-        cover_pdf = pdfkit.from_string(cover_html, output_path=False, configuration=pdfkit_config, options=pdfkit_options)
+        with timing.span('wkhtmltopdf', covers=1):
+            cover_pdf = pdfkit.from_string(cover_html, output_path=False, configuration=self.pdfkit_config, options=self.pdfkit_options)
         # Read the byte string into an in memory file-like object
         self.cover_pdf = io.BytesIO(cover_pdf)
+        return self.cover_pdf
+
+    def create_cover_pdfs(self, data_list, template, batch_size=50):
+        """
+        Populate html template with each data dictionary in data_list and convert to pdf, using one wkhtmltopdf invocation per batch_size covers.
+        The template is expected to produce a single page cover. If a batch doesn't produce one page per cover, the covers in that batch are created individually.
+        Returns a list of in-memory cover pdfs in the same order as data_list
+        """
+        import pdfkit
+        from PyPDF2 import PdfFileReader, PdfFileWriter
+        cover_pdfs = []
+        for i in range(0, len(data_list), batch_size):
+            batch = data_list[i:i + batch_size]
+            # Write the populated html for each cover to a temporary folder, so that all covers can be passed to wkhtmltopdf at once
+            html_dir = tempfile.mkdtemp()
+            try:
+                html_files = []
+                with timing.span('template_render', covers=len(batch)):
+                    for j, data in enumerate(batch):
+                        html_file = os.path.join(html_dir, 'cover_{j}.html'.format(j=j))
+                        with open(html_file, 'wb') as html:
+                            html.write(self.get_template(template).render(data).encode('utf-8'))
+                        html_files.append(html_file)
+                # Convert all html files to a single PDF. Each input file starts on a new page.
+                with timing.span('wkhtmltopdf', covers=len(batch)):
+                    batch_pdf = PdfFileReader(io.BytesIO(pdfkit.from_file(html_files, output_path=False, configuration=self.pdfkit_config, options=self.pdfkit_options)))
+            finally:
+                shutil.rmtree(html_dir, ignore_errors=True)
+            if batch_pdf.getNumPages() == len(batch):
+                # Split the combined PDF back into one in-memory PDF per cover
+                for page_number in range(batch_pdf.getNumPages()):
+                    writer = PdfFileWriter()
+                    writer.addPage(batch_pdf.getPage(page_number))
+                    cover_pdf = io.BytesIO()
+                    writer.write(cover_pdf)
+                    cover_pdf.seek(0)
+                    cover_pdfs.append(cover_pdf)
+            else:
+                # Covers can't be separated if any is more than one page, so create each one individually
+                cover_pdfs.extend(self.create_cover_pdf(data, template) for data in batch)
+        return cover_pdfs
 
     def pdf_merge(self, output_file, *pdfs):
         """
-        Takes multiple PDF filepaths and merges into one document.
-        Outputs to filepath specified in merged_report 
+        Takes multiple PDF filepaths (or in-memory PDFs) and merges into one document.
+        The merged report is written to local scratch space and then published to output_file, so that a partial
+        file is never left at output_file if writing to the network share fails.
+        Returns the SHA-256 checksum of the published report.
         """
-        # Create PdfFileMerger object
-        merger = PdfFileMerger()
-        # Concatenate the PDFs together. PDFs output from wkhtmltopdf break it if import_bookmarks is set to True (see https://github.com/mstamy2/PyPDF2/issues/193)
-        [merger.append(pdf, import_bookmarks=False) for pdf in pdfs]
-        # Write out the merged PDF report
-        with open(output_file, 'wb') as merged_report:
-            merger.write(merged_report)
+        from PyPDF2 import PdfFileReader, PdfFileWriter
+        # Create PdfFileWriter object
+        writer = PdfFileWriter()
+        # Open PDF filepaths rather than reading them into memory, so that pages are read from disk as the merged report is written
+        open_files = [open(pdf, 'rb') if isinstance(pdf, basestring) else pdf for pdf in pdfs]
+        local_file = None
+        try:
+            # Concatenate the pages of the PDFs together. Bookmarks aren't imported as PDFs output from wkhtmltopdf break it (see https://github.com/mstamy2/PyPDF2/issues/193)
+            for pdf in open_files:
+                pdf.seek(0)
+                reader = PdfFileReader(pdf, strict=False)
+                for page_number in range(reader.getNumPages()):
+                    writer.addPage(reader.getPage(page_number))
+            # Write out the merged PDF report to local scratch space
+            handle, local_file = tempfile.mkstemp(suffix='.pdf', dir=self.scratch_dir)
+            with os.fdopen(handle, 'wb') as merged_report:
+                writer.write(merged_report)
+            # Publish the merged report to the output location
+            return publish_file(local_file, output_file)
+        finally:
+            [pdf.close() for pdf, original in zip(open_files, pdfs) if pdf is not original]
+            if local_file and os.path.exists(local_file):
+                os.remove(local_file)
 
-def labkey_geneworks_data_match(gel_id, date_of_birth, nhsnumber):
+def labkey_geneworks_data_match(gel_id, date_of_birth, nhsnumber, labkey_batch=None):
     """Check details for GEL participant ID match in LabKey.
 
     Args:
         gel_id (str): A gel participant ID
         date_of_birth (str): A date of birth in the format: "DAY/MONTH/YEAR"
         nhsnumber (str): An NHS number
+        labkey_batch (LabKeyBatch_SSH): Optional LabKey results already retrieved for many participants.
+            If not supplied, LabKey is called for this participant alone.
     Returns:
         Boolean: True if input data matches LabKey.
     """
-    try:
-        labkey_data = LabKey_SSH(gel_id)
-    # Use BaseException so that SystemExit exceptions are caught
-    except BaseException as e:
-        print "ERROR\tFollowing error encountered getting demographics from labkey for participant ID {gel_id}: {e}".format(gel_id=gel_id, e=e)
-        return False
+    if labkey_batch is not None:
+        labkey_data = labkey_batch.records.get(str(gel_id))
+        if labkey_data is None:
+            print "ERROR\tFollowing error encountered getting demographics from labkey for participant ID {gel_id}: {e}".format(gel_id=gel_id, e=labkey_batch.errors.get(str(gel_id)))
+            return False
+    else:
+        try:
+            labkey_data = LabKey_SSH(gel_id)
+        # Errors from GENAPP01 (including timeouts and an open circuit breaker) are raised as RemoteCallError
+        except Exception as e:
+            print "ERROR\tFollowing error encountered getting demographics from labkey for participant ID {gel_id}: {e}".format(gel_id=gel_id, e=e)
+            return False
     if (labkey_data.dob == date_of_birth) and (labkey_data.nhsid.replace(" ", "") == nhsnumber.replace(" ", "")):
         return True
     else:
         return False 
 
 
+def publish_file(local_file, output_file, chunk_size=1024 * 1024):
+    '''
+    Copies a local file to output_file (e.g. on a network share) so that output_file only ever contains the complete file.
+    The file is copied to a temporary file alongside output_file, the size of the copy is verified and then it is renamed to output_file.
+    Args:
+        local_file: Path to the local file
+        output_file: Path to publish the file to
+        chunk_size: Number of bytes copied at a time
+    Returns:
+        SHA-256 checksum of the published file
+    Raises:
+        IOError: If the copied file is not the same size as the local file
+    '''
+    partial_file = output_file + '.partial'
+    sha256 = hashlib.sha256()
+    try:
+        with open(local_file, 'rb') as source, open(partial_file, 'wb') as destination:
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                sha256.update(chunk)
+                destination.write(chunk)
+            destination.flush()
+            os.fsync(destination.fileno())
+        # Check that the whole file has been written before making it visible at output_file
+        if os.path.getsize(partial_file) != os.path.getsize(local_file):
+            raise IOError("Incomplete copy to {output_file}. {copied} out of {total} bytes".format(
+                output_file=output_file,
+                copied=os.path.getsize(partial_file),
+                total=os.path.getsize(local_file)
+                )
+            )
+        # os.rename can't overwrite an existing file on Windows, so remove any previous version first
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        os.rename(partial_file, output_file)
+    finally:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+    return sha256.hexdigest()
+
+
+def summary_of_findings_text(result_code):
+    '''
+    Args:
+        Moka result code
+    Returns:
+        Summary of findings text for the cover page, or None if the result code is not known
+    '''
+    # Set summary of findings text based on result code If result code is Negative (1) or Negative Negative (1189679668)
+    if result_code in [1, 1189679668]:
+        # 1 = Negative, 1189679668 = NegNeg
+        return (
+            'Whole genome sequencing has been completed by Genomics England and the primary analysis has not identified any underlying genetic cause of the clinical presentation.'
+        )
+    elif result_code in [1189679670]:
+        # 1189679670 = Previously reported variant i.e. No new findings from WGS
+        return (
+            'Whole genome sequencing has been completed by Genomics England; please see the genome interpretation section for details of previously reported variant(s).'
+        )
+    elif result_code in [1189679598]:
+        #1189679598 = Other i.e complicated cases
+        return (
+            'Whole genome sequencing has been completed by Genomics England; please see the genome interpretation section for details.'
+        )
+
+
 def null_fields(data_dict):
     '''
     Args:
@@ -332,39 +932,495 @@ def remove_values(data_list, *args):
     return data_list
 
 
-def main():
-    # Output folder for combined reports
-    gel_report_output_folder = r'\\gstt.local\apps\Moka\Files\ngs\{year}\{month}'.format(
+def process_test(ngs_test_id, data, moka, report_run, cover_pdf=None):
+    """
+    Runs the reporting pipeline for a single NGSTestID that has passed validation:
+    optionally submits the exit questionnaire and downloads the summary of findings, creates the cover page
+    (unless a cover_pdf already rendered for the whole batch is supplied), attaches it to the summary of findings,
+    updates Moka and queues the Geneworks charge and the email to the clinician. Resources shared by all tests in the
+    run are held by report_run. The charge and email are only queued once the test's Moka updates have been committed.
+    """
+    email = None
+    # If submit_exit_q flag is used, call script to submit a negneg clinical report and exit questionnaire to the CIP-API
+    # This shouldn't be used if either a summary of findings or exit questionnaire has already be created for this case (will fail if so)
+    # If resuming, skip this if it was submitted by a previous run.
+    if report_run.args.submit_exit_q and report_run.completed(ngs_test_id, data, 'exit_q_submitted'):
+        print "INFO\tClinical report and exit questionnaire already submitted for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+    elif report_run.args.submit_exit_q:
+        ir_id = data['IRID']
+        try:
+            ExitQuestionnaire_SSH(
+                ir_id=ir_id,
+                user='jahn'
+                )
+        # Errors from GENAPP01 (including timeouts and an open circuit breaker) are raised as RemoteCallError
+        except Exception as e:
+            print "ERROR\tEncountered following error when submitting clinical report and exit questionnaire for NGSTestID {ngs_test_id}: {error}".format(ngs_test_id=ngs_test_id, error=e)
+            return
+        report_run.record(ngs_test_id, data, 'exit_q_submitted')
+    # If download_summary flag is used, call script to download the summary of findings report from CIP-API
+    # This will only work if there is only one version of the summary of findings report, as is expected for negneg cases where summary of findings was genereted programmatically
+    # Therefore put -1 at end of summary of findings filename to indicate it is version 1 (as happens when downloading manually from interpretation portal)
+    # If resuming, skip this if it was downloaded by a previous run and is still present.
+    if report_run.args.download_summary:
+        ir_id = data['IRID'].split("-")[0]
+        ir_version = data['IRID'].split("-")[1]
+        summary_findings_path = os.path.join(report_run.report_index.folder, "Summary_of_Findings_{ir_id}-{ir_version}-1.pdf".format(ir_id=ir_id, ir_version=ir_version))
+    if report_run.args.download_summary and report_run.completed(ngs_test_id, data, 'summary_downloaded') and os.path.exists(summary_findings_path):
+        print "INFO\tSummary of findings already downloaded for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+    elif report_run.args.download_summary:
+        try:
+            summary = SummaryFindings_SSH(
+                ir_id=ir_id,
+                ir_version=ir_version,
+                output_path=summary_findings_path,
+                header="{patient_name}    DoB {DOB}    PRU {PRU}    NHS Number {NHSNumber}".format(**data),
+                stream=report_run.args.stream_summary,
+                cache=report_run.summary_cache
+                )
+        # Errors from GENAPP01 (including timeouts and an open circuit breaker) are raised as RemoteCallError
+        except Exception as e:
+            print "ERROR\tEncountered following error when downloading summary of findings for NGSTestID {ngs_test_id}: {error}".format(ngs_test_id=ngs_test_id, error=e)
+            return
+        # Report the throughput of the SFTP copy
+        if summary.transfer:
+            print "INFO\t{transfer}".format(transfer=summary.transfer)
+        # Add the downloaded summary of findings to the index of technical reports
+        report_run.report_index.add(summary_findings_path)
+        report_run.record(ngs_test_id, data, 'summary_downloaded', summary_findings_path)
+    # Specify the path to the folder containing the technical reports downloaded from the interpretation portal
+    gel_original_report_folder = report_run.report_index.folder
+    # create a search pattern to identify the correct HTML report. Use single character wildcard as the verison of the report is not known
+    gel_original_report_search_name = "Summary_of_Findings_{ir_id}-?.pdf".format(ir_id=data['IRID'])
+    # Specify the output path for the combined report, based on the GeL participant ID and the interpretation request ID retrieved from Moka
+    # If resuming, use the combined report created by a previous run if it is still present
+    gel_combined_report = report_run.completed(ngs_test_id, data, 'merged') and report_run.journal.get_detail(ngs_test_id, data['IRID'], 'merged')
+    if gel_combined_report and os.path.exists(gel_combined_report):
+        print "INFO\tCombined report already created for NGSTestID {ngs_test_id}: {gel_combined_report}".format(ngs_test_id=ngs_test_id, gel_combined_report=gel_combined_report)
+    else:
+        gel_combined_report = None
+    new_combined_report = os.path.join(report_run.gel_report_output_folder, r'{pru}_{proband_id}_{ir_id}_{date}.pdf'.format(
+            pru=data['PRU'].replace(':', '_'),
+            date=datetime.datetime.now().strftime(r'%y%m%d'),
+            proband_id=data['GELID'],
+            ir_id=data['IRID']
+            ))
+    # Get the list of reports which match the search pattern (created above) from the index of the technical reports folder
+    list_of_html_reports = report_run.report_index.find(data['IRID'])
+    # if the combined report was created by a previous run, the original report isn't needed
+    if gel_combined_report:
+        pass
+    # if there is more than one report for this case
+    elif len(list_of_html_reports) > 1:
+        # print error message
+        print 'ERROR\tMultiple ({file_count}) versions of the HTML report exist for IR-ID {ir_id}. Ensure only the correct version exists in {gel_original_report_folder}.'.format(file_count=len(list_of_html_reports), ir_id=data['IRID'], gel_original_report_folder=gel_original_report_folder)
+    # if the original GeL report is not found, 
+    elif len(list_of_html_reports) < 1:
+        # print an error message
+        print 'ERROR\tOriginal GeL report not found for IR-ID {ir_id}. Please ensure it has been saved as PDF with the following filepath: {gel_original_report}'.format(gel_original_report=os.path.join(gel_original_report_folder, gel_original_report_search_name), ir_id=data['IRID'])
+    else:
+        # If only one report found create the name of the report using the file identified using the wildcard
+        gel_original_report = os.path.join(gel_original_report_folder, list_of_html_reports[0])
+        # Use the cover pdf rendered for the whole batch if there is one, otherwise create it now
+        if cover_pdf is None:
+            cover_pdf = report_run.generator.create_cover_pdf(data, COVER_TEMPLATE)
+        # Attach the GeL report to the cover page and output to the output path specified above.
+        # Moka is only updated once the complete report has been published to the output path.
+        gel_combined_report = new_combined_report
+        try:
+            with timing.span('pdf_merge'):
+                report_run.generator.pdf_merge(gel_combined_report, cover_pdf, gel_original_report)
+        except Exception as e:
+            print "ERROR\tEncountered following error when creating combined report {gel_combined_report} for NGSTestID {ngs_test_id}: {error}".format(gel_combined_report=gel_combined_report, ngs_test_id=ngs_test_id, error=e)
+            return
+        report_run.record(ngs_test_id, data, 'merged', gel_combined_report)
+    if gel_combined_report:
+        # Moka updates for this test, applied together in a single transaction
+        today_date = datetime.datetime.now().replace(microsecond=0)
+        username = os.getenv('username')
+        computer = os.getenv('computername')
+        moka_writes = []
+        # Store report filepath as an NGSTestFile in Moka
+        moka_writes.append(('ngstestfile_insert', (ngs_test_id, gel_combined_report, today_date)))
+        # If it's a negneg, update the check2, reporter (check3) and authoriser (check4) to the logged in user, and status to Complete for NGSTest and Patient, and generate email
+        if data['result_code']  == 1189679668:
+            moka_writes.append(('ngstest_update', (today_date, today_date, today_date, username, ngs_test_id)))
+            # Record test status update in patient log
+            moka_writes.append(('patientlog_insert', (
+                data['internal_patient_id'],
+                'NGS: Test status automatically set to complete for 100k interpretation request {IRID}.'.format(IRID=data['IRID']),
+                today_date,
+                username,
+                computer
+                )))
+            # Update the patient status to complete. Only do this if patient status is currently 100K, to prevent interfering with any parallel testing.
+            if data['patient_status_id'] == 1202218839:
+                moka_writes.append(('patients_update', (data['internal_patient_id'],)))
+                # Record status update in patient log
+                moka_writes.append(('patientlog_insert', (
+                    data['internal_patient_id'],
+                    'NGS: Patient status automatically set to complete for 100k interpretation request {IRID}.'.format(IRID=data['IRID']),
+                    today_date,
+                    username,
+                    computer
+                    )))
+            # Create email body
+            email_subject = "100,000 Genomes Project Result"
+            email_body = (
+                '<body style="font-family:Calibri,sans-serif;">'
+                '<b>100,000 Genomes Project result from the Genetics Laboratory at Viapath - Guy\'s Hospital</b><br><br>'
+                'PLEASE DO NOT REPLY TO THIS EMAIL ADDRESS WITH ENQUIRIES ABOUT REPORTS<br>'
+                'FOR ALL ENQUIRIES PLEASE CONTACT THE LABORATORY USING <a href="mailto:DNADutyScientist@viapath.co.uk">DNADutyScientist@viapath.co.uk</a><br><br>'
+                'Kind regards<br>'
+                'Genetics Laboratory<br>'
+                '5th Floor, Tower Wing<br>'
+                'Guy\'s Hospital<br>'
+                'London, SE1 9RT<br>'
+                'United Kingdom<br><br>'
+                'Tel: + 44 (0) 207 188 1709'
+                '</body>'
+                )
+            # Email addressed to clinican with results attached. This is queued so that emails are populated from the main thread.
+            email = (data['clinician_report_email'], email_subject, email_body, [gel_combined_report])
+            # Don't generate the email again if resuming and it was generated by a previous run
+            if report_run.completed(ngs_test_id, data, 'emailed'):
+                print "INFO\tEmail already generated for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+                email = None
+        # Record result letter generation in patient log
+        moka_writes.append(('patientlog_insert', (
+            data['internal_patient_id'],
+            'NGS: 100k results letter automatically generated for 100k interpretation request {IRID}.'.format(IRID=data['IRID']),
+            today_date,
+            username,
+            computer
+            )))
+        # Queue charge to Geneworks once the Moka updates have been committed. Charges for all tests are entered together at the end of the run.
+        # If it's a negneg, submit negneg cost code (unless resuming and it was charged by a previous run)
+        charge = None
+        if data['result_code'] in [1189679668] and report_run.completed(ngs_test_id, data, 'charged'):
+            print "INFO\tCharge already entered into Geneworks for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+        elif data['result_code'] in [1189679668]:
+            charge = partial(report_run.charges.add, data['PRU'], 'WGS No Variants', 71, ngs_test_id=ngs_test_id, irid=data['IRID'])
+        # If it's a different result code, warn user that charge couldn't be entered to geneworks
+        else:
+            print 'ERROR\tUnable to enter charge to geneworks for IRID {ir_id} NGSTestID {ngs_test_id}. No charge associated with result code {result_code}'.format(
+                ngs_test_id=ngs_test_id,
+                ir_id=data['IRID'],
+                result_code=data['result_code']
+                )
+        # Apply the Moka updates (or queue them if updates are being applied in batches). The charge and email are queued
+        # once the updates have been committed, so they're skipped if the updates fail.
+        # If resuming and Moka was updated by a previous run, just queue the charge and email.
+        if report_run.completed(ngs_test_id, data, 'moka_updated'):
+            print "INFO\tMoka already updated for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+            if charge:
+                charge()
+            if email:
+                report_run.queue_email(ngs_test_id, data, email)
+        elif not report_run.moka_writes.add(
+                ngs_test_id,
+                moka_writes,
+                moka,
+                on_commit=partial(report_run.moka_updated, ngs_test_id, data, charge, email),
+                on_error=report_run.queue_message
+                ):
+            return
+        # Print output location of reports
+        print 'SUCCESS\tGenerated report for IRID {ir_id} NGStestID {ngs_test_id} can be found in: {gel_report_output_folder}'.format(
+            ngs_test_id=ngs_test_id, 
+            gel_report_output_folder=report_run.gel_report_output_folder,
+            ir_id=data['IRID']
+            )
+
+
+class ReportRun(object):
+    """
+    Resources shared by all tests processed in a run.
+    If the --preflight flag was used, nothing is written locally: the journal, mailer and summary of findings cache
+    aren't created, and the report index and LabKey caches are only read.
+    """
+    def __init__(self, args, gel_report_output_folder):
+        # Command line arguments
+        self.args = args
+        # Output folder for combined reports
+        self.gel_report_output_folder = gel_report_output_folder
+        # GelReportGenerator object, shared by all tests so that the cover template is only compiled once
+        self.generator = GelReportGenerator(path_to_wkhtmltopdf=WKHTMLTOPDF)
+        # Index the summary of findings reports in the technical reports folder once for the whole run.
+        # The cache file isn't used for a pre-flight run, as it would be rewritten if the folder has changed.
+        self.report_index = ReportIndex(TECHNICAL_REPORTS_FOLDER, cache_file=None if args.preflight else args.report_index_cache)
+        # Geneworks charges for all tests, entered at the end of the run
+        self.charges = GeLGeneworksChargeBatch()
+        # Moka updates for all tests, applied in transactions of moka_batch_size tests
+        self.moka_writes = MokaWriteBack(batch_size=args.moka_batch_size)
+        # Mailer used for all emails to clinicians, so that a single Outlook session is used for the run
+        self.mailer = None if args.preflight else get_mailer(args.email_backend, args.email_outbox)
+        # List of (NGSTestID, data, email tuple) for tests whose Moka updates have been committed, waiting to be
+        # generated by the main thread
+        self.emails = []
+        # Messages about the outcome of tests' Moka updates, waiting to be printed by the main thread. A batch of updates
+        # is applied by whichever worker fills it, so these aren't printed in that worker's captured output.
+        self.messages = []
+        # Emails and messages are queued from worker threads
+        self._emails_lock = threading.Lock()
+        # Journal of the stages completed for each test, used to skip completed stages when resuming.
+        # A pre-flight run doesn't create or open the journal, so every test is checked as if it was new.
+        self.journal = None if args.preflight else RunJournal(args.journal)
+        # Pool of worker threads shared by every chunk and poll of the run, created when first needed.
+        # Each worker thread keeps its own GENAPP01 session, so reusing the threads reuses their connections.
+        self.worker_pool = None
+        # Each worker thread holds a Moka connection while it processes tests, and the main thread holds one more
+        set_pool_size(args.workers + 1)
+        # Cache of LabKey demographics, so that participants checked recently aren't retrieved from LabKey again
+        self.labkey_cache = None
+        # A pre-flight run only reads an existing cache, and doesn't add the demographics it retrieves
+        use_labkey_cache = not (args.skip_labkey or args.no_labkey_cache)
+        if use_labkey_cache and (os.path.exists(args.labkey_cache) or not args.preflight):
+            self.labkey_cache = LabKeyCache(args.labkey_cache, ttl_hours=args.labkey_cache_ttl, include_names=args.labkey_cache_names, read_only=args.preflight)
+        # Cache of downloaded summary of findings, so that reports already downloaded aren't regenerated on GENAPP01.
+        # Nothing is downloaded by a pre-flight run, so the cache isn't opened (or pruned).
+        self.summary_cache = None
+        if args.download_summary and not (args.no_summary_cache or args.preflight):
+            self.summary_cache = SummaryCache(args.summary_cache)
+            if args.prune_summary_cache is not None:
+                entries, files = self.summary_cache.prune(args.prune_summary_cache)
+                print "INFO\tRemoved {entries} entries and {files} files from the summary of findings cache".format(entries=entries, files=files)
+
+    def get_worker_pool(self):
+        """
+        Returns the pool of worker threads used to process tests, creating it on first use
+        """
+        if self.worker_pool is None:
+            self.worker_pool = ThreadPool(self.args.workers)
+        return self.worker_pool
+
+    def stop_workers(self):
+        """
+        Stops the worker threads, discarding any queued tests, and closes the GENAPP01 sessions used by all threads.
+        A new pool is created if tests are processed again.
+        """
+        try:
+            if self.worker_pool is not None:
+                self.worker_pool.terminate()
+                self.worker_pool.join()
+                self.worker_pool = None
+        finally:
+            close_sessions()
+
+    def completed(self, ngs_test_id, data, stage):
+        """
+        Returns True if the --resume flag was used (or running in watch mode) and the stage was completed for the test by a previous run
+        """
+        return bool(self.journal) and (self.args.resume or self.args.watch) and self.journal.is_done(ngs_test_id, data['IRID'], stage)
+
+    def record(self, ngs_test_id, data, stage, detail=None):
+        """
+        Records in the journal that a stage has been completed for the test
+        """
+        self.journal.record(ngs_test_id, data['IRID'], stage, detail)
+
+    def moka_updated(self, ngs_test_id, data, charge=None, email=None):
+        """
+        Called once the Moka updates for a test have been committed. Records this in the journal and queues the Geneworks charge and email, if there are any.
+        """
+        self.record(ngs_test_id, data, 'moka_updated')
+        if charge:
+            charge()
+        if email:
+            self.queue_email(ngs_test_id, data, email)
+
+    def queue_email(self, ngs_test_id, data, email):
+        """
+        Queues a (to_address, subject, body, attachments) email for a test to be generated by send_emails()
+        """
+        with self._emails_lock:
+            self.emails.append((ngs_test_id, data, email))
+
+    def queue_message(self, message):
+        """
+        Queues a message to be printed by print_messages()
+        """
+        with self._emails_lock:
+            self.messages.append(message)
+
+    def print_messages(self):
+        """
+        Prints the queued messages. Called from the main thread, after the output of the test being processed.
+        """
+        with self._emails_lock:
+            messages, self.messages = self.messages, []
+        for message in messages:
+            print message
+
+    def send_emails(self):
+        """
+        Generates the queued emails and records them in the journal. Must be called from the main thread, as the
+        Outlook session can't be shared between threads.
+        """
+        while True:
+            with self._emails_lock:
+                if not self.emails:
+                    return
+                ngs_test_id, data, email = self.emails.pop(0)
+            with timing.span('email', ngs_test_id=ngs_test_id):
+                self.mailer.add(*email)
+            self.record(ngs_test_id, data, 'emailed')
+
+
+class ThreadOutput(object):
+    """
+    File-like object used in place of sys.stdout so that output printed while processing each test can be captured
+    and printed grouped per test when several tests are processed concurrently.
+    Output from threads that aren't capturing is written straight to the original stream.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        """
+        Start capturing output printed by the current thread
+        """
+        self.local.buffer = StringIO()
+
+    def release(self):
+        """
+        Stop capturing output printed by the current thread and return the captured output
+        """
+        captured = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return captured
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.write(text)
+        else:
+            self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+# Each worker thread uses its own Moka connection, as pyodbc connections can't be shared between threads
+_worker = threading.local()
+# All MokaQueryExecuter objects created for worker threads, so that their connections can be returned to the pool
+_worker_mokas = []
+# Incremented each time the worker connections are returned to the pool. Worker threads outlive a call to
+# report_tests(), so a thread whose MokaQueryExecuter was created before the last release creates a new one.
+_worker_generation = [0]
+
+def get_worker_moka():
+    """
+    Returns the MokaQueryExecuter for the current thread, creating it on first use
+    """
+    if getattr(_worker, 'moka', None) is None or _worker.generation != _worker_generation[0]:
+        _worker.moka = MokaQueryExecuter()
+        _worker.generation = _worker_generation[0]
+        _worker_mokas.append(_worker.moka)
+    return _worker.moka
+
+def release_worker_mokas():
+    """
+    Returns the Moka connections used by all worker threads to the pool
+    """
+    _worker_generation[0] += 1
+    try:
+        while _worker_mokas:
+            _worker_mokas.pop().close()
+    finally:
+        _worker.moka = None
+
+
+def run_test(test, report_run, output):
+    """
+    Runs process_test() for a single (NGSTestID, data, cover_pdf) tuple in the current thread, capturing everything it prints.
+    Returns:
+        Tuple of (captured output, sys.exc_info() if an exception was raised or None)
+    """
+    ngs_test_id, data, cover_pdf = test
+    exc_info = None
+    output.capture()
+    try:
+        # Tag the timing spans recorded while processing the test with its NGSTestID
+        with timing.context(ngs_test_id=ngs_test_id):
+            process_test(ngs_test_id, data, get_worker_moka(), report_run, cover_pdf)
+    except Exception:
+        exc_info = sys.exc_info()
+    return output.release(), exc_info
+
+
+def report_output_folder():
+    """
+    Returns the output folder for combined reports created now
+    """
+    return GEL_REPORT_OUTPUT_FOLDER.format(
         year=datetime.datetime.now().year,
         month=datetime.datetime.now().month
         )
-    # Get command line arguments
-    args = process_arguments()
-    # Print list of NGStestIDs for processing:
-    print ("INFO\t{num_tests} NGS test IDs for processing: {testIDs}").format(num_tests=len(args.n), testIDs=args.n)
-    # Create MokaQueryExecuter object
-    moka = MokaQueryExecuter()
+
+def preflight(ngs_test_ids, report_run, moka):
+    """
+    Runs the pre-flight checks for every test in one pass, using the Moka data for all tests, the index of the
+    technical reports folder and a single LabKey invocation. Nothing is submitted, downloaded, rendered or updated.
+    An error is printed for each test that fails a check.
+    Returns:
+        List of (NGSTestID, data, problem) tuples in the order the NGSTestIDs were supplied. problem is None for tests
+        that are ready to report, otherwise a short description of the check that failed. data is None if Moka
+        returned no data for the test.
+    """
+    args = report_run.args
+    # Get data for cover pages from Moka for all NGSTestIDs in bulk
+    moka_data = moka.get_data_many(ngs_test_ids)
+    # List of (NGSTestID, data, problem) tuples
+    checked_tests = []
     # Loop through each Moka NGStestID supplied as an argument
-    for ngs_test_id in args.n:
-        # Get data for cover page from Moka.
-        data = moka.get_data(ngs_test_id)
+    for ngs_test_id in ngs_test_ids:
+        problem = None
+        # Take a copy of the data for this test so that duplicate NGSTestIDs in the arguments are processed from the original values
+        data = dict(moka_data[ngs_test_id]) if ngs_test_id in moka_data else None
         # If no data are returned, print an error message
         if not data:
             print 'ERROR\tNo results returned from Moka data query for NGSTestID {ngs_test_id}. Check there are records in all inner joined tables (eg clinician address in checker table)'.format(ngs_test_id=ngs_test_id)
+            problem = 'No data returned from Moka'
+        # If the PRU matches more than one patient in Geneworks, the demographics may belong to a different patient
+        elif data['geneworks_patient_count'] > 1:
+            print "ERROR\tPRU {pru} for NGSTestID {ngs_test_id} matches {count} patients in Geneworks".format(pru=data['PRU'], ngs_test_id=ngs_test_id, count=data['geneworks_patient_count'])
+            problem = 'PRU matches multiple Geneworks patients'
         # Check for any missing fields (Nulls) in the returned data. Error and skip this sample if required fields are missing.
         # If the skip_labkey flag has been used, we don't need to worry about missing DOB or NHS number (which are sometimes missing for e.g. fetal samples)
         elif null_fields(data) and not args.skip_labkey:
             missing_fields = null_fields(data)
             print "ERROR\tNo {fields} value in Moka for NGSTestID {ngs_test_id}".format(fields=', '.join(missing_fields), ngs_test_id=ngs_test_id)
+            problem = 'No {fields} in Moka'.format(fields=', '.join(missing_fields))
         elif args.skip_labkey and remove_values(null_fields(data), 'DOB', 'NHSNumber'):
             missing_fields = remove_values(null_fields(data), 'DOB', 'NHSNumber')
             print "ERROR\tNo {fields} value in Moka for NGSTestID {ngs_test_id}".format(fields=', '.join(missing_fields), ngs_test_id=ngs_test_id)
+            problem = 'No {fields} in Moka'.format(fields=', '.join(missing_fields))
         # If block_auto_report value is non-zero, skip this sample and issue error message.
         elif data['block_auto_report'] and not args.ignore_block:
             print "ERROR\tAutomated reporting blocked in Moka for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id)
+            problem = 'Automated reporting blocked in Moka'
         # Check that interpretation request ID is in expected format
         elif not re.search("^\d+-\d+$", data['IRID']):
             print "ERROR\tInterpretation request ID {irid} does not match pattern <id>-<version> for NGSTestID {ngs_test_id}".format(ngs_test_id=ngs_test_id, irid=data['IRID'])
+            problem = 'IR ID does not match <id>-<version>'
+        # If result code not known, print error and skip to the next case
+        elif summary_of_findings_text(data['result_code']) is None:
+            print 'ERROR\tUnknown result code for NGSTestID {ngs_test_id}.'.format(ngs_test_id=ngs_test_id)
+            problem = 'Unknown result code'
+        # Unless it will be downloaded (or the combined report was created by a previous run), check there's exactly one summary of findings report for the case
+        elif not args.download_summary and not report_run.completed(ngs_test_id, data, 'merged') and len(report_run.report_index.find(data['IRID'])) != 1:
+            reports = report_run.report_index.find(data['IRID'])
+            if reports:
+                print 'ERROR\tMultiple ({file_count}) versions of the HTML report exist for IR-ID {ir_id}. Ensure only the correct version exists in {gel_original_report_folder}.'.format(file_count=len(reports), ir_id=data['IRID'], gel_original_report_folder=report_run.report_index.folder)
+                problem = 'Multiple summary of findings reports'
+            else:
+                print 'ERROR\tOriginal GeL report not found for IR-ID {ir_id}. Please ensure it has been saved as PDF with the following filepath: {gel_original_report}'.format(
+                    gel_original_report=os.path.join(report_run.report_index.folder, "Summary_of_Findings_{ir_id}-?.pdf".format(ir_id=data['IRID'])),
+                    ir_id=data['IRID']
+                    )
+                problem = 'Summary of findings not found'
         # Otherwise continue...
         else:
             # Convert DoB (if there is one) to string in format dd/mm/yyyy
@@ -375,197 +1431,312 @@ def main():
                 data['DOB'] = 'Not available'
             if not data['NHSNumber']:
                 data['NHSNumber'] = 'Not available'
-            # If skip_labkey flag not used, check DOB and NHSnumber in labkey and Geneworks match. Skip to next case if they don't.
-            if args.skip_labkey:
-                pass
-            elif not labkey_geneworks_data_match(data['GELID'], data['DOB'], data['NHSNumber']):
-                print 'ERROR\tMoka demographics for NGSTestID {ngs_test_id} do not match LabKey data.'.format(ngs_test_id=ngs_test_id)
+            # Set summary of findings text based on result code
+            data['summary_of_findings'] = summary_of_findings_text(data['result_code'])
+        checked_tests.append((ngs_test_id, data, problem))
+    # If skip_labkey flag not used, get LabKey demographics for all remaining tests in a single remote invocation.
+    # If resuming, tests validated by a previous run don't need to be checked again.
+    valid_tests = [(ngs_test_id, data) for ngs_test_id, data, problem in checked_tests if not problem]
+    labkey_tests = [(ngs_test_id, data) for ngs_test_id, data in valid_tests if not report_run.completed(ngs_test_id, data, 'validated')]
+    # If requested, remove the participants in this run from the LabKey cache so they are retrieved from LabKey.
+    # The cache isn't changed by a pre-flight run.
+    if report_run.labkey_cache and args.invalidate_labkey_cache and not args.preflight:
+        report_run.labkey_cache.invalidate([data['GELID'] for ngs_test_id, data in valid_tests])
+    labkey_batch = None
+    if not args.skip_labkey and labkey_tests:
+        labkey_batch = LabKeyBatch_SSH([data['GELID'] for ngs_test_id, data in labkey_tests], cache=report_run.labkey_cache)
+    for i, (ngs_test_id, data, problem) in enumerate(checked_tests):
+        # If skip_labkey flag not used, check DOB and NHSnumber in labkey and Geneworks match.
+        if problem or args.skip_labkey or report_run.completed(ngs_test_id, data, 'validated'):
+            pass
+        elif not labkey_geneworks_data_match(data['GELID'], data['DOB'], data['NHSNumber'], labkey_batch):
+            print 'ERROR\tMoka demographics for NGSTestID {ngs_test_id} do not match LabKey data.'.format(ngs_test_id=ngs_test_id)
+            checked_tests[i] = (ngs_test_id, data, 'Demographics do not match LabKey')
+    return checked_tests
+
+def preflight_table(checked_tests):
+    """
+    Returns a table of the NGSTestID, IR ID, status (ready or skip) and reason for each test checked by preflight()
+    """
+    rows = [('NGSTestID', 'IRID', 'status', 'reason')]
+    for ngs_test_id, data, problem in checked_tests:
+        rows.append((str(ngs_test_id), (data and data['IRID']) or '', 'skip' if problem else 'ready', problem or ''))
+    widths = [max(len(row[column]) for row in rows) for column in range(3)]
+    return '\n'.join('{0:<{w0}} {1:<{w1}} {2:<{w2}} {3}'.format(*row, w0=widths[0], w1=widths[1], w2=widths[2]).rstrip() for row in rows)
+
+def finish_tests(report_run, moka):
+    """
+    Applies any queued Moka updates, generates the emails for the tests they were committed for, enters the Geneworks
+    charges for the tests reported and records them in the journal, then returns the Moka connections used by all
+    threads to the pool.
+    Every step is run even if an earlier one fails. Returns a list of sys.exc_info() tuples for the steps that failed.
+    """
+    def enter_charges():
+        try:
+            report_run.charges.run()
+            for charge in report_run.charges.charges:
+                if charge['record_no']:
+                    report_run.journal.record(charge['ngs_test_id'], charge['irid'], 'charged', charge['record_no'])
+        finally:
+            # Start a new batch of charges for the next call
+            report_run.charges = GeLGeneworksChargeBatch()
+    errors = []
+    # Return Moka connections to the pool last, so they can be reused by the next call
+    for step in (partial(report_run.moka_writes.flush, moka), report_run.print_messages, report_run.send_emails, enter_charges, release_worker_mokas):
+        try:
+            step()
+        except Exception:
+            errors.append(sys.exc_info())
+    return errors
+
+def report_tests(ngs_test_ids, report_run):
+    """
+    Runs the reporting pipeline for a list of NGSTestIDs using the resources held by report_run:
+    runs the pre-flight checks for all tests, renders the cover pages and processes each test that passed.
+    If the --preflight flag was used, stops once the checks have been printed.
+    Once all tests have been processed (or if an exception is raised), any queued Moka updates are applied and
+    Geneworks charges are entered for the reported tests.
+    Returns the number of tests that passed the pre-flight checks.
+    """
+    args = report_run.args
+    # Print list of NGStestIDs for processing:
+    print ("INFO\t{num_tests} NGS test IDs for processing: {testIDs}").format(num_tests=len(ngs_test_ids), testIDs=ngs_test_ids)
+    # Create MokaQueryExecuter object for the main thread
+    moka = get_worker_moka()
+    # Pick up any summary of findings saved, replaced or removed since the last chunk or poll
+    report_run.report_index.refresh_if_changed()
+    # Check every test before any reports are submitted, downloaded or rendered, and report which will be processed
+    checked_tests = preflight(ngs_test_ids, report_run, moka)
+    ready = len([problem for ngs_test_id, data, problem in checked_tests if not problem])
+    print "INFO\tPre-flight checks: {ready} of {total} tests ready to report".format(ready=ready, total=len(checked_tests))
+    print preflight_table(checked_tests)
+    # Stop here if only the pre-flight checks were requested
+    if args.preflight:
+        release_worker_mokas()
+        return ready
+    # List of (NGSTestID, data) tuples for tests ready to be reported
+    tests_to_report = []
+    for ngs_test_id, data, problem in checked_tests:
+        if not problem:
+            # Only record the test as validated if its demographics were checked against LabKey, so that a later run
+            # without the skip_labkey flag still checks them
+            if not args.skip_labkey:
+                report_run.record(ngs_test_id, data, 'validated')
+            tests_to_report.append((ngs_test_id, data))
+    # Render the cover pdfs for all tests in as few wkhtmltopdf invocations as possible.
+    # If resuming, covers aren't needed for tests where the combined report was created by a previous run.
+    tests_needing_cover = [(ngs_test_id, data) for ngs_test_id, data in tests_to_report if not report_run.completed(ngs_test_id, data, 'merged')]
+    cover_pdfs = dict(zip(
+        [ngs_test_id for ngs_test_id, data in tests_needing_cover],
+        report_run.generator.create_cover_pdfs([data for ngs_test_id, data in tests_needing_cover], COVER_TEMPLATE)
+        ))
+    tests_to_report = [(ngs_test_id, data, cover_pdfs.get(ngs_test_id)) for ngs_test_id, data in tests_to_report]
+    # Process tests, using a pool of worker threads if more than one worker requested.
+    # Output is captured per test and printed in the order the NGSTestIDs were supplied.
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    # sys.exc_info() for an exception that stopped the run, which is raised once the run has been finished
+    run_exc_info = None
+    try:
+        run = partial(run_test, report_run=report_run, output=output)
+        if args.workers > 1:
+            results = report_run.get_worker_pool().imap(run, tests_to_report)
+        else:
+            results = imap(run, tests_to_report)
+        for captured, exc_info in results:
+            output.write(captured)
+            # Print the outcome of any Moka updates applied while processing the test, including other tests' updates
+            # applied in the same batch
+            report_run.print_messages()
+            # Populate emails addressed to clinicans with results attached, for tests whose Moka updates have been committed.
+            # Emails are always generated from the main thread, one at a time.
+            report_run.send_emails()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+    except BaseException:
+        run_exc_info = sys.exc_info()
+    sys.stdout = output.stream
+    # All tests will have been processed unless an exception was raised, in which case stop any queued tests being started
+    if run_exc_info:
+        report_run.stop_workers()
+    # Apply any Moka updates still queued and enter Geneworks charges for all tests that have been reported, including if the run stopped early
+    finish_errors = finish_tests(report_run, moka)
+    # Raise the exception that stopped the run rather than any error from finishing it, which are printed instead
+    if run_exc_info:
+        for error in finish_errors:
+            print "ERROR\tEncountered following error when finishing the run: {error}".format(error=error[1])
+        raise run_exc_info[0], run_exc_info[1], run_exc_info[2]
+    if finish_errors:
+        for error in finish_errors[1:]:
+            print "ERROR\tEncountered following error when finishing the run: {error}".format(error=error[1])
+        raise finish_errors[0][0], finish_errors[0][1], finish_errors[0][2]
+    return ready
+
+def read_worklist(worklist_file):
+    """
+    Returns the list of NGSTestIDs read from a worklist file object, in the order they appear.
+    IDs can be separated by new lines, spaces or commas. Anything after a # is a comment and is ignored.
+    """
+    ngs_test_ids = []
+    for line_number, line in enumerate(worklist_file, 1):
+        # Remove comments, which can be on their own line or follow the IDs
+        line = line.split('#', 1)[0]
+        for ngs_test_id in re.split(r'[\s,]+', line.strip()):
+            if not ngs_test_id:
                 continue
-            # If submit_exit_q flag is used, call script to submit a negneg clinical report and exit questionnaire to the CIP-API
-            # This shouldn't be used if either a summary of findings or exit questionnaire has already be created for this case (will fail if so)
-            if args.submit_exit_q:
-                ir_id = data['IRID']
-                try:
-                    ExitQuestionnaire_SSH(
-                        ir_id=ir_id,
-                        user='jahn'
-                        )
-                # Use BaseException so that SystemExit exceptions are caught
-                except BaseException as e:
-                    print "ERROR\tEncountered following error when submitting clinical report and exit questionnaire for NGSTestID {ngs_test_id}: {error}".format(ngs_test_id=ngs_test_id, error=e)
+            if not ngs_test_id.isdigit():
+                raise ValueError('Invalid NGSTestID "{ngs_test_id}" on line {line_number} of worklist'.format(ngs_test_id=ngs_test_id, line_number=line_number))
+            ngs_test_ids.append(int(ngs_test_id))
+    return ngs_test_ids
+
+def get_worklist(args):
+    """
+    Returns the list of NGSTestIDs to report, from the -n arguments, the --worklist file or selected from Moka with --ready
+    """
+    if args.n:
+        return args.n
+    if args.worklist == '-':
+        return read_worklist(sys.stdin)
+    if args.worklist:
+        with open(args.worklist) as worklist_file:
+            return read_worklist(worklist_file)
+    # Select all tests that are ready to report from Moka
+    ngs_test_ids = [ngs_test_id for ngs_test_id, irid in get_worker_moka().get_ready_tests()]
+    release_worker_mokas()
+    print "INFO\t{num_tests} tests ready to report selected from Moka".format(num_tests=len(ngs_test_ids))
+    return ngs_test_ids
+
+def report_worklist(ngs_test_ids, report_run):
+    """
+    Reports a worklist of NGSTestIDs in chunks of chunk_size tests, running each chunk through report_tests().
+    Only the data for one chunk is held at a time, so memory use doesn't grow with the size of the worklist.
+    A progress line is printed after each chunk when there is more than one.
+    """
+    chunk_size = report_run.args.chunk_size
+    chunks = (len(ngs_test_ids) + chunk_size - 1) // chunk_size
+    start = time.time()
+    ready = 0
+    for chunk, i in enumerate(range(0, len(ngs_test_ids), chunk_size), 1):
+        ready += report_tests(ngs_test_ids[i:i + chunk_size], report_run)
+        if chunks > 1:
+            processed = min(i + chunk_size, len(ngs_test_ids))
+            print "INFO\tProgress: chunk {chunk} of {chunks}, {processed} of {total} tests processed, {ready} passed pre-flight checks ({rate:.2f} tests/s)".format(
+                chunk=chunk,
+                chunks=chunks,
+                processed=processed,
+                total=len(ngs_test_ids),
+                ready=ready,
+                rate=processed / max(time.time() - start, 1e-6)
+                )
+
+def report_poll_stats(report_run):
+    """
+    Prints the cache hits and misses, and with --profile the time spent in each stage, for the tests reported in one
+    poll of watch mode. The counts and timings are then reset so that each poll is reported on its own rather than
+    accumulating for as long as the service runs. Spans written with --timings are unaffected.
+    """
+    for cache in (report_run.labkey_cache, report_run.summary_cache):
+        if cache:
+            print "INFO\t{cache}".format(cache=cache)
+            cache.reset_counts()
+    if report_run.args.profile:
+        print timing.summary_table()
+    timing.reset()
+
+def watch(report_run):
+    """
+    Service mode. Polls Moka every poll_interval seconds for tests that are ready to report and runs them through
+    report_tests(), keeping the database connections, SSH sessions, compiled cover template and caches held by
+    report_run between cases. Unless summaries are downloaded from CIP-API, tests are only reported once their summary
+    of findings has been saved in the technical reports folder. Tests that fail are retried once the technical reports
+    folder changes, or after RETRY_INTERVAL seconds. Runs until interrupted (e.g. with Ctrl+C).
+    """
+    args = report_run.args
+    # Time each NGSTestID was last attempted, and the technical reports folder modification time at that point
+    attempted = {}
+    print "INFO\tWatching Moka for tests ready to report every {poll_interval} seconds. Press Ctrl+C to stop.".format(poll_interval=args.poll_interval)
+    while True:
+        try:
+            # The output folder changes each month
+            report_run.gel_report_output_folder = report_output_folder()
+            folder_mtime = os.stat(report_run.report_index.folder).st_mtime
+            ready_tests = get_worker_moka().get_ready_tests()
+            ngs_test_ids = []
+            for ngs_test_id, irid in ready_tests:
+                previous = attempted.get(ngs_test_id)
+                if previous and previous[1] == folder_mtime and time.time() - previous[0] < RETRY_INTERVAL:
                     continue
-            # If download_summary flag is used, call script to download the summary of findings report from CIP-API
-            # This will only work if there is only one version of the summary of findings report, as is expected for negneg cases where summary of findings was genereted programmatically
-            # Therefore put -1 at end of summary of findings filename to indicate it is version 1 (as happens when downloading manually from interpretation portal)
-            if args.download_summary:
-                ir_id = data['IRID'].split("-")[0]
-                ir_version = data['IRID'].split("-")[1]
-                try:
-                    SummaryFindings_SSH(
-                        ir_id=ir_id,
-                        ir_version=ir_version,
-                        output_path=r"\\gstt.local\shared\Genetics\Bioinformatics\GeL\technical_reports\Summary_of_Findings_{ir_id}-{ir_version}-1.pdf".format(ir_id=ir_id, ir_version=ir_version),
-                        header="{patient_name}    DoB {DOB}    PRU {PRU}    NHS Number {NHSNumber}".format(**data)
-                        )
-                # Use BaseException so that SystemExit exceptions are caught
-                except BaseException as e:
-                    print "ERROR\tEncountered following error when downloading summary of findings for NGSTestID {ngs_test_id}: {error}".format(ngs_test_id=ngs_test_id, error=e)
+                # Wait for the summary of findings to be saved, unless it will be downloaded
+                if not args.download_summary and not report_run.report_index.find(irid):
                     continue
-            # Set summary of findings text based on result code If result code is Negative (1) or Negative Negative (1189679668)
-            if data['result_code'] in [1, 1189679668]:
-                # 1 = Negative, 1189679668 = NegNeg
-                data['summary_of_findings'] = (
-                    'Whole genome sequencing has been completed by Genomics England and the primary analysis has not identified any underlying genetic cause of the clinical presentation.'
-                )
-            elif data['result_code'] in [1189679670]:
-                # 1189679670 = Previously reported variant i.e. No new findings from WGS
-                data['summary_of_findings'] = (
-                    'Whole genome sequencing has been completed by Genomics England; please see the genome interpretation section for details of previously reported variant(s).'
-                )
-            elif data['result_code'] in [1189679598]:
-                #1189679598 = Other i.e complicated cases
-                data['summary_of_findings'] = (
-                    'Whole genome sequencing has been completed by Genomics England; please see the genome interpretation section for details.'
-                )
+                ngs_test_ids.append(ngs_test_id)
+            if ngs_test_ids:
+                for ngs_test_id in ngs_test_ids:
+                    attempted[ngs_test_id] = (time.time(), folder_mtime)
+                report_worklist(ngs_test_ids, report_run)
+                report_poll_stats(report_run)
             else:
-                # If result code not known, print error and skip to the next case
-                print 'ERROR\tUnknown result code for NGSTestID {ngs_test_id}.'.format(ngs_test_id=ngs_test_id)
-                continue
-            # Create GelReportGenerator object
-            g = GelReportGenerator(path_to_wkhtmltopdf=r'\\gstt.local\shared\Genetics_Data2\Array\Software\wkhtmltopdf\bin\wkhtmltopdf.exe')            
-            # Create the cover pdf
-            g.create_cover_pdf(data, r'\\gstt.local\apps\Moka\Files\Software\100K\gel_cover_report_template.html')
-            # Specify the path to the folder containing the technical reports downloaded from the interpretation portal
-            gel_original_report_folder = r'\\gstt.local\shared\Genetics\Bioinformatics\GeL\technical_reports'
-            # create a search pattern to identify the correct HTML report. Use single character wildcard as the verison of the report is not known
-            gel_original_report_search_name = "Summary_of_Findings_{ir_id}-?.pdf".format(ir_id=data['IRID'])
-            # Specify the output path for the combined report, based on the GeL participant ID and the interpretation request ID retrieved from Moka
-            gel_combined_report = r'{gel_report_output_folder}\{pru}_{proband_id}_{ir_id}_{date}.pdf'.format(
-                    gel_report_output_folder=gel_report_output_folder,
-                    pru=data['PRU'].replace(':', '_'),
-                    date=datetime.datetime.now().strftime(r'%y%m%d'),
-                    proband_id=data['GELID'],
-                    ir_id=data['IRID']
-                    )
-            # create an empty list to hold all the reports which match the search pattern
-            list_of_html_reports = []
-            # populate this list with the results of os.listdir which match the search term (created above). 
-            list_of_html_reports = fnmatch.filter(os.listdir(gel_original_report_folder), gel_original_report_search_name)
-            # if there is more than one report for this case
-            if len(list_of_html_reports) > 1:
-                # print error message
-                print 'ERROR\tMultiple ({file_count}) versions of the HTML report exist for IR-ID {ir_id}. Ensure only the correct version exists in {gel_original_report_folder}.'.format(file_count=len(list_of_html_reports), ir_id=data['IRID'], gel_original_report_folder=gel_original_report_folder)
-            # if the original GeL report is not found, 
-            elif len(list_of_html_reports) < 1:
-                # print an error message
-                print 'ERROR\tOriginal GeL report not found for IR-ID {ir_id}. Please ensure it has been saved as PDF with the following filepath: {gel_original_report}'.format(gel_original_report=os.path.join(gel_original_report_folder, gel_original_report_search_name), ir_id=data['IRID'])
+                release_worker_mokas()
+        except Exception as e:
+            # Keep watching if a poll fails, e.g. if the connection to Moka drops
+            print "ERROR\tEncountered following error when reporting ready tests: {error}".format(error=e)
+            release_worker_mokas()
+        time.sleep(args.poll_interval)
+
+def main():
+    # Get command line arguments
+    args = process_arguments()
+    # Write timing spans to a file if requested
+    timing.configure(args.timings)
+    # Create resources shared by all tests in the run
+    report_run = ReportRun(args, report_output_folder())
+    try:
+        # Check that the Geneworks views are configured and readable before doing anything else
+        try:
+            GeneworksQueryExecuter().check_access()
+        except TransientError as e:
+            # Geneworks may be back by the time it's needed, so report the error and carry on
+            print "ERROR\tUnable to check access to the Geneworks views: {error}".format(error=e)
+        except (ValueError, RemoteCallError) as e:
+            sys.exit("ERROR\t{error}".format(error=e))
+        if args.watch:
+            watch(report_run)
+        else:
+            try:
+                ngs_test_ids = get_worklist(args)
+            except (IOError, ValueError) as e:
+                sys.exit("ERROR\tUnable to read worklist: {error}".format(error=e))
+            if ngs_test_ids:
+                report_worklist(ngs_test_ids, report_run)
             else:
-                # If only one report found create the name of the report using the file identified using the wildcard
-                gel_original_report = os.path.join(gel_original_report_folder, list_of_html_reports[0])
-                # Attach the GeL report to the cover page and output to the output path specified above.
-                g.pdf_merge(gel_combined_report, g.cover_pdf, gel_original_report)
-                # Store report filepath as an NGSTestFile in Moka
-                ngstestfile_insert_sql = (
-                    "INSERT INTO NGSTestFile (NGSTestID, Description, NGSTestFile, DateAdded) "
-                    "VALUES ({ngs_test_id},  '100k Results', '{gel_combined_report}', '{today_date}');"
-                    ).format(
-                        ngs_test_id=ngs_test_id,
-                        gel_combined_report=gel_combined_report,
-                        today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p')
-                        )
-                moka.execute_query(ngstestfile_insert_sql)
-                # If it's a negneg, update the check2, reporter (check3) and authoriser (check4) to the logged in user, and status to Complete for NGSTest and Patient, and generate email
-                if data['result_code']  == 1189679668:
-                    ngstest_update_sql = (
-                        "UPDATE n SET n.Check2ID = c.Check1ID, n.Check2Date = '{today_date}', n.Check3ID = c.Check1ID, n.Check3Date = '{today_date}', n.Check4ID = c.Check1ID, n.Check4Date = '{today_date}', n.StatusID = 4 "
-                        "FROM NGSTest AS n, Checker AS c WHERE c.UserName = '{username}' AND n.NGSTestID = {ngs_test_id};"
-                        ).format(
-                            today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'), 
-                            username=os.getenv('username'),
-                            ngs_test_id=ngs_test_id
-                            )
-                    moka.execute_query(ngstest_update_sql)
-                    # Record test status update in patient log
-                    patientlog_insert_sql = (
-                        "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) "
-                        "VALUES ({internal_patient_id},  'NGS: Test status automatically set to complete for 100k interpretation request {IRID}.', '{today_date}', '{username}', '{computer}');"
-                        ).format(
-                            internal_patient_id=data['internal_patient_id'],
-                            IRID=data['IRID'],
-                            today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'),
-                            username=os.getenv('username'),
-                            computer=os.getenv('computername')
-                            )
-                    moka.execute_query(patientlog_insert_sql)
-                    # Update the patient status to complete. Only do this if patient status is currently 100K, to prevent interfering with any parallel testing.
-                    if data['patient_status_id'] == 1202218839:
-                        ngstest_update_sql = (
-                            "UPDATE Patients SET Patients.s_StatusOverall = 4 WHERE InternalPatientID = {internal_patient_id};".format(
-                                internal_patient_id=data['internal_patient_id']    
-                                )
-                            )
-                        moka.execute_query(ngstest_update_sql)
-                        # Record status update in patient log
-                        patientlog_insert_sql = (
-                            "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) "
-                            "VALUES ({internal_patient_id},  'NGS: Patient status automatically set to complete for 100k interpretation request {IRID}.', '{today_date}', '{username}', '{computer}');"
-                            ).format(
-                                internal_patient_id=data['internal_patient_id'],
-                                IRID=data['IRID'],
-                                today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'),
-                                username=os.getenv('username'),
-                                computer=os.getenv('computername')
-                                )
-                        moka.execute_query(patientlog_insert_sql)
-                    # Create email body
-                    email_subject = "100,000 Genomes Project Result"
-                    email_body = (
-                        '<body style="font-family:Calibri,sans-serif;">'
-                        '<b>100,000 Genomes Project result from the Genetics Laboratory at Viapath - Guy\'s Hospital</b><br><br>'
-                        'PLEASE DO NOT REPLY TO THIS EMAIL ADDRESS WITH ENQUIRIES ABOUT REPORTS<br>'
-                        'FOR ALL ENQUIRIES PLEASE CONTACT THE LABORATORY USING <a href="mailto:DNADutyScientist@viapath.co.uk">DNADutyScientist@viapath.co.uk</a><br><br>'
-                        'Kind regards<br>'
-                        'Genetics Laboratory<br>'
-                        '5th Floor, Tower Wing<br>'
-                        'Guy\'s Hospital<br>'
-                        'London, SE1 9RT<br>'
-                        'United Kingdom<br><br>'
-                        'Tel: + 44 (0) 207 188 1709'
-                        '</body>'
-                        )
-                    # Populate an outlook email addressed to clinican with results attached 
-                    generate_email(data['clinician_report_email'], email_subject, email_body, [gel_combined_report])
-                # Record result letter generation in patient log
-                patientlog_insert_sql = (
-                    "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) "
-                    "VALUES ({internal_patient_id},  'NGS: 100k results letter automatically generated for 100k interpretation request {IRID}.', '{today_date}', '{username}', '{computer}');"
-                    ).format(
-                        internal_patient_id=data['internal_patient_id'],
-                        IRID=data['IRID'],
-                        today_date=datetime.datetime.now().strftime(r'%Y%m%d %H:%M:%S %p'),
-                        username=os.getenv('username'),
-                        computer=os.getenv('computername')
-                        )
-                moka.execute_query(patientlog_insert_sql)
-                # Insert charge to Geneworks
-                g = GeLGeneworksCharge()
-                g.get_test_details(data['PRU'])
-                # If it's a negneg, submit negneg cost code
-                if data['result_code'] in [1189679668]:
-                    g.insert_charge('WGS No Variants', 71)
-                # If it's a different result code, warn user that charge couldn't be entered to geneworks
-                else:
-                    print 'ERROR\tUnable to enter charge to geneworks for IRID {ir_id} NGSTestID {ngs_test_id}. No charge associated with result code {result_code}'.format(
-                        ngs_test_id=ngs_test_id,
-                        ir_id=data['IRID'],
-                        result_code=data['result_code']
-                        )
-                # Print output location of reports
-                print 'SUCCESS\tGenerated report for IRID {ir_id} NGStestID {ngs_test_id} can be found in: {gel_report_output_folder}'.format(
-                    ngs_test_id=ngs_test_id, 
-                    gel_report_output_folder=gel_report_output_folder,
-                    ir_id=data['IRID']
-                    )
+                print "INFO\tNo tests to report"
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        print "INFO\tStopped watching for tests ready to report"
+    finally:
+        # Stop the worker threads and close the connections to GENAPP01, Moka and Geneworks
+        try:
+            report_run.stop_workers()
+            release_worker_mokas()
+        finally:
+            close_pools()
+        # Report the time spent connecting to databases
+        for pool in pools():
+            print "INFO\t{pool}".format(pool=pool)
+        # Report if calls to GENAPP01 or the databases were stopped after repeated failures
+        for breaker in [get_breaker()] + [pool.breaker for pool in pools()]:
+            if breaker.opened:
+                print "ERROR\t{breaker}".format(breaker=breaker)
+        if report_run.labkey_cache:
+            print "INFO\t{labkey_cache}".format(labkey_cache=report_run.labkey_cache)
+        if report_run.summary_cache:
+            print "INFO\t{summary_cache}".format(summary_cache=report_run.summary_cache)
+        if report_run.mailer and report_run.mailer.created:
+            print "INFO\t{mailer}".format(mailer=report_run.mailer)
+        # Print the time spent in each stage of the run
+        if args.profile:
+            print timing.summary_table()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python2
+"""
+genapp_session.py
+
+Persistent SSH session to the Viapath GENAPP01 server. Requires a config file with SSH credentials.
+
+A single authenticated transport is opened per run (one per worker thread) and shared by LabKey_SSH,
+ExitQuestionnaire_SSH and SummaryFindings_SSH, so the number of SSH handshakes stays constant regardless of the
+number of tests processed. paramiko is imported when the first connection is opened.
+
+Connecting, running commands and transferring files are bounded by timeouts, which can be set in the GENAPP01
+section of the config file (CONNECT_TIMEOUT, COMMAND_TIMEOUT and TRANSFER_TIMEOUT, in seconds). Timeouts and dropped
+connections are raised as resilience.TransientError. All sessions share one circuit breaker, which stops calls to
+GENAPP01 after FAILURE_THRESHOLD consecutive transient failures for RESET_TIMEOUT seconds.
+"""
+import socket
+import logging
+import threading
+from app_config import get_config, get_number
+from resilience import CircuitBreaker, RemoteCallError, TransientError, retry_call
+
+# Connection errors are raised as exceptions, so don't warn that paramiko's log messages have no handler
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+# Defaults for the optional settings in the GENAPP01 section of the config file
+CONNECT_TIMEOUT = 30.0
+COMMAND_TIMEOUT = 300.0
+TRANSFER_TIMEOUT = 300.0
+RETRIES = 2
+RETRY_DELAY = 2.0
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 300.0
+
+def print_message(message):
+    """Default log function for sessions, which prints the message to the caller's output.
+    """
+    print(message)
+
+class GenappSession(object):
+    '''Single authenticated SSH transport to GENAPP01, handing out exec channels and an SFTP client.
+
+    The transport is opened on first use and is reopened transparently if the connection has dropped.
+
+    Args:
+        host: Server to connect to. Defaults to GENAPP01 SERVER from config file
+        user: SSH username. Defaults to GENAPP01 USER from config file
+        password: SSH password. Defaults to GENAPP01 PASSWORD from config file
+        port: SSH port. Defaults to GENAPP01 PORT from config file if set, otherwise 22
+        breaker: Optional CircuitBreaker. Defaults to the breaker shared by all sessions.
+        log: Optional function called with a message before each retry. Defaults to printing the message.
+    Attributes:
+        handshakes: Number of times an SSH transport has been opened and authenticated
+        connect_timeout: Seconds to wait for the connection and authentication
+        command_timeout: Seconds to wait for output from a command
+        transfer_timeout: Seconds to wait for each SFTP request
+        retries: Number of times idempotent calls made with retry() are repeated after a transient failure
+    Methods:
+        exec_command(command, stdin_data, stdout_file): Runs a command on the server and returns stdout and stderr
+        get_file(remotepath, localpath, callback): Copies a file from the server with SFTP
+        call(func, description): Calls a function that uses the session, with the same error handling as the other methods
+        retry(func, description): Calls an idempotent function, repeating it after transient failures
+        open_sftp(): Returns an SFTP client on the shared transport
+        close(): Closes the SFTP client and transport
+    '''
+    def __init__(self, host=None, user=None, password=None, port=None, breaker=None, log=None):
+        config = get_config()
+        self.ssh_host = host or config.get("GENAPP01", "SERVER")
+        self.ssh_user = user or config.get("GENAPP01", "USER")
+        self.ssh_pwd = password or config.get("GENAPP01", "PASSWORD")
+        self.port = port or get_number("GENAPP01", "PORT", 22)
+        self.connect_timeout = get_number("GENAPP01", "CONNECT_TIMEOUT", CONNECT_TIMEOUT)
+        self.command_timeout = get_number("GENAPP01", "COMMAND_TIMEOUT", COMMAND_TIMEOUT)
+        self.transfer_timeout = get_number("GENAPP01", "TRANSFER_TIMEOUT", TRANSFER_TIMEOUT)
+        self.retries = get_number("GENAPP01", "RETRIES", RETRIES)
+        self.retry_delay = get_number("GENAPP01", "RETRY_DELAY", RETRY_DELAY)
+        self.breaker = breaker or get_breaker()
+        self.log = log or print_message
+        self.handshakes = 0
+        self._transport = None
+        self._sftp = None
+        self._lock = threading.RLock()
+
+    def get_transport(self):
+        """Return the shared transport, (re)connecting if it is not open or the link has dropped.
+        """
+        with self._lock:
+            if self._transport is None or not self._transport.is_active():
+                self._connect()
+            return self._transport
+
+    def _connect(self):
+        """Open and authenticate a new transport, discarding any existing one.
+        """
+        import paramiko
+        self.close()
+        sock = socket.create_connection((self.ssh_host, self.port), timeout=self.connect_timeout)
+        transport = paramiko.Transport(sock)
+        # Bound each step of the handshake, so that an unresponsive server doesn't stall the run
+        transport.banner_timeout = self.connect_timeout
+        transport.handshake_timeout = self.connect_timeout
+        transport.auth_timeout = self.connect_timeout
+        try:
+            transport.connect(username=self.ssh_user, password=self.ssh_pwd)
+        except BaseException:
+            transport.close()
+            raise
+        # Send keepalives so that a dropped link is detected by is_active() before the next command
+        transport.set_keepalive(30)
+        self._transport = transport
+        self.handshakes += 1
+
+    def _open_channel(self):
+        """Open a new session channel, reconnecting once if the existing transport has gone away.
+        """
+        import paramiko
+        try:
+            return self.get_transport().open_session(timeout=self.connect_timeout)
+        except (paramiko.SSHException, EOFError, socket.error):
+            with self._lock:
+                self._connect()
+            return self.get_transport().open_session(timeout=self.connect_timeout)
+
+    def _call(self, func, description, *args, **kwargs):
+        """Call func through the circuit breaker, raising timeouts and connection failures as TransientError.
+        """
+        import paramiko
+        def call():
+            try:
+                return func(*args, **kwargs)
+            except socket.timeout:
+                # Discard the SFTP client, as a timed out request leaves it waiting for a response
+                with self._lock:
+                    if self._sftp is not None:
+                        self._sftp.close()
+                        self._sftp = None
+                raise TransientError("Timed out {description} on {host}".format(description=description, host=self.ssh_host))
+            except paramiko.AuthenticationException as e:
+                # Rejected credentials won't succeed if retried
+                raise RemoteCallError("Authentication with {host} failed: {error}".format(host=self.ssh_host, error=e))
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                # Discard the SFTP client and transport, as they may be left in an unknown state
+                self.close()
+                raise TransientError("Connection to {host} failed {description}: {error}".format(host=self.ssh_host, description=description, error=str(e) or repr(e)))
+        return self.breaker.call(call)
+
+    def exec_command(self, command, stdin_data=None, stdout_file=None, chunk_size=32768):
+        """Run a command on the server in a new channel of the shared transport.
+        Args:
+            command: Command to run
+            stdin_data: Optional string to send to the command's stdin
+            stdout_file: Optional file-like object. If supplied, stdout is written to it in chunks as it arrives
+                instead of being held in memory, and None is returned in place of the stdout string.
+            chunk_size: Size of chunks read from stdout when streaming to stdout_file
+        Returns:
+            Tuple of (stdout, stderr) strings
+        Raises:
+            TransientError: If the connection fails or no output is received for command_timeout seconds
+            CircuitOpenError: If GENAPP01 has failed repeatedly
+        """
+        return self._call(self._exec_command, 'running command', command, stdin_data, stdout_file, chunk_size)
+
+    def _exec_command(self, command, stdin_data, stdout_file, chunk_size):
+        channel = self._open_channel()
+        try:
+            # Reads and writes on the channel raise socket.timeout if the command is unresponsive for command_timeout seconds
+            channel.settimeout(self.command_timeout)
+            channel.exec_command(command)
+            if stdin_data:
+                channel.sendall(stdin_data)
+            channel.shutdown_write()
+            # Call .read() on the stdout and stderr files so that the command has finished before the channel is closed
+            if stdout_file is None:
+                stdout = channel.makefile('rb', -1).read()
+            else:
+                stdout = None
+                chunk = channel.recv(chunk_size)
+                while chunk:
+                    stdout_file.write(chunk)
+                    chunk = channel.recv(chunk_size)
+            stderr = channel.makefile_stderr('rb', -1).read()
+        finally:
+            channel.close()
+        return stdout, stderr
+
+    def get_file(self, remotepath, localpath, callback=None):
+        """Copy a file from the server with SFTP.
+        Raises:
+            TransientError: If the connection fails or an SFTP request takes longer than transfer_timeout seconds
+            CircuitOpenError: If GENAPP01 has failed repeatedly
+        """
+        def get():
+            self.open_sftp().get(remotepath=remotepath, localpath=localpath, callback=callback)
+        return self._call(get, 'copying {remotepath}'.format(remotepath=remotepath))
+
+    def call(self, func, description):
+        """Call a function that uses this session's transport or SFTP client (e.g. a file transfer) through the circuit
+        breaker, raising timeouts and connection failures as TransientError. Returns the result of func.
+        """
+        return self._call(func, description)
+
+    def retry(self, func, description):
+        """Call an idempotent function that uses this session, repeating it up to retries times if it raises a
+        TransientError, with jittered backoff between attempts. Each retry is reported with the session's log function.
+        Returns the result of func.
+        """
+        return retry_call(func, attempts=self.retries + 1, base_delay=self.retry_delay, description=description, log=self.log)
+
+    def open_sftp(self):
+        """Return an SFTP client on the shared transport. The client is reused until the transport is reconnected.
+        """
+        import paramiko
+        with self._lock:
+            transport = self.get_transport()
+            if self._sftp is None or self._sftp.get_channel().get_transport() is not transport:
+                self._sftp = paramiko.SFTPClient.from_transport(transport)
+                # Each SFTP request raises socket.timeout if the server doesn't respond within transfer_timeout seconds
+                self._sftp.get_channel().settimeout(self.transfer_timeout)
+            return self._sftp
+
+    def close(self):
+        """Close the SFTP client and transport (if open).
+        """
+        with self._lock:
+            if self._sftp is not None:
+                self._sftp.close()
+                self._sftp = None
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
+
+# Circuit breaker shared by all sessions, created on first use
+_breaker = None
+_breaker_lock = threading.Lock()
+
+def get_breaker():
+    """Return the circuit breaker shared by all calls to GENAPP01, creating it on first use.
+    """
+    global _breaker
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                'GENAPP01',
+                failure_threshold=get_number("GENAPP01", "FAILURE_THRESHOLD", FAILURE_THRESHOLD),
+                reset_timeout=get_number("GENAPP01", "RESET_TIMEOUT", RESET_TIMEOUT)
+                )
+        return _breaker
+
+# Sessions shared by all remote calls made from each thread. Each worker thread gets its own session so that
+# commands and SFTP transfers from concurrent workers don't contend for a single transport.
+_thread_sessions = threading.local()
+# All sessions created by get_session(), so that they can be closed by close_sessions()
+_sessions = []
+_sessions_lock = threading.Lock()
+
+def get_session():
+    """Return the session shared by all remote calls in the current thread, creating it on first use.
+    """
+    session = getattr(_thread_sessions, 'session', None)
+    if session is None:
+        session = GenappSession()
+        _thread_sessions.session = session
+        with _sessions_lock:
+            _sessions.append(session)
+    return session
+
+def close_sessions():
+    """Close the transports of all sessions created by get_session(). Call once no thread is using them, e.g. at the
+    end of a run. A session used again afterwards reconnects, so the number of open transports is never more than the
+    number of threads making remote calls.
+    """
+    with _sessions_lock:
+        sessions = list(_sessions)
+    for session in sessions:
+        session.close()
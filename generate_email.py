@@ -1,8 +1,10 @@
 """
-usage: generate_email.py [-h] -t TO -s SUBJECT -b BODY
-                         [-a ATTACHMENTS [ATTACHMENTS ...]]
+usage: generate_email.py [-h] [-t TO] [-s SUBJECT] [-b BODY]
+                         [-a ATTACHMENTS [ATTACHMENTS ...]] [-m FILE]
+                         [--backend {outlook,drafts,msg,eml}] [--outbox DIR]
 
-Generates an email and opens in Outlook
+Generates emails and opens them in Outlook, saves them as Outlook drafts, or
+writes them to an outbox folder
 
 optional arguments:
   -h, --help            show this help message and exit
@@ -12,45 +14,253 @@ optional arguments:
   -b BODY, --body BODY  Email body
   -a ATTACHMENTS [ATTACHMENTS ...], --attachments ATTACHMENTS [ATTACHMENTS ...]
                         File paths for attachments
+  -m FILE, --manifest FILE
+                        JSON lines file of emails to generate ('-' for stdin),
+                        one object per line with "to", "subject", "body" and
+                        optionally "attachments" keys. Used in place of -t,
+                        -s, -b and -a to generate many emails in one call.
+  --backend {outlook,drafts,msg,eml}
+                        How emails are generated (default outlook). outlook
+                        opens each email in an Outlook window, drafts saves
+                        them to the Outlook Drafts folder, msg saves them as
+                        .msg files in the outbox folder using Outlook, and eml
+                        writes them as .eml files to the outbox folder without
+                        using Outlook.
+  --outbox DIR          Folder that .msg and .eml files are written to
+                        (required for the msg and eml backends)
 """
+import os
+import re
+import sys
+import json
 import argparse
-import win32com.client as win32
+import datetime
+import mimetypes
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+from email.utils import formatdate, make_msgid
+
+# Ways emails can be generated. See process_arguments() for details.
+BACKENDS = ['outlook', 'drafts', 'msg', 'eml']
 
 def process_arguments():
     """
     Uses argparse module to define and handle command line input arguments and help menu
     """
     # Create ArgumentParser object. Description message will be displayed as part of help message if script is run with -h flag
-    parser = argparse.ArgumentParser(description='Generates an email and opens in Outlook')
+    parser = argparse.ArgumentParser(description='Generates emails and opens them in Outlook, saves them as Outlook drafts, or writes them to an outbox folder')
     # Define the arguments that will be taken.
-    parser.add_argument('-t', '--to', required=True, type=str, help='Recipient email address')
-    parser.add_argument('-s', '--subject', required=True, type=str, help='Subject line for email')
-    parser.add_argument('-b', '--body', required=True, type=str, help='Email body')
+    parser.add_argument('-t', '--to', type=str, help='Recipient email address')
+    parser.add_argument('-s', '--subject', type=str, help='Subject line for email')
+    parser.add_argument('-b', '--body', type=str, help='Email body')
     parser.add_argument('-a', '--attachments', required=False, type=str, nargs='+', help='File paths for attachments')
+    parser.add_argument(
+            '-m', '--manifest',
+            metavar='FILE',
+            help='JSON lines file of emails to generate (\'-\' for stdin), one object per line with "to", "subject", "body" and optionally "attachments" keys. Used in place of -t, -s, -b and -a to generate many emails in one call.'
+        )
+    parser.add_argument(
+            '--backend',
+            choices=BACKENDS,
+            default='outlook',
+            help='How emails are generated (default outlook). outlook opens each email in an Outlook window, drafts saves them to the Outlook Drafts folder, msg saves them as .msg files in the outbox folder using Outlook, and eml writes them as .eml files to the outbox folder without using Outlook.'
+        )
+    parser.add_argument('--outbox', metavar='DIR', help='Folder that .msg and .eml files are written to (required for the msg and eml backends)')
     # Return the arguments
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Either a manifest or the details of a single email must be supplied
+    if args.manifest and (args.to or args.subject or args.body or args.attachments):
+        parser.error('-m/--manifest cannot be used with -t, -s, -b or -a')
+    if not args.manifest and not (args.to and args.subject and args.body):
+        parser.error('-t/--to, -s/--subject and -b/--body are required unless -m/--manifest is used')
+    if args.backend in ('msg', 'eml') and not args.outbox:
+        parser.error('--outbox is required for the {backend} backend'.format(backend=args.backend))
+    return args
+
+def read_manifest(manifest_file):
+    """
+    Returns a list of (to_address, subject, body, attachments) tuples read from a JSON lines manifest file object
+    """
+    emails = []
+    for line_number, line in enumerate(manifest_file, 1):
+        if not line.strip():
+            continue
+        try:
+            message = json.loads(line)
+            emails.append((message['to'], message['subject'], message['body'], message.get('attachments') or []))
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError('Invalid email on line {line_number} of manifest: {error}'.format(line_number=line_number, error=e))
+    return emails
+
+def outbox_filename(outbox, subject, extension):
+    """
+    Returns an unused path in the outbox folder for an email, named with the current time and subject
+    """
+    # Remove characters that aren't allowed in Windows filenames
+    name = '{timestamp}_{subject}'.format(
+        timestamp=datetime.datetime.now().strftime('%Y%m%d_%H%M%S'),
+        subject=re.sub(r'[^\w\-]+', '_', subject).strip('_')[:50]
+        )
+    path = os.path.join(outbox, name + extension)
+    suffix = 1
+    while os.path.exists(path):
+        suffix += 1
+        path = os.path.join(outbox, '{name}_{suffix}{extension}'.format(name=name, suffix=suffix, extension=extension))
+    return path
+
+class OutlookMailer(object):
+    '''Generates emails using a single Outlook session for the whole run.
+
+    Args:
+        mode: 'outlook' to open each email in an Outlook window, 'drafts' to save each email to the Drafts folder, or
+              'msg' to save each email as a .msg file in the outbox folder
+        outbox: Folder that .msg files are saved to. Created if it doesn't exist.
+    Attributes:
+        created: Number of emails generated
+    Methods:
+        add(to_address, subject, body, attachments): Generates an email
+    '''
+    # Outlook item type for a mail item, and SaveAs format for .msg files
+    MAIL_ITEM = 0
+    MSG_FORMAT = 3
+
+    def __init__(self, mode='outlook', outbox=None):
+        self.mode = mode
+        self.outbox = outbox
+        self.created = 0
+        self._outlook = None
+        if mode == 'msg' and not os.path.isdir(outbox):
+            os.makedirs(outbox)
+
+    @property
+    def outlook(self):
+        """
+        Outlook application, dispatched on first use
+        """
+        if self._outlook is None:
+            # Import Outlook automation only when an email is generated, so that --help and importing this module are fast
+            import win32com.client as win32
+            self._outlook = win32.Dispatch('outlook.application')
+        return self._outlook
+
+    def add(self, to_address, subject, body, attachments):
+        """
+        Populates an Outlook email and opens it, saves it as a draft or saves it as a .msg file.
+        Returns the path of the .msg file, or None.
+        """
+        # Create Outlook message object
+        mail = self.outlook.CreateItem(self.MAIL_ITEM)
+        # Set email attributes
+        mail.To = to_address
+        mail.Subject = subject
+        mail.HtmlBody = body
+        # Attach files
+        if attachments:
+            [mail.Attachments.Add(Source=attachment) for attachment in attachments]
+        path = None
+        if self.mode == 'drafts':
+            mail.Save()
+        elif self.mode == 'msg':
+            path = outbox_filename(self.outbox, subject, '.msg')
+            mail.SaveAs(os.path.abspath(path), self.MSG_FORMAT)
+        else:
+            # Open the email in outlook. False argument prevents the Outlook window from blocking the script
+            mail.Display(False)
+        self.created += 1
+        return path
+
+    def __str__(self):
+        return "Emails: {created} {action}".format(
+            created=self.created,
+            action={'drafts': 'saved to Outlook Drafts', 'msg': 'saved to {outbox}'.format(outbox=self.outbox)}.get(self.mode, 'opened in Outlook')
+            )
+
+class EmlMailer(object):
+    '''Writes emails as .eml files (RFC 5322 MIME messages) to an outbox folder, without using Outlook.
+
+    Files are marked as unsent, so Outlook opens them as drafts that can be checked and sent.
+
+    Args:
+        outbox: Folder that .eml files are written to. Created if it doesn't exist.
+    Attributes:
+        created: Number of emails written
+    Methods:
+        add(to_address, subject, body, attachments): Writes an email to the outbox
+    '''
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self.created = 0
+        if not os.path.isdir(outbox):
+            os.makedirs(outbox)
+
+    def message(self, to_address, subject, body, attachments):
+        """
+        Returns the MIME message for an email with an HTML body and the attachments
+        """
+        message = MIMEMultipart()
+        message['To'] = to_address
+        message['Subject'] = subject
+        message['Date'] = formatdate(localtime=True)
+        message['Message-ID'] = make_msgid()
+        message['X-Unsent'] = '1'
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        message.attach(MIMEText(body, 'html', 'utf-8'))
+        for attachment in attachments or []:
+            content_type = mimetypes.guess_type(attachment)[0] or 'application/octet-stream'
+            with open(attachment, 'rb') as attachment_file:
+                part = MIMEApplication(attachment_file.read(), content_type.split('/')[1])
+            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment))
+            message.attach(part)
+        return message
+
+    def add(self, to_address, subject, body, attachments):
+        """
+        Writes an email to the outbox folder. Returns the path of the .eml file.
+        """
+        path = outbox_filename(self.outbox, subject, '.eml')
+        # Write to a temporary file and rename, so that a partial email is never left in the outbox
+        partial_path = path + '.partial'
+        with open(partial_path, 'wb') as eml:
+            eml.write(self.message(to_address, subject, body, attachments).as_string())
+        os.rename(partial_path, path)
+        self.created += 1
+        return path
+
+    def __str__(self):
+        return "Emails: {created} written to {outbox}".format(created=self.created, outbox=self.outbox)
+
+def get_mailer(backend='outlook', outbox=None):
+    """
+    Returns the mailer for a backend (see BACKENDS), used to generate all emails in a run
+    """
+    if backend == 'eml':
+        return EmlMailer(outbox)
+    return OutlookMailer(mode=backend, outbox=outbox)
 
 def generate_email(to_address, subject, body, attachments):
     '''
     Populates an Outlook email and opens in separate window
     '''
-    # Create Outlook message object
-    outlook = win32.Dispatch('outlook.application')
-    mail = outlook.CreateItem(0)
-    # Set email attributes
-    mail.To = to_address
-    mail.Subject = subject
-    mail.HtmlBody = body
-    # Attach files
-    if attachments:
-        [mail.Attachments.Add(Source=attachment) for attachment in attachments]
-    # Open the email in outlook. False argument prevents the Outlook window from blocking the script 
-    mail.Display(False)
+    OutlookMailer().add(to_address, subject, body, attachments)
 
 def main():
     args = process_arguments()
-    # Populate an outlook email addressed to clinican with results attached 
-    generate_email(args.to, args.subject, args.body, args.attachments)
+    if args.manifest == '-':
+        emails = read_manifest(sys.stdin)
+    elif args.manifest:
+        with open(args.manifest) as manifest_file:
+            emails = read_manifest(manifest_file)
+    else:
+        emails = [(args.to, args.subject, args.body, args.attachments)]
+    # Generate all emails with one mailer, so that a single Outlook session is used
+    mailer = get_mailer(args.backend, args.outbox)
+    for email in emails:
+        path = mailer.add(*email)
+        if path:
+            print("INFO\tEmail to {to} saved to {path}".format(to=email[0], path=path))
+    print("INFO\t{mailer}".format(mailer=mailer))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,85 @@
+"""
+labkey_cache.py
+
+Local cache of participant demographics returned by LabKey, keyed by GEL participant ID.
+
+A participant's date of birth and NHS number rarely change, so demographics retrieved from LabKey are stored in an
+SQLite database and reused until they are older than the cache's time to live (TTL). Patient names are not stored
+unless the cache is created with include_names=True.
+"""
+import time
+from sqlite_store import SqliteCache
+
+class LabKeyCache(SqliteCache):
+    '''Cache of LabKey demographics keyed by GEL participant ID.
+
+    Args:
+        path: Path to SQLite database file. Created if it doesn't exist.
+        ttl_hours: Number of hours a cached record is used for before it is retrieved from LabKey again
+        include_names: If True, patient names are stored in the cache. Otherwise they are returned as empty strings.
+        read_only: If True, the cache is only read: put() and invalidate() don't change it. A file without the
+            demographics table (e.g. an empty file) is treated as an empty cache.
+    Attributes:
+        hits: Number of participants found in the cache
+        misses: Number of participants not in the cache, or with an expired record
+    Methods:
+        get(participant_id): Returns (name, dob, nhsid) tuple for a participant, or None
+        put(participant_id, name, dob, nhsid): Stores the demographics for a participant
+        invalidate(participant_ids): Removes records for the given participants, or all records if none are given
+    '''
+    NAME = 'LabKey cache'
+    # Demographics for each participant, with the time they were retrieved from LabKey
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS demographics ('
+        'participant_id TEXT PRIMARY KEY, '
+        'name TEXT, '
+        'dob TEXT NOT NULL, '
+        'nhsid TEXT NOT NULL, '
+        'retrieved REAL NOT NULL)',
+    )
+
+    def __init__(self, path, ttl_hours=24 * 7, include_names=False, read_only=False):
+        self.ttl_hours = ttl_hours
+        self.include_names = include_names
+        self.read_only = read_only
+        super(LabKeyCache, self).__init__(path, create_tables=not read_only)
+        # A read-only cache can't create the table, so a file without it has nothing cached
+        self._empty = read_only and not self.has_table('demographics')
+
+    def get(self, participant_id):
+        """Return the cached (name, dob, nhsid) for a participant, or None if it is not cached or has expired.
+        """
+        rows = [] if self._empty else self.query(
+            'SELECT name, dob, nhsid FROM demographics WHERE participant_id = ? AND retrieved >= ?',
+            (str(participant_id), time.time() - self.ttl_hours * 3600)
+        )
+        self.count(hit=bool(rows))
+        if not rows:
+            return None
+        name, dob, nhsid = rows[0]
+        return (name or '', dob, nhsid)
+
+    def put(self, participant_id, name, dob, nhsid):
+        """Store the demographics retrieved from LabKey for a participant.
+        """
+        if self.read_only:
+            return
+        self.write(
+            'INSERT OR REPLACE INTO demographics (participant_id, name, dob, nhsid, retrieved) VALUES (?, ?, ?, ?, ?)',
+            (str(participant_id), name if self.include_names else None, dob, nhsid, time.time())
+        )
+
+    def invalidate(self, participant_ids=None):
+        """Remove cached records for the given participant IDs, or all cached records if participant_ids is None.
+        Returns:
+            Number of records removed
+        """
+        if self.read_only:
+            return 0
+        if participant_ids is None:
+            return self.write('DELETE FROM demographics')
+        return self.write(
+            'DELETE FROM demographics WHERE participant_id = ?',
+            [(str(participant_id),) for participant_id in participant_ids],
+            many=True
+        )
@@ -0,0 +1,119 @@
+"""
+report_index.py
+
+Index of the summary of findings PDFs saved in the technical reports folder, keyed by interpretation request ID.
+
+The technical reports folder holds thousands of files on an SMB share, so it is only listed again when the folder's
+modification time has changed, and the index is kept up to date with any summaries downloaded during the run. Reports
+found in the index are checked to still exist before they are returned. The index can optionally be cached on disk and
+reused by later runs as long as the folder's modification time hasn't changed.
+"""
+import os
+import re
+import json
+import threading
+
+class ReportIndex(object):
+    '''Index of summary of findings PDFs in a folder, mapping IRID (<id>-<version>) to candidate report filenames.
+
+    Reports are expected to be named Summary_of_Findings_<IRID>-<report version>.pdf, where report version is a
+    single character (matching the Summary_of_Findings_<IRID>-?.pdf search pattern).
+
+    Args:
+        folder: Folder containing summary of findings PDFs
+        cache_file: Optional JSON file used to reuse the index across runs
+    Methods:
+        find(irid): Returns list of report filenames for an IRID
+        add(filepath): Adds a report saved during the run to the index
+        refresh(): Rebuilds the index by listing the folder
+        refresh_if_changed(): Rebuilds the index if the folder has been modified since it was built
+    '''
+    # Case insensitive to match the behaviour of fnmatch on Windows
+    FILENAME_PATTERN = re.compile(r'^Summary_of_Findings_(\d+-\d+)-.\.pdf$', re.IGNORECASE)
+
+    def __init__(self, folder, cache_file=None):
+        self.folder = folder
+        self.cache_file = cache_file
+        self.reports = {}
+        self.folder_mtime = None
+        self._lock = threading.Lock()
+        if not (self.cache_file and self._load_cache()):
+            self.refresh()
+
+    def _add_filename(self, filename):
+        match = self.FILENAME_PATTERN.match(filename)
+        if match:
+            filenames = self.reports.setdefault(match.group(1), [])
+            if filename not in filenames:
+                filenames.append(filename)
+                filenames.sort()
+
+    def refresh(self):
+        """Rebuild the index by listing the folder, and save to the cache file if there is one.
+        """
+        with self._lock:
+            # Record the folder modification time before listing, so that any change made while listing is picked up next time
+            folder_mtime = os.stat(self.folder).st_mtime
+            self.reports = {}
+            for filename in os.listdir(self.folder):
+                self._add_filename(filename)
+            self.folder_mtime = folder_mtime
+            if self.cache_file:
+                self._save_cache()
+
+    def refresh_if_changed(self):
+        """Rebuild the index if the folder's modification time has changed since it was built.
+        Returns:
+            Boolean: True if the index was rebuilt
+        """
+        if os.stat(self.folder).st_mtime == self.folder_mtime:
+            return False
+        self.refresh()
+        return True
+
+    def _load_cache(self):
+        """Load the index from the cache file if it exists and was built from the current state of the folder.
+        Returns:
+            Boolean: True if the index was loaded from the cache file
+        """
+        try:
+            with open(self.cache_file) as cache:
+                cached = json.load(cache)
+        except (IOError, ValueError):
+            return False
+        if cached.get('folder') != self.folder or cached.get('folder_mtime') != os.stat(self.folder).st_mtime:
+            return False
+        self.reports = cached['reports']
+        self.folder_mtime = cached['folder_mtime']
+        return True
+
+    def _save_cache(self):
+        """Write the index to the cache file, via a temporary file so that a partially written cache is never read.
+        """
+        temp_cache_file = self.cache_file + '.tmp'
+        with open(temp_cache_file, 'w') as cache:
+            json.dump({'folder': self.folder, 'folder_mtime': self.folder_mtime, 'reports': self.reports}, cache)
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+        os.rename(temp_cache_file, self.cache_file)
+
+    def find(self, irid):
+        """Return a sorted list of report filenames for the IRID.
+        If none are indexed, the folder is listed again if it has been modified since the index was built. If any
+        indexed report no longer exists (e.g. it was deleted or replaced by another version), the folder is always
+        listed again, as the folder's modification time may not have changed on the share.
+        """
+        filenames = self.reports.get(irid)
+        if filenames and not all(os.path.exists(os.path.join(self.folder, filename)) for filename in filenames):
+            self.refresh()
+            filenames = self.reports.get(irid)
+        elif not filenames and self.refresh_if_changed():
+            filenames = self.reports.get(irid)
+        return list(filenames or [])
+
+    def add(self, filepath):
+        """Add a report saved to the folder during the run (e.g. by SummaryFindings_SSH) to the index.
+        """
+        if os.path.normcase(os.path.dirname(os.path.abspath(filepath))) == os.path.normcase(os.path.abspath(self.folder)):
+            with self._lock:
+                self._add_filename(os.path.basename(filepath))
@@ -0,0 +1,140 @@
+"""
+resilience.py
+
+Error types, retries and circuit breakers for calls to remote services (GENAPP01, Moka and Geneworks).
+
+Failures that may succeed if the call is repeated (timeouts, dropped connections, incomplete transfers) are raised
+as TransientError. retry_call() repeats idempotent calls that raise TransientError, waiting for a random (jittered)
+exponential backoff between attempts so that concurrent workers don't retry in step. A CircuitBreaker shared by all
+calls to a service stops calling it after repeated transient failures, so that the rest of the run fails fast rather
+than waiting for every call to time out.
+"""
+import time
+import random
+import threading
+
+class RemoteCallError(Exception):
+    '''A call to a remote service failed'''
+
+class TransientError(RemoteCallError):
+    '''A call to a remote service failed in a way that may succeed if it is repeated (e.g. a timeout)'''
+
+class CircuitOpenError(RemoteCallError):
+    '''A call to a remote service wasn't attempted because its circuit breaker is open'''
+
+class CircuitBreaker(object):
+    '''Stops calls to a service after repeated transient failures.
+
+    The breaker opens after failure_threshold consecutive TransientErrors. While open, calls fail immediately with
+    CircuitOpenError. Once reset_timeout seconds have passed, the next call is let through as a trial: the breaker
+    closes if it succeeds and opens again if it fails. Other calls made while the trial is in progress still fail with
+    CircuitOpenError, so that a service that is still down is only called once.
+
+    Args:
+        name: Name of the service, used in error messages
+        failure_threshold: Number of consecutive transient failures that open the breaker
+        reset_timeout: Seconds the breaker stays open before a trial call is allowed
+    Attributes:
+        failures: Number of consecutive transient failures
+        opened: Number of times the breaker has opened
+    Methods:
+        call(func, *args, **kwargs): Calls func through the breaker and returns its result
+    '''
+    def __init__(self, name, failure_threshold=5, reset_timeout=300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = None
+        # True while the trial call after reset_timeout is in progress
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        """
+        Raises CircuitOpenError if the call shouldn't be made. Returns True if the call is the trial call.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.time() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("{name} unavailable after {failures} consecutive failures. Not retrying for {seconds:.0f} seconds.".format(
+                    name=self.name,
+                    failures=self.failures,
+                    seconds=self.reset_timeout - (time.time() - self._opened_at)
+                    ))
+            if self._trial:
+                raise CircuitOpenError("{name} unavailable after {failures} consecutive failures. Waiting for a trial call to finish.".format(
+                    name=self.name,
+                    failures=self.failures
+                    ))
+            self._trial = True
+            return True
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self._opened_at = None
+            else:
+                self.failures += 1
+                # Open the breaker, or re-open it if a trial call failed
+                if self.failures >= self.failure_threshold:
+                    if self._opened_at is None:
+                        self.opened += 1
+                    self._opened_at = time.time()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) unless the breaker is open, recording whether it raised a TransientError
+        """
+        trial = self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except TransientError:
+            self._record(success=False)
+            raise
+        else:
+            self._record(success=True)
+        finally:
+            # Let another call through as the trial if this one raised an error that isn't recorded
+            if trial:
+                with self._lock:
+                    self._trial = False
+        return result
+
+    def __str__(self):
+        return "{name} circuit breaker: opened {opened} times".format(name=self.name, opened=self.opened)
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    """
+    Returns a random delay of up to base_delay * 2^(attempt - 1) seconds (capped at max_delay) to wait before retrying
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+def retry_call(func, attempts=3, base_delay=1.0, max_delay=30.0, description=None, log=None):
+    """
+    Calls func, repeating it up to attempts times in total if it raises a TransientError, with jittered exponential
+    backoff between attempts. Only use for idempotent calls. CircuitOpenError and other exceptions are not retried.
+    If log is given, it is called with a message before each retry.
+    Returns the result of func. Raises the last TransientError if every attempt fails.
+    """
+    attempt = 1
+    while True:
+        try:
+            return func()
+        except TransientError as e:
+            if attempt >= attempts:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            if log is not None:
+                log("INFO\tRetrying {description} in {delay:.1f}s (attempt {attempt} of {attempts} failed: {error})".format(
+                    description=description or 'call',
+                    delay=delay,
+                    attempt=attempt,
+                    attempts=attempts,
+                    error=e
+                    ))
+            time.sleep(delay)
+            attempt += 1
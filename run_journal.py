@@ -0,0 +1,72 @@
+"""
+run_journal.py
+
+Local journal recording which stages of gel_cover_report.py have completed for each NGSTestID and interpretation
+request, so that a rerun after a failure can skip work that has already been done.
+
+The journal is a SQLite database. Each completed stage is committed as soon as it is recorded, so the journal is
+up to date even if the run stops part way through.
+"""
+import datetime
+from sqlite_store import SqliteStore
+
+class RunJournal(SqliteStore):
+    '''Journal of completed stages for each NGSTestID/IRID.
+
+    Args:
+        path: Path to SQLite database file. Created if it doesn't exist.
+    Methods:
+        record(ngs_test_id, irid, stage, detail): Records that a stage has completed
+        is_done(ngs_test_id, irid, stage): Returns True if a stage has completed
+        get_detail(ngs_test_id, irid, stage): Returns the detail recorded for a completed stage
+        close(): Closes the journal
+    '''
+    # Stages recorded for each test, in the order they are run. 'validated' is only recorded once the test's
+    # demographics have been checked against LabKey.
+    STAGES = (
+        'validated',
+        'exit_q_submitted',
+        'summary_downloaded',
+        'merged',
+        'moka_updated',
+        'charged',
+        'emailed',
+    )
+    # One row for each stage completed by each test
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS stages ('
+        'ngs_test_id INTEGER NOT NULL, '
+        'irid TEXT NOT NULL, '
+        'stage TEXT NOT NULL, '
+        'completed TEXT NOT NULL, '
+        'detail TEXT, '
+        'PRIMARY KEY (ngs_test_id, irid, stage))',
+    )
+
+    def record(self, ngs_test_id, irid, stage, detail=None):
+        """Record that a stage has completed for a test, with an optional detail (e.g. the path of a file created).
+        """
+        if stage not in self.STAGES:
+            raise ValueError("Unknown stage {stage}".format(stage=stage))
+        self.write(
+            'INSERT OR REPLACE INTO stages (ngs_test_id, irid, stage, completed, detail) VALUES (?, ?, ?, ?, ?)',
+            (ngs_test_id, irid, stage, datetime.datetime.now().isoformat(), None if detail is None else str(detail))
+        )
+
+    def _get(self, ngs_test_id, irid, stage):
+        rows = self.query(
+            'SELECT detail FROM stages WHERE ngs_test_id = ? AND irid = ? AND stage = ?',
+            (ngs_test_id, irid, stage)
+        )
+        return rows[0] if rows else None
+
+    def is_done(self, ngs_test_id, irid, stage):
+        """Return True if the stage has been recorded as completed for the test.
+        """
+        return self._get(ngs_test_id, irid, stage) is not None
+
+    def get_detail(self, ngs_test_id, irid, stage):
+        """Return the detail recorded when the stage was completed, or None.
+        """
+        row = self._get(ngs_test_id, irid, stage)
+        return row[0] if row else None
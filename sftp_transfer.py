@@ -0,0 +1,224 @@
+#!/usr/bin/env python2
+"""
+sftp_transfer.py
+
+Copies files from the Viapath GENAPP01 server with SFTP, using the SSH session shared by the other scripts.
+
+Reads are pipelined: up to WINDOW read requests of BLOCK_SIZE bytes are sent before waiting for the first reply,
+so a transfer isn't limited to one block per round trip. Data is written to a .partial file next to the local
+path. If a transfer fails part way through, the next attempt resumes from the end of the .partial file instead of
+starting again. Once all bytes have been received, the file's SHA-256 is compared with one calculated on the server
+(with sha256sum), and the .partial file is only renamed to the local path if they match. The window can be set in
+the GENAPP01 section of the config file (TRANSFER_WINDOW).
+
+Requirements:
+    Python 2.7
+    paramiko (via genapp_session)
+
+usage: sftp_transfer.py [-h] [--window N] [--no_resume] [--no_verify]
+                        [--timings FILE] [--profile]
+                        remote_path local_path
+
+Copies a file from GENAPP01 with pipelined SFTP reads, resuming partial
+downloads and verifying the server's SHA-256 checksum
+
+positional arguments:
+  remote_path     Path of the file on GENAPP01
+  local_path      Local path to copy the file to
+
+optional arguments:
+  -h, --help      show this help message and exit
+  --window N      Number of SFTP read requests in flight at once (default 16)
+  --no_resume     Optional flag to start again instead of resuming from an
+                  existing .partial file
+  --no_verify     Optional flag to skip checking the file against a SHA-256
+                  checksum calculated on the server
+  --timings FILE  Optional file to write timing spans to as JSON lines ('-'
+                  for stderr)
+  --profile       Optional flag to print a table of time spent in each stage
+"""
+import os
+import sys
+import time
+import pipes
+import hashlib
+import argparse
+from app_config import get_number
+from genapp_session import get_session, close_sessions
+from resilience import RemoteCallError, TransientError
+import timing
+
+# Defaults for the number of read requests in flight and the size of each request. 32768 bytes is the largest read
+# request paramiko sends.
+WINDOW = 16
+BLOCK_SIZE = 32768
+
+class SftpTransfer(object):
+    '''Copies a file from the server with pipelined SFTP reads, resuming from a partial download and verifying the
+    file against a SHA-256 checksum calculated on the server.
+
+    Args:
+        session: GenappSession to use. Defaults to the session shared by the current thread.
+        window: Number of read requests in flight at once. Defaults to GENAPP01 TRANSFER_WINDOW from config file if
+            set, otherwise WINDOW.
+        block_size: Number of bytes requested by each read
+        resume: If True, a .partial file left by an earlier attempt is resumed from its end
+        verify: If True, the file is checked against a SHA-256 checksum calculated on the server
+    Attributes:
+        total_bytes: Size of the file on the server
+        transferred_bytes: Number of bytes copied by the last call to get()
+        resumed_from: Number of bytes already in the .partial file when the last transfer started
+        seconds: Time taken by the last call to get()
+        sha256: SHA-256 checksum of the copied file
+    Methods:
+        get(remotepath, localpath): Copies a file from the server. Returns the number of bytes copied.
+        throughput(): Returns the transfer rate of the last call to get() in bytes per second
+    '''
+    def __init__(self, session=None, window=None, block_size=BLOCK_SIZE, resume=True, verify=True):
+        self.session = session or get_session()
+        self.window = window or get_number("GENAPP01", "TRANSFER_WINDOW", WINDOW)
+        self.block_size = block_size
+        self.resume = resume
+        self.verify = verify
+        self.remotepath = None
+        self.total_bytes = None
+        self.transferred_bytes = 0
+        self.resumed_from = 0
+        self.seconds = 0.0
+        self.sha256 = None
+
+    def get(self, remotepath, localpath):
+        """Copy remotepath on the server to localpath, replacing any existing file.
+        Returns:
+            Number of bytes copied (excluding any resumed from a partial file)
+        Raises:
+            TransientError: If the connection fails, an SFTP request times out, or the checksum of the copied file
+                doesn't match the server's. The .partial file is kept so that the next attempt can resume, unless the
+                checksum didn't match.
+            RemoteCallError: If the file can't be read or its checksum can't be calculated on the server
+            CircuitOpenError: If GENAPP01 has failed repeatedly
+        """
+        self.remotepath = remotepath
+        self.transferred_bytes = 0
+        start = time.time()
+        partial_path = localpath + '.partial'
+        if not self.resume and os.path.exists(partial_path):
+            os.remove(partial_path)
+        self.session.call(lambda: self._copy(remotepath, partial_path), 'copying {remotepath}'.format(remotepath=remotepath))
+        if self.verify:
+            expected = self.server_sha256(remotepath)
+            # A resumed file may have been started from an earlier version of the remote file, so copy the whole
+            # file again before reporting a mismatch. The .partial file is removed first so that the corrupt copy
+            # can't be resumed, and the byte count restarts so that only the full copy is reported.
+            if self.sha256 != expected and self.resumed_from:
+                os.remove(partial_path)
+                self.transferred_bytes = 0
+                start = time.time()
+                self.session.call(lambda: self._copy(remotepath, partial_path), 'copying {remotepath}'.format(remotepath=remotepath))
+            if self.sha256 != expected:
+                # Remove the corrupt copy before the error is raised, so that a retry starts again from the beginning
+                os.remove(partial_path)
+                raise TransientError("Checksum of transferred file {sha256} does not match server checksum {expected}".format(
+                        sha256=self.sha256,
+                        expected=expected
+                    )
+                )
+        # Replace any existing file at the local path
+        if os.path.exists(localpath):
+            os.remove(localpath)
+        os.rename(partial_path, localpath)
+        self.seconds = time.time() - start
+        return self.transferred_bytes
+
+    def _copy(self, remotepath, partial_path):
+        """Append the rest of the remote file to the partial file, calculating the checksum of the whole file.
+        """
+        sftp = self.session.open_sftp()
+        try:
+            self.total_bytes = sftp.stat(remotepath).st_size
+        except IOError as e:
+            # The file doesn't exist or can't be read, which won't be fixed by retrying
+            raise RemoteCallError("Unable to copy {remotepath}: {error}".format(remotepath=remotepath, error=e.strerror or e))
+        sha256 = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_path):
+            # Start again if the partial file is larger than the remote file, otherwise include it in the checksum
+            if os.path.getsize(partial_path) <= self.total_bytes:
+                with open(partial_path, 'rb') as partial:
+                    for data in iter(lambda: partial.read(1024 * 1024), ''):
+                        sha256.update(data)
+                        offset += len(data)
+            else:
+                os.remove(partial_path)
+        self.resumed_from = offset
+        with sftp.open(remotepath, 'rb') as remote:
+            with open(partial_path, 'ab') as partial:
+                while offset < self.total_bytes:
+                    # Request the next window of blocks at once. readv() sends every request before reading the first reply.
+                    chunks = []
+                    while len(chunks) < self.window and offset < self.total_bytes:
+                        chunks.append((offset, min(self.block_size, self.total_bytes - offset)))
+                        offset += chunks[-1][1]
+                    for (chunk_offset, length), data in zip(chunks, remote.readv(chunks)):
+                        # Error if the file was truncated on the server during the transfer
+                        if len(data) != length:
+                            raise TransientError("Incomplete file transfer. {transferred} out of {total} bytes".format(
+                                    transferred=chunk_offset + len(data),
+                                    total=self.total_bytes
+                                )
+                            )
+                        partial.write(data)
+                        sha256.update(data)
+                        self.transferred_bytes += len(data)
+        self.sha256 = sha256.hexdigest()
+
+    def server_sha256(self, remotepath):
+        """Return the SHA-256 checksum of a file, calculated on the server.
+        """
+        stdout, stderr = self.session.exec_command('sha256sum {path}'.format(path=pipes.quote(remotepath)))
+        # If an error was encountered, raise it with the error message
+        if stderr or not stdout:
+            raise RemoteCallError(stderr or "No checksum returned for {remotepath}".format(remotepath=remotepath))
+        return stdout.split()[0]
+
+    def throughput(self):
+        """Return the transfer rate of the last call to get() in bytes per second.
+        """
+        return self.transferred_bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "Copied {remotepath}: {transferred} bytes{resumed} in {seconds:.2f}s ({rate:.2f} MB/s)".format(
+            remotepath=self.remotepath,
+            transferred=self.transferred_bytes,
+            resumed=' (resumed from {offset})'.format(offset=self.resumed_from) if self.resumed_from else '',
+            seconds=self.seconds,
+            rate=self.throughput() / (1024 * 1024)
+            )
+
+def main():
+    # Define and capture arguments.
+    parser = argparse.ArgumentParser(description='Copies a file from GENAPP01 with pipelined SFTP reads, resuming partial downloads and verifying the server\'s SHA-256 checksum')
+    parser.add_argument('remote_path', help='Path of the file on GENAPP01')
+    parser.add_argument('local_path', help='Local path to copy the file to')
+    parser.add_argument('--window', metavar='N', type=int, help='Number of SFTP read requests in flight at once (default {window})'.format(window=WINDOW))
+    parser.add_argument('--no_resume', action='store_true', help='Optional flag to start again instead of resuming from an existing .partial file')
+    parser.add_argument('--no_verify', action='store_true', help='Optional flag to skip checking the file against a SHA-256 checksum calculated on the server')
+    parser.add_argument('--timings', metavar='FILE', help='Optional file to write timing spans to as JSON lines (\'-\' for stderr)')
+    parser.add_argument('--profile', action='store_true', help='Optional flag to print a table of time spent in each stage')
+    parsed_args = parser.parse_args()
+    timing.configure(parsed_args.timings)
+    transfer = SftpTransfer(window=parsed_args.window, resume=not parsed_args.no_resume, verify=not parsed_args.no_verify)
+    try:
+        # Retry the transfer if it fails part way through, resuming from the bytes already copied
+        with timing.span('sftp_transfer'):
+            transfer.session.retry(lambda: transfer.get(parsed_args.remote_path, parsed_args.local_path), 'file transfer')
+        print("INFO\t{transfer}".format(transfer=transfer))
+    except RemoteCallError as e:
+        sys.exit(str(e))
+    finally:
+        close_sessions()
+        if parsed_args.profile:
+            print(timing.summary_table())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+sql_statements.py
+
+Registry of the named SQL statements gel_cover_report.py runs against Moka and Geneworks.
+
+Every statement uses ? placeholders for its values, so the SQL text sent to SQL Server is the same whichever
+NGSTestIDs, PRUs or dates it is run for. The server compiles each statement once and reuses the cached plan, and
+pyodbc reuses the prepared statement while the same text is executed repeatedly on a cursor.
+
+The names of the Geneworks views are read from the GENEWORKS section of config.ini (PATIENT_VIEW, SPECIMEN_VIEW,
+TEST_VIEW, DNATESTREQUEST_VIEW and DNANUMBER_VIEW) and substituted for the {patient_view} etc. markers in the
+Geneworks statements. There are no defaults: the views must have the same columns as the gwv-*linked views in Moka,
+and a ValueError is raised when a Geneworks statement is needed and a view name isn't set.
+
+Statements that look up a list of values contain an {in_list} marker. in_list() expands it to a number of
+placeholders rounded up to a power of two, padding the values by repeating the last one (which doesn't change the
+rows matched), so a query only ever has a handful of distinct texts however many values it is run for.
+"""
+from app_config import get_config
+
+# Markers for the Geneworks views used by the statements, and the GENEWORKS config options holding their names
+GENEWORKS_VIEWS = {
+    'patient_view': 'PATIENT_VIEW',
+    'specimen_view': 'SPECIMEN_VIEW',
+    'test_view': 'TEST_VIEW',
+    'dnatestrequest_view': 'DNATESTREQUEST_VIEW',
+    'dnanumber_view': 'DNANUMBER_VIEW',
+}
+
+# Named statements, with ? placeholders for all values
+STATEMENTS = {
+    # Moka. 1189679668 is the negneg result code. StatusID 4 is complete.
+    'moka_ready_tests': (
+        'SELECT NGSTest.NGSTestID, NGSTest.IRID FROM NGSTest '
+        'WHERE NGSTest.ResultCode = 1189679668 AND (NGSTest.BlockAutomatedReporting = 0 OR NGSTest.BlockAutomatedReporting IS NULL) '
+        'AND NGSTest.IRID IS NOT NULL AND NGSTest.IRID <> \'\' AND NGSTest.StatusID <> 4 '
+        'AND NOT EXISTS (SELECT NGSTestFile.NGSTestID FROM NGSTestFile WHERE NGSTestFile.NGSTestID = NGSTest.NGSTestID AND NGSTestFile.Description = \'100k Results\') '
+        'ORDER BY NGSTest.NGSTestID;'
+        ),
+    'moka_test_data': (
+        'SELECT NGSTest.NGSTestID, NGSTest.BlockAutomatedReporting, NGSTest.InternalPatientID, NGSTest.ResultCode, Checker.Name AS clinician_name, Checker.ReportEmail, Item_Address.Item AS clinician_address, '
+        'Patients.PatientID, NGSTest.GELProbandID, NGSTest.IRID, Patients.s_StatusOverall '
+        'FROM ((NGSTest INNER JOIN Patients ON NGSTest.InternalPatientID = Patients.InternalPatientID) '
+        'INNER JOIN Checker ON NGSTest.BookBy = Checker.Check1ID) '
+        'INNER JOIN Item AS Item_Address ON Checker.Address = Item_Address.ItemID '
+        'WHERE NGSTestID IN ({in_list});'
+        ),
+    'ngstestfile_insert': (
+        "INSERT INTO NGSTestFile (NGSTestID, Description, NGSTestFile, DateAdded) "
+        "VALUES (?, '100k Results', ?, ?);"
+        ),
+    'ngstest_update': (
+        "UPDATE n SET n.Check2ID = c.Check1ID, n.Check2Date = ?, n.Check3ID = c.Check1ID, n.Check3Date = ?, n.Check4ID = c.Check1ID, n.Check4Date = ?, n.StatusID = 4 "
+        "FROM NGSTest AS n, Checker AS c WHERE c.UserName = ? AND n.NGSTestID = ?;"
+        ),
+    'patients_update': (
+        "UPDATE Patients SET Patients.s_StatusOverall = 4 WHERE InternalPatientID = ?;"
+        ),
+    'patientlog_insert': (
+        "INSERT INTO PatientLog (InternalPatientID, LogEntry, Date, Login, PCName) "
+        "VALUES (?, ?, ?, ?, ?);"
+        ),
+    # Geneworks
+    'geneworks_patients': (
+        'SELECT patient.PatientTrustID, patient.FirstName, patient.LastName, patient.DoB, patient.Gender, patient.NHSNo '
+        'FROM "{patient_view}" AS patient WHERE patient.PatientTrustID IN ({in_list});'
+        ),
+    # DisorderID 60 is 'Whole Genome Sequencing'
+    # TestDescriptionID 18 is 'GeL'
+    # There can be multiple specimens/tests per patient with these Disorder and TestDescriptionIDs, (where the omics samples that are stored have also had these tests added)
+    # Therefore need to select the sample that has actually had DNA extracted, hence the inner join to the dnanumber view.
+    'geneworks_gel_tests': (
+        'SELECT patient.PatientTrustID, test.TestID, specimen.SpecimenTrustID '
+        'FROM ("{dnatestrequest_view}" AS dnatestrequest INNER JOIN (("{test_view}" AS test INNER JOIN "{specimen_view}" AS specimen ON test.SpecimenID = specimen.SpecimenID) '
+        'INNER JOIN "{patient_view}" AS patient ON specimen.PatientID = patient.PatientID) ON dnatestrequest.TestID = test.TestID) '
+        'INNER JOIN "{dnanumber_view}" AS dnanumber ON specimen.SpecimenID = dnanumber.SpecimenID '
+        'WHERE patient.PatientTrustID IN ({in_list}) AND dnatestrequest.DisorderID = 60 AND dnatestrequest.TestDescriptionID = 18;'
+        ),
+    # spInsertLabReportCostDetail, with the record number of the new charge selected from its output parameter.
+    # Parameters are (SpecimenNo, TestType, Cost, TestID).
+    # Necessary to use SET NOCOUNT ON to prevent 'pyodbc.ProgrammingError: No results.  Previous SQL was not a query.' error, see:
+    # https://stackoverflow.com/questions/7753830/mssql2008-pyodbc-previous-sql-was-not-a-query
+    'geneworks_insert_charge': (
+        'SET NOCOUNT ON; '
+        'DECLARE @return_value int, @RecordNo int, @timestamp datetime; '
+        'SET @timestamp = getdate(); '
+        'EXEC @return_value = [dbo].[spInsertLabReportCostDetail] '
+        '@SpecimenNo = ?, '
+        '@CostTypeID = NULL, '
+        '@Destination = NULL, '
+        '@DateReported = @timestamp, '
+        '@TestType = ?, '
+        '@Cost = ?, '
+        '@DNAUnitsSample = NULL, '
+        '@DNAUnitsAnalysis = NULL, '
+        '@DNAUnitsReport = NULL, '
+        '@DNAUnitsTotal = 1, '
+        '@CytoUnits = NULL, '
+        '@EnteredByID = 888, ' # This is the user 'moka' in geneworks
+        '@PCRFee = NULL, '
+        '@TestID = ?, '
+        '@RecordNo = @RecordNo OUTPUT; '
+        'SELECT @RecordNo AS record_no;'
+        ),
+}
+
+def view_names():
+    """
+    Returns a dictionary of the Geneworks view names to substitute into the statements, from config.ini.
+    Raises ValueError if any of the names aren't set.
+    """
+    config = get_config()
+    missing = sorted(option for option in GENEWORKS_VIEWS.values() if not config.has_option('GENEWORKS', option))
+    if missing:
+        raise ValueError("Geneworks view names not set in the GENEWORKS section of config.ini: {options} (see example_config.ini)".format(
+            options=', '.join(missing)
+            ))
+    return dict((marker, config.get('GENEWORKS', option)) for marker, option in GENEWORKS_VIEWS.items())
+
+def _format(name, **values):
+    """
+    Returns the SQL for a named statement with the supplied values substituted, and the Geneworks view names if it
+    queries Geneworks views
+    """
+    sql = STATEMENTS[name]
+    if any('{' + marker + '}' in sql for marker in GENEWORKS_VIEWS):
+        values.update(view_names())
+    return sql.format(**values)
+
+def get(name):
+    """
+    Returns the SQL for a named statement
+    """
+    return _format(name)
+
+def in_list(name, values):
+    """
+    Returns (sql, params) for a named statement containing an {in_list} marker, to look up all the supplied values
+    (at least one).
+    The number of placeholders is rounded up to the next power of two and the values are padded to match by
+    repeating the last value.
+    """
+    values = list(values)
+    size = 1
+    while size < len(values):
+        size *= 2
+    params = values + values[-1:] * (size - len(values))
+    return _format(name, in_list=', '.join(['?'] * size)), params
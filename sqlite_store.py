@@ -0,0 +1,106 @@
+"""
+sqlite_store.py
+
+Base classes for the local SQLite files written by gel_cover_report.py: the run journal, the LabKey cache and the
+summary of findings cache index.
+
+Each file is opened with a single connection, which is shared by the worker threads. The sqlite3 module doesn't allow
+a connection to be used from two threads at once, so every statement is run while holding the store's lock.
+SqliteCache also counts cache hits and misses, under the same lock.
+"""
+import sqlite3
+import threading
+
+class SqliteStore(object):
+    '''SQLite database file with one connection shared by all threads.
+
+    Args:
+        path: Path to SQLite database file. Created if it doesn't exist.
+        create_tables: If False, the tables in SCHEMA aren't created (e.g. if the file is only read)
+    Attributes:
+        SCHEMA: CREATE TABLE IF NOT EXISTS statements for the store's tables, set by each subclass
+    Methods:
+        query(sql, params): Runs a query and returns all rows
+        write(sql, params, many): Runs a statement (or executemany), commits and returns the number of rows changed
+        has_table(name): Returns True if the table exists
+        close(): Closes the connection
+    '''
+    SCHEMA = ()
+
+    def __init__(self, path, create_tables=True):
+        self.path = path
+        self._cnxn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        if create_tables:
+            with self._lock:
+                for sql in self.SCHEMA:
+                    self._cnxn.execute(sql)
+                self._cnxn.commit()
+
+    def query(self, sql, params=()):
+        """Run a query and return all rows.
+        """
+        with self._lock:
+            return self._cnxn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=(), many=False):
+        """Run a statement, or run it for each of a list of parameter tuples if many is True, and commit.
+        Returns:
+            Number of rows changed
+        """
+        with self._lock:
+            if many:
+                rowcount = self._cnxn.executemany(sql, params).rowcount
+            else:
+                rowcount = self._cnxn.execute(sql, params).rowcount
+            self._cnxn.commit()
+        return rowcount
+
+    def has_table(self, name):
+        """Return True if the database has a table with the given name.
+        """
+        return bool(self.query("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)))
+
+    def close(self):
+        with self._lock:
+            self._cnxn.close()
+
+class SqliteCache(SqliteStore):
+    '''SqliteStore that counts the lookups served from the cache.
+
+    Args:
+        path: Path to SQLite database file. Created if it doesn't exist.
+        create_tables: If False, the tables in SCHEMA aren't created (e.g. if the file is only read)
+    Attributes:
+        NAME: Name of the cache used when reporting the counts, set by each subclass
+        hits: Number of lookups served from the cache
+        misses: Number of lookups not served from the cache
+    Methods:
+        count(hit): Adds a lookup to the hits or misses
+        reset_counts(): Sets the hits and misses back to zero
+    '''
+    NAME = 'Cache'
+
+    def __init__(self, path, create_tables=True):
+        super(SqliteCache, self).__init__(path, create_tables=create_tables)
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit):
+        """Add a lookup to the hits if hit is True, otherwise to the misses.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def reset_counts(self):
+        """Set the hits and misses back to zero, e.g. at the start of each poll in watch mode.
+        """
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def __str__(self):
+        return "{name}: {hits} hits, {misses} misses".format(name=self.NAME, hits=self.hits, misses=self.misses)
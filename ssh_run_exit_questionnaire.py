@@ -2,9 +2,10 @@
 """
 Requirements:
     Python 2.7
-    paramiko
+    paramiko (via genapp_session)
 
 usage: ssh_run_exit_questionnaire.py [-h] --ir_id IR_ID --user USER
+                                     [--timings FILE] [--profile]
 
 Submits a negneg clinical report and exit questionnaire for given
 interpretation request
@@ -13,63 +14,64 @@ optional arguments:
   -h, --help     show this help message and exit
   --ir_id IR_ID  Interpretation request ID with version (e.g. 12345-1)
   --user USER    cip-api username
+  --timings FILE  Optional file to write timing spans to as JSON lines ('-'
+                  for stderr)
+  --profile       Optional flag to print a table of time spent in each stage
 """
-import os
 import sys
 import argparse
 import datetime
-from ConfigParser import ConfigParser
-import paramiko
-
-# Read config file (must be called config.ini and stored in same directory as script)
-config = ConfigParser()
-config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"))
+from genapp_session import get_session, close_sessions
+from resilience import RemoteCallError
+import timing
 
 class ExitQuestionnaire_SSH():
     '''
     Call summary_findings.py on the Viapath GENAPP01 server via ssh and transfer the PDF.
     '''
-    def __init__(self, ir_id, user):
+    def __init__(self, ir_id, user, session=None):
         self.ir_id = ir_id
         self.user = user
-        self.ssh_host = config.get("GENAPP01", "SERVER")
-        self.ssh_user = config.get("GENAPP01", "USER")
-        self.ssh_pwd = config.get("GENAPP01", "PASSWORD")
+        # Use the SSH session shared by the whole process unless one is supplied
+        self.session = session or get_session()
         self.submit_exit_questionnaire()
     
     def submit_exit_questionnaire(self):
         """Call summary_findings.py on the server with input details.
         """
-        # Set up paramiko SSH client
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(self.ssh_host, username=self.ssh_user, password=self.ssh_pwd)
         command = "/home/mokaguys/miniconda2/envs/jellypy_py3/bin/python /home/mokaguys/Apps/100K_exit_questionnaire/exit_questionnaire.py -i {ir_id} -r {user} -d {date}".format(
                 ir_id=self.ir_id,
                 user=self.user,
                 date=datetime.datetime.now().strftime(r'%Y-%m-%d')
             )
-        # Execute command to submit clinical report and exit questionnaire on the server
-        stdin, stdout, stderr = client.exec_command(command)
-        # Call .read() on paramiko StderrFile object 
-        # (Just printing the stderr instead of calling .read() was causing this issue:
-        # https://stackoverflow.com/questions/20951690/paramiko-ssh-exec-command-to-collect-output-says-open-channel-in-response)        
-        stderr = stderr.read()
-        client.close()
-        # If an error was encountered, print error message and exit
+        # Execute command to submit clinical report and exit questionnaire on the server.
+        # Submission isn't idempotent, so it isn't retried if GENAPP01 times out.
+        with timing.span('exit_questionnaire', ir_id=self.ir_id):
+            stdout, stderr = self.session.exec_command(command)
+        # If an error was encountered, raise it with the error message
         if stderr:
-            sys.exit(stderr)
+            raise RemoteCallError(stderr)
     
 def main():
     # Define and capture arguments.
     parser = argparse.ArgumentParser(description='Submits a negneg clinical report and exit questionnaire for given interpretation request')
     parser.add_argument('--ir_id', required=True, help='Interpretation request ID with version (e.g. 12345-1)')
     parser.add_argument('--user', required=True, help='cip-api username')
+    parser.add_argument('--timings', metavar='FILE', help='Optional file to write timing spans to as JSON lines (\'-\' for stderr)')
+    parser.add_argument('--profile', action='store_true', help='Optional flag to print a table of time spent in each stage')
     parsed_args = parser.parse_args()
-    s = ExitQuestionnaire_SSH(
-        ir_id=parsed_args.ir_id,
-        user=parsed_args.user
-        )
+    timing.configure(parsed_args.timings)
+    try:
+        s = ExitQuestionnaire_SSH(
+            ir_id=parsed_args.ir_id,
+            user=parsed_args.user
+            )
+    except RemoteCallError as e:
+        sys.exit(str(e))
+    finally:
+        close_sessions()
+        if parsed_args.profile:
+            print(timing.summary_table())
 
 if __name__ == '__main__':
     main()
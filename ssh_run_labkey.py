@@ -5,23 +5,49 @@ ssh_run_labkey.py
 Call LabKey.py on the Viapath GENAPP server via ssh. Requires a config file with SSH credentials.
 
 Usage:
-    ssh_run_labkey.py -i participant_id -c config_file
+    ssh_run_labkey.py -i participant_id [participant_id ...] [--cache FILE] [--ttl HOURS] [--invalidate]
+                      [--timings FILE] [--profile]
 """
-import os
 import sys
 import argparse
-from ConfigParser import ConfigParser
-import paramiko
+from pipes import quote
+from genapp_session import get_session, close_sessions
+from resilience import RemoteCallError
+from labkey_cache import LabKeyCache
+import timing
 
-# Read config file (must be called config.ini and stored in same directory as script)
-config = ConfigParser()
-config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"))
+# Python interpreter and LabKey script on GENAPP01
+LABKEY_PYTHON = "/home/mokaguys/miniconda2/envs/jellypy_py3/bin/python"
+LABKEY_SCRIPT = "/home/mokaguys/Apps/100k_check_labkey/LabKey.py"
+
+# Python 3 script sent to the interpreter on GENAPP01 via stdin to run LabKey.py for many participant IDs in a single
+# interpreter. Prints one tab-separated line per participant ID: <participant_id> <OK|ERROR> <LabKey.py stdout or error>
+LABKEY_BATCH_RUNNER = """
+import sys, io, runpy, contextlib
+script = sys.argv[1]
+for pid in sys.argv[2:]:
+    out, err = io.StringIO(), io.StringIO()
+    sys.argv = [script, '-i', pid]
+    try:
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            err.write(str(e.code))
+    except Exception as e:
+        err.write(repr(e))
+    status, text = ('ERROR', err.getvalue()) if err.getvalue() else ('OK', out.getvalue())
+    print('\\t'.join([pid, status, ' '.join(text.split('\\n')).strip()]))
+    sys.stdout.flush()
+"""
 
 class LabKey_SSH():
     '''Call LabKey.py on the Viapath GENAPP01 server via ssh.
 
     Args:
         participant_id: A GEL participant ID
+        session: Optional GenappSession to run the command on. Defaults to the session shared by the whole process.
+        cache: Optional LabKeyCache. If the participant is cached, LabKey is not called.
     Attributes:
         name: Patient Name
         dob: Patient date of birth in the format "DAY/MONTH/YEAR"
@@ -29,49 +55,191 @@ class LabKey_SSH():
     Methods:
         call_labkey_api(): Calls API on GENAPP using input details
     '''
-    def __init__(self, participant_id):
+    def __init__(self, participant_id, session=None, cache=None):
         self.participant_id = participant_id
-        self.ssh_host = config.get("GENAPP01", "SERVER")
-        self.ssh_user = config.get("GENAPP01", "USER")
-        self.ssh_pwd = config.get("GENAPP01", "PASSWORD")
-        self.raw_string = self.call_labkey_api()
-        # Remove newlines, flanking quote characters and separate into a list of variables
-        self.name, self.dob, self.nhsid = self.raw_string.rstrip('\n').strip("'").split(",")
+        self.session = session or get_session()
+        cached = cache.get(participant_id) if cache else None
+        if cached:
+            self.raw_string = ",".join(cached)
+            self.name, self.dob, self.nhsid = cached
+        else:
+            self.raw_string = self.call_labkey_api()
+            self.name, self.dob, self.nhsid = parse_labkey_output(self.raw_string)
+            if cache:
+                cache.put(participant_id, self.name, self.dob, self.nhsid)
     
     def call_labkey_api(self):
         """Call LabKey.py on the server with input details.
         Returns:
             A string form the stdout of the LabKey script - contains patient details.
         """
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(self.ssh_host, username=self.ssh_user, password=self.ssh_pwd)
-        # Send command
-        stdin, stdout, stderr = client.exec_command(
-            "/home/mokaguys/miniconda2/envs/jellypy_py3/bin/python /home/mokaguys/Apps/100k_check_labkey/LabKey.py -i {}".format(
-                self.participant_id
-            )
+        command = "{python} {script} -i {participant_id}".format(
+            python=LABKEY_PYTHON,
+            script=LABKEY_SCRIPT,
+            participant_id=quote(str(self.participant_id))
         )
-        # If an error was encountered, print error message and exit
-        stderr = stderr.read()
-        stdout = stdout.read()
-        client.close()
+        # Send command over the shared SSH session. LabKey lookups are read-only, so are retried if GENAPP01 times out.
+        with timing.span('labkey', participants=1):
+            stdout, stderr = self.session.retry(lambda: self.session.exec_command(command), 'LabKey')
+        # If an error was encountered, raise it with the error message
         if stderr:
-            sys.exit(stderr)
+            raise RemoteCallError(stderr)
         return stdout
         
     def __str__(self):
         return ",".join([self.name, self.dob, self.nhsid])
-    
+
+class LabKeyRecord(object):
+    '''Patient details returned by LabKey.py for a single participant.
+
+    Attributes:
+        participant_id: A GEL participant ID
+        name: Patient Name
+        dob: Patient date of birth in the format "DAY/MONTH/YEAR"
+        nhsid: Patient nhs id
+    '''
+    def __init__(self, participant_id, raw_string):
+        self.participant_id = participant_id
+        self.name, self.dob, self.nhsid = parse_labkey_output(raw_string)
+
+    def __str__(self):
+        return ",".join([self.name, self.dob, self.nhsid])
+
+class LabKeyBatch_SSH():
+    '''Call LabKey.py on the Viapath GENAPP01 server via ssh for many participants in a single remote invocation.
+
+    LabKey.py is run for every participant within one Python interpreter on the server, avoiding the interpreter
+    start-up cost for each participant. Errors are recorded per participant rather than exiting.
+
+    Args:
+        participant_ids: List of GEL participant IDs
+        session: Optional GenappSession to run the command on. Defaults to the session shared by the whole process.
+        chunk_size: Maximum number of participant IDs sent in each remote invocation
+        cache: Optional LabKeyCache. Only participants that aren't cached are sent to LabKey, and their results are
+            added to the cache.
+    Attributes:
+        records: Dictionary of LabKeyRecord objects keyed by participant ID
+        errors: Dictionary of error messages keyed by participant ID
+    Methods:
+        call_labkey_api_many(participant_ids): Calls API on GENAPP for a list of participant IDs
+    '''
+    def __init__(self, participant_ids, session=None, chunk_size=200, cache=None):
+        # Remove duplicates, preserving order
+        self.participant_ids = []
+        for participant_id in participant_ids:
+            if str(participant_id) not in self.participant_ids:
+                self.participant_ids.append(str(participant_id))
+        self.session = session or get_session()
+        self.records = {}
+        self.errors = {}
+        self.cache = cache
+        # Use cached demographics where available, so that only uncached participants are sent to LabKey
+        uncached_ids = []
+        for participant_id in self.participant_ids:
+            cached = cache.get(participant_id) if cache else None
+            if cached:
+                self.records[participant_id] = LabKeyRecord(participant_id, ",".join(cached))
+            else:
+                uncached_ids.append(participant_id)
+        for i in range(0, len(uncached_ids), chunk_size):
+            self.call_labkey_api_many(uncached_ids[i:i + chunk_size])
+
+    def call_labkey_api_many(self, participant_ids):
+        """Call LabKey.py on the server for each participant ID in a single remote invocation.
+        Populates the records and errors attributes with the results for each participant.
+        """
+        command = "{python} - {script} {participant_ids}".format(
+            python=LABKEY_PYTHON,
+            script=LABKEY_SCRIPT,
+            participant_ids=" ".join(quote(participant_id) for participant_id in participant_ids)
+        )
+        # Send command over the shared SSH session, passing the batch runner script to the interpreter's stdin.
+        # LabKey lookups are read-only, so are retried if GENAPP01 times out.
+        # Errors connecting to the server are recorded against every participant in this chunk
+        try:
+            with timing.span('labkey', participants=len(participant_ids)):
+                stdout, stderr = self.session.retry(lambda: self.session.exec_command(command, stdin_data=LABKEY_BATCH_RUNNER), 'LabKey')
+        except RemoteCallError as e:
+            stdout, stderr = "", str(e) or repr(e)
+        # Parse the output line for each participant
+        for line in stdout.splitlines():
+            fields = line.split("\t", 2)
+            if len(fields) != 3 or fields[0] not in participant_ids:
+                continue
+            participant_id, status, text = fields
+            if status == "OK":
+                try:
+                    record = LabKeyRecord(participant_id, text)
+                except ValueError:
+                    self.errors[participant_id] = "Unexpected output from LabKey: {}".format(text)
+                    continue
+                self.records[participant_id] = record
+                if self.cache:
+                    self.cache.put(participant_id, record.name, record.dob, record.nhsid)
+            else:
+                self.errors[participant_id] = text
+        # Record an error for any participant without output, e.g. if the batch runner itself failed
+        for participant_id in participant_ids:
+            if participant_id not in self.records and participant_id not in self.errors:
+                self.errors[participant_id] = stderr.strip() or "No output returned from LabKey"
+
+def parse_labkey_output(raw_string):
+    """Parse the stdout of LabKey.py into patient details.
+    Args:
+        raw_string: A string from the stdout of the LabKey script in the format 'name,dob,nhsid'
+    Returns:
+        Tuple of (name, dob, nhsid)
+    Raises:
+        ValueError: If the string is not in the expected format
+    """
+    # Remove newlines, flanking quote characters and separate into a list of variables
+    fields = raw_string.rstrip('\n').strip("'").split(",")
+    if len(fields) != 3:
+        raise ValueError("Unexpected output from LabKey: {}".format(raw_string))
+    return tuple(fields)
+
 def main():
     # Call LabKey script on GENAPP via SSH and print patient details to std_out
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--pid', required=True, help="A Genomics England participant ID")
+    parser.add_argument('-i', '--pid', required=True, nargs='+', help="One or more Genomics England participant IDs")
+    parser.add_argument('--cache', metavar='FILE', help="Optional SQLite file used to cache demographics between runs. Names are not cached.")
+    parser.add_argument('--ttl', metavar='HOURS', type=float, default=24 * 7, help="Number of hours cached demographics are used for (default 168)")
+    parser.add_argument('--invalidate', action='store_true', help="Remove the participants from the cache before retrieving them from LabKey")
+    parser.add_argument('--timings', metavar='FILE', help="Optional file to write timing spans to as JSON lines ('-' for stderr)")
+    parser.add_argument('--profile', action='store_true', help="Optional flag to print a table of time spent in each stage")
     parsed_args = parser.parse_args()
+    timing.configure(parsed_args.timings)
+
+    cache = None
+    if parsed_args.cache:
+        cache = LabKeyCache(parsed_args.cache, ttl_hours=parsed_args.ttl)
+        if parsed_args.invalidate:
+            cache.invalidate(parsed_args.pid)
 
-    # Get patient data and print
-    patient_data = LabKey_SSH(parsed_args.pid)
-    print(patient_data)
+    try:
+        # Get patient data and print
+        if len(parsed_args.pid) == 1:
+            try:
+                patient_data = LabKey_SSH(parsed_args.pid[0], cache=cache)
+            except RemoteCallError as e:
+                sys.exit(str(e))
+            print(patient_data)
+        else:
+            # Fetch all participants in a single remote invocation and print one line per participant ID
+            labkey_batch = LabKeyBatch_SSH(parsed_args.pid, cache=cache)
+            for participant_id in labkey_batch.participant_ids:
+                if participant_id in labkey_batch.records:
+                    print("{}\t{}".format(participant_id, labkey_batch.records[participant_id]))
+                else:
+                    print("{}\tERROR\t{}".format(participant_id, labkey_batch.errors[participant_id]))
+            # Exit with non-zero status if any participants could not be retrieved
+            if labkey_batch.errors:
+                sys.exit(1)
+    finally:
+        close_sessions()
+        # Print the timings however the script exits, including when a participant couldn't be retrieved
+        if parsed_args.profile:
+            print(timing.summary_table())
 
 if __name__ == '__main__':
     main()
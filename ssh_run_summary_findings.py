@@ -2,10 +2,12 @@
 """
 Requirements:
     Python 2.7
-    paramiko
+    paramiko (via genapp_session)
 
 usage: ssh_run_summary_findings.py [-h] --ir_id IR_ID --ir_version IR_VERSION
-                                   -o OUTPUT_FILE [--header HEADER]
+                                   -o OUTPUT_FILE [--header HEADER] [--stream]
+                                   [--cache DIR] [--prune_cache DAYS]
+                                   [--timings FILE] [--profile]
 
 Downloads summary of findings for given interpretation request
 
@@ -18,92 +20,203 @@ optional arguments:
                         Output PDF
   --header HEADER       Optional string to printed at top of each page e.g.
                         'Joe Bloggs DoB 01/01/1901'
+  --stream              Optional flag to stream the PDF straight back over the
+                        SSH command's output instead of saving it on the
+                        server and copying it with SFTP
+  --cache DIR           Optional folder to cache downloaded PDFs in. A PDF
+                        already cached for the same IR ID, IR version and
+                        header is used instead of contacting the server.
+  --prune_cache DAYS    Remove PDFs not used in the last DAYS days from the
+                        cache folder before downloading
+  --timings FILE        Optional file to write timing spans to as JSON lines
+                        ('-' for stderr)
+  --profile             Optional flag to print a table of time spent in each
+                        stage
 """
 import os
 import sys
 import argparse
 import re
-from ConfigParser import ConfigParser
-import paramiko
+import hashlib
+import pipes
+from genapp_session import get_session, close_sessions
+from resilience import RemoteCallError, TransientError
+from summary_cache import SummaryCache
+from sftp_transfer import SftpTransfer
+import timing
 
-# Read config file (must be called config.ini and stored in same directory as script)
-config = ConfigParser()
-config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.ini"))
+# Commands used to generate the summary of findings PDF on the server
+SUMMARY_FINDINGS_PYTHON = "/home/mokaguys/miniconda2/envs/jellypy_py3/bin/python"
+SUMMARY_FINDINGS_SCRIPT = "/home/mokaguys/Apps/100K_summary_findings_pdf/summary_findings.py"
+
+# Shell script used to stream the PDF back to the client. The PDF is written to a temporary file which is deleted
+# when the script exits. The first line of output is the size and sha256 checksum of the PDF, followed by the PDF itself.
+STREAM_SCRIPT = (
+    'tmp=$(mktemp --suffix=.pdf) || exit 1; '
+    'trap \'rm -f "$tmp"\' EXIT; '
+    '{command} -o "$tmp" > /dev/null || exit 1; '
+    'printf "%s %s\\n" "$(stat -c %s "$tmp")" "$(sha256sum "$tmp" | cut -d " " -f 1)"; '
+    'cat "$tmp"'
+    )
+
+class StreamedFile(object):
+    '''File-like object receiving the output of STREAM_SCRIPT. Reads the size and checksum line, then writes the
+    remaining bytes to the output file, calculating the length and checksum as they are written.
+
+    Args:
+        output_file: Open file to write the PDF to
+    Attributes:
+        expected_bytes: Size of the PDF on the server
+        expected_sha256: Checksum of the PDF on the server
+        transferred_bytes: Number of bytes written to the output file
+        sha256: Checksum of the bytes written to the output file
+    '''
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.expected_bytes = None
+        self.expected_sha256 = None
+        self.transferred_bytes = 0
+        self._header = ''
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        # Until the first line has been read, collect output and parse the size and checksum from it
+        if self.expected_bytes is None:
+            self._header += data
+            if '\n' not in self._header:
+                return
+            header, data = self._header.split('\n', 1)
+            try:
+                expected_bytes, self.expected_sha256 = header.split()
+                self.expected_bytes = int(expected_bytes)
+            except ValueError:
+                raise ValueError("Unexpected output from server: {header}".format(header=header[:100]))
+        self.output_file.write(data)
+        self._sha256.update(data)
+        self.transferred_bytes += len(data)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
 
 class SummaryFindings_SSH():
     '''
     Call summary_findings.py on the Viapath GENAPP01 server via ssh and transfer the PDF.
+
+    By default the PDF is saved on the server and copied with SFTP. If stream is True, the PDF is instead written to
+    the command's output and streamed straight to the output path, so no copy is left on the server.
+
+    If a SummaryCache is supplied, a PDF already downloaded for the same IR ID, IR version and header is copied from
+    the cache instead of contacting the server, and new downloads are added to the cache.
     '''
-    def __init__(self, ir_id, ir_version, output_path, header):
+    def __init__(self, ir_id, ir_version, output_path, header, session=None, stream=False, cache=None):
         self.ir_id = ir_id
         self.ir_version = ir_version
         self.output_path_local = output_path
         self.output_path_server = "/home/mokaguys/Documents/100K_summary_findings_pdf/{}".format(os.path.basename(self.output_path_local))
         self.header = header
-        self.ssh_host = config.get("GENAPP01", "SERVER")
-        self.ssh_user = config.get("GENAPP01", "USER")
-        self.ssh_pwd = config.get("GENAPP01", "PASSWORD")
+        # Use the SSH session shared by the whole process unless one is supplied
+        self.session = session or get_session()
         self.transferred_bytes = None
         self.total_bytes = None
-        self.download_summary_findings()
-        self.copy_summary_findings()
-    
-    def download_summary_findings(self):
-        """Call summary_findings.py on the server with input details.
+        # SftpTransfer used to copy the PDF, if it was saved on the server
+        self.transfer = None
+        # Use the cached PDF if there is one
+        with timing.span('summary_cache', ir_id=self.ir_id, ir_version=self.ir_version):
+            self.from_cache = bool(cache) and cache.fetch(self.ir_id, self.ir_version, self.header, self.output_path_local)
+        if self.from_cache:
+            return
+        # Downloads are idempotent, so are retried if GENAPP01 times out or the transfer is incomplete
+        if stream:
+            self.session.retry(self.stream_summary_findings, 'summary of findings download')
+        else:
+            self.session.retry(self.download_summary_findings, 'summary of findings download')
+            # Retry the copy on its own, so that a failed transfer resumes from the bytes already copied rather than
+            # generating the PDF again
+            self.session.retry(self.copy_summary_findings, 'summary of findings copy')
+        if cache:
+            cache.store(self.ir_id, self.ir_version, self.header, self.output_path_local)
+
+    def summary_findings_command(self):
+        """Return the command to run summary_findings.py, without the output path.
         """
-        # Set up paramiko SSH client
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        client.connect(self.ssh_host, username=self.ssh_user, password=self.ssh_pwd)
-        command = "/home/mokaguys/miniconda2/envs/jellypy_py3/bin/python /home/mokaguys/Apps/100K_summary_findings_pdf/summary_findings.py --ir_id {ir_id} --ir_version {ir_version} -o {output_path}".format(
+        command = "{python} {script} --ir_id {ir_id} --ir_version {ir_version}".format(
+                python=SUMMARY_FINDINGS_PYTHON,
+                script=SUMMARY_FINDINGS_SCRIPT,
                 ir_id=self.ir_id,
-                ir_version=self.ir_version,
-                output_path=self.output_path_server
+                ir_version=self.ir_version
             )
         if self.header:
             # Escape any characters in header that could break the bash command even when in double quotes, 
             # see point 3.3.4 here: http://tldp.org/LDP/Bash-Beginners-Guide/html/sect_03_03.html
-            self.header = re.sub(r'(["$`\\])', r"\\\1", self.header)
+            header = re.sub(r'(["$`\\])', r"\\\1", self.header)
             # Append header to command
-            command += ' --header "{header}"'.format(header=self.header)
+            command += ' --header "{header}"'.format(header=header)
+        return command
+    
+    def download_summary_findings(self):
+        """Call summary_findings.py on the server with input details.
+        """
+        command = "{command} -o {output_path}".format(
+                command=self.summary_findings_command(),
+                output_path=self.output_path_server
+            )
         # Execute command to download summary of findings on the server
-        stdin, stdout, stderr = client.exec_command(command)
-        # Call .read() on paramiko StderrFile object 
-        # (Just printing the stderr instead of calling .read() was causing this issue:
-        # https://stackoverflow.com/questions/20951690/paramiko-ssh-exec-command-to-collect-output-says-open-channel-in-response)        
-        stderr = stderr.read()
-        client.close()
-        # If an error was encountered, print error message and exit
+        with timing.span('summary_download', ir_id=self.ir_id, ir_version=self.ir_version):
+            stdout, stderr = self.session.exec_command(command)
+        # If an error was encountered, raise it with the error message
         if stderr:
-            sys.exit(stderr)
+            raise RemoteCallError(stderr)
 
-    def check_sftp_progress(self, transferred, total):
-        """
-        Callback function for recording bytes transferred and total bytes 
+    def stream_summary_findings(self):
+        """Call summary_findings.py on the server and stream the PDF straight back to the local output path.
+        The PDF is written to a .partial file which is only renamed to the output path once its length and checksum
+        have been checked against those reported by the server.
         """
-        self.transferred_bytes = transferred
-        self.total_bytes = total
+        command = "bash -c {script}".format(script=pipes.quote(STREAM_SCRIPT.format(command=self.summary_findings_command())))
+        partial_path = self.output_path_local + '.partial'
+        try:
+            with open(partial_path, 'wb') as output_file:
+                streamed = StreamedFile(output_file)
+                with timing.span('summary_stream', ir_id=self.ir_id, ir_version=self.ir_version):
+                    stdout, stderr = self.session.exec_command(command, stdout_file=streamed)
+            # If an error was encountered, raise it with the error message
+            if stderr:
+                raise RemoteCallError(stderr)
+            self.transferred_bytes = streamed.transferred_bytes
+            self.total_bytes = streamed.expected_bytes
+            # Error if not all bytes have been transferred, or the checksum doesn't match
+            if self.transferred_bytes != self.total_bytes:
+                raise TransientError("Incomplete file transfer. {transferred} out of {total} bytes".format(
+                        transferred=self.transferred_bytes,
+                        total=self.total_bytes
+                    )
+                )
+            if streamed.sha256 != streamed.expected_sha256:
+                raise TransientError("Checksum of transferred file {sha256} does not match server checksum {expected}".format(
+                        sha256=streamed.sha256,
+                        expected=streamed.expected_sha256
+                    )
+                )
+            # Replace any existing file at the output path
+            if os.path.exists(self.output_path_local):
+                os.remove(self.output_path_local)
+            os.rename(partial_path, self.output_path_local)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
 
     def copy_summary_findings(self):
         """
-        Copies summary of findings pdf from the server to local directory via SFTP
+        Copies summary of findings pdf from the server to local directory via SFTP, using pipelined reads. An
+        incomplete copy left by a previous attempt is resumed, and the PDF is checked against its checksum on the server.
         """
-        # Connect to server using IP from config file and port 22 
-        transport = paramiko.Transport((self.ssh_host, 22))
-        transport.connect(username=self.ssh_user, password=self.ssh_pwd)
-        sftp = paramiko.SFTPClient.from_transport(transport)
-        # Copy file from server. Use callback function to record transferred and total bytes.
-        sftp.get(remotepath=self.output_path_server, localpath=self.output_path_local, callback=self.check_sftp_progress)
-        sftp.close()
-        transport.close()
-        # Error if not all bytes have been transferred
-        if self.transferred_bytes != self.total_bytes:
-            sys.exit("Incomplete file transfer. {transferred} out of {total} bytes".format(
-                    transferred=self.transferred_bytes,
-                    total=self.total_bytes
-                )
-            )
-    
+        self.transfer = SftpTransfer(session=self.session)
+        with timing.span('summary_sftp', ir_id=self.ir_id, ir_version=self.ir_version):
+            self.transfer.get(remotepath=self.output_path_server, localpath=self.output_path_local)
+        # The transfer has been checked to be complete
+        self.transferred_bytes = self.total_bytes = self.transfer.total_bytes
+
 def main():
     # Define and capture arguments.
     parser = argparse.ArgumentParser(description='Downloads summary of findings for given interpretation request')
@@ -111,13 +224,37 @@ def main():
     parser.add_argument('--ir_version', required=True, help='Interpretation request version')
     parser.add_argument('-o', '--output_file', required=True, help='Output PDF')
     parser.add_argument('--header', required=False, help='Optional string to printed at top of each page e.g. \'Joe Bloggs    DoB 01/01/1901\'')
+    parser.add_argument('--stream', action='store_true', help='Optional flag to stream the PDF straight back over the SSH command\'s output instead of saving it on the server and copying it with SFTP')
+    parser.add_argument('--cache', metavar='DIR', help='Optional folder to cache downloaded PDFs in. A PDF already cached for the same IR ID, IR version and header is used instead of contacting the server.')
+    parser.add_argument('--prune_cache', metavar='DAYS', type=float, help='Remove PDFs not used in the last DAYS days from the cache folder before downloading')
+    parser.add_argument('--timings', metavar='FILE', help='Optional file to write timing spans to as JSON lines (\'-\' for stderr)')
+    parser.add_argument('--profile', action='store_true', help='Optional flag to print a table of time spent in each stage')
     parsed_args = parser.parse_args()
-    s = SummaryFindings_SSH(
-        ir_id=parsed_args.ir_id,
-        ir_version=parsed_args.ir_version,
-        output_path=parsed_args.output_file,
-        header=parsed_args.header
-        )
+    timing.configure(parsed_args.timings)
+    cache = None
+    if parsed_args.cache:
+        cache = SummaryCache(parsed_args.cache)
+        if parsed_args.prune_cache is not None:
+            cache.prune(parsed_args.prune_cache)
+    try:
+        s = SummaryFindings_SSH(
+            ir_id=parsed_args.ir_id,
+            ir_version=parsed_args.ir_version,
+            output_path=parsed_args.output_file,
+            header=parsed_args.header,
+            stream=parsed_args.stream,
+            cache=cache
+            )
+        if s.from_cache:
+            print("INFO\tSummary of findings copied from cache")
+        elif s.transfer:
+            print("INFO\t{transfer}".format(transfer=s.transfer))
+    except RemoteCallError as e:
+        sys.exit(str(e))
+    finally:
+        close_sessions()
+        if parsed_args.profile:
+            print(timing.summary_table())
 
 if __name__ == '__main__':
     main()
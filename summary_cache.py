@@ -0,0 +1,145 @@
+"""
+summary_cache.py
+
+Local content-addressed cache of summary of findings PDFs downloaded from GENAPP01.
+
+Each download is keyed by interpretation request ID, interpretation request version and the header printed on each
+page. The PDF is stored once in the cache folder under its sha256 checksum, and an SQLite index records the checksum
+and size for each key. A repeat request for the same key is served from the cache without contacting GENAPP01.
+Cached files are checked against the recorded checksum and size before use, so a corrupt or truncated file is
+detected and downloaded again.
+"""
+import os
+import time
+import shutil
+import hashlib
+from sqlite_store import SqliteCache
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Returns the sha256 checksum and size of a file
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            sha256.update(chunk)
+            size += len(chunk)
+            chunk = f.read(chunk_size)
+    return sha256.hexdigest(), size
+
+class SummaryCache(SqliteCache):
+    '''Cache of summary of findings PDFs, stored in a local folder.
+
+    Args:
+        folder: Folder to store the cache in. Created if it doesn't exist.
+    Attributes:
+        hits: Number of requests served from the cache
+        misses: Number of requests not in the cache (or where the cached file was corrupt)
+    Methods:
+        fetch(ir_id, ir_version, header, output_path): Copies a cached PDF to output_path if there is one
+        store(ir_id, ir_version, header, path): Adds a downloaded PDF to the cache
+        prune(max_age_days): Removes entries not used within max_age_days, and any unreferenced files
+    '''
+    NAME = 'Summary of findings cache'
+    # Index of the cached PDFs, one row for each download
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS summaries ('
+        'cache_key TEXT PRIMARY KEY, '
+        'ir_id TEXT NOT NULL, '
+        'ir_version TEXT NOT NULL, '
+        'sha256 TEXT NOT NULL, '
+        'size INTEGER NOT NULL, '
+        'created REAL NOT NULL, '
+        'last_used REAL NOT NULL)',
+    )
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.blob_folder = os.path.join(folder, 'pdf')
+        if not os.path.isdir(self.blob_folder):
+            os.makedirs(self.blob_folder)
+        super(SummaryCache, self).__init__(os.path.join(folder, 'index.sqlite'))
+
+    @staticmethod
+    def cache_key(ir_id, ir_version, header):
+        """Return the key for a download. The header is hashed so that patient details aren't stored in the index.
+        The key is built from UTF-8 bytes, so headers can be byte strings or unicode with non-ASCII characters.
+        """
+        if isinstance(header, unicode):
+            header = header.encode('utf-8')
+        return hashlib.sha256('{}|{}|{}'.format(ir_id, ir_version, header or '')).hexdigest()
+
+    def blob_path(self, sha256):
+        """Return the path of the cached PDF with the given checksum.
+        """
+        return os.path.join(self.blob_folder, sha256 + '.pdf')
+
+    def _remove_entry(self, key):
+        self.write('DELETE FROM summaries WHERE cache_key = ?', (key,))
+
+    def fetch(self, ir_id, ir_version, header, output_path):
+        """Copy the cached PDF for the request to output_path, if there is a valid one in the cache.
+        If output_path already holds an identical file, it is left as it is.
+        Returns:
+            Boolean: True if the request was served from the cache
+        """
+        key = self.cache_key(ir_id, ir_version, header)
+        rows = self.query('SELECT sha256, size FROM summaries WHERE cache_key = ?', (key,))
+        if not rows:
+            self.count(hit=False)
+            return False
+        sha256, size = rows[0]
+        # Nothing to copy if the output file already matches the cached file
+        if not (os.path.exists(output_path) and file_sha256(output_path) == (sha256, size)):
+            blob = self.blob_path(sha256)
+            # If the cached file is missing, truncated or corrupt, discard the entry so that it is downloaded again
+            if not (os.path.exists(blob) and file_sha256(blob) == (sha256, size)):
+                self._remove_entry(key)
+                if os.path.exists(blob):
+                    os.remove(blob)
+                self.count(hit=False)
+                return False
+            # Copy to a temporary file first so that a partial copy is never left at the output path
+            partial_path = output_path + '.partial'
+            shutil.copyfile(blob, partial_path)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            os.rename(partial_path, output_path)
+        self.write('UPDATE summaries SET last_used = ? WHERE cache_key = ?', (time.time(), key))
+        self.count(hit=True)
+        return True
+
+    def store(self, ir_id, ir_version, header, path):
+        """Add a downloaded PDF to the cache.
+        """
+        sha256, size = file_sha256(path)
+        blob = self.blob_path(sha256)
+        # Files are stored by checksum, so identical PDFs are only stored once
+        if not (os.path.exists(blob) and file_sha256(blob) == (sha256, size)):
+            partial_blob = blob + '.partial'
+            shutil.copyfile(path, partial_blob)
+            if os.path.exists(blob):
+                os.remove(blob)
+            os.rename(partial_blob, blob)
+        now = time.time()
+        self.write(
+            'INSERT OR REPLACE INTO summaries (cache_key, ir_id, ir_version, sha256, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.cache_key(ir_id, ir_version, header), str(ir_id), str(ir_version), sha256, size, now, now)
+        )
+
+    def prune(self, max_age_days):
+        """Remove entries that haven't been used in the last max_age_days days, and any cached files no longer
+        referenced by an entry.
+        Returns:
+            Tuple of (entries removed, files removed)
+        """
+        entries = self.write('DELETE FROM summaries WHERE last_used < ?', (time.time() - max_age_days * 86400,))
+        referenced = set(row[0] for row in self.query('SELECT DISTINCT sha256 FROM summaries'))
+        files = 0
+        for filename in os.listdir(self.blob_folder):
+            if os.path.splitext(filename)[0] not in referenced:
+                os.remove(os.path.join(self.blob_folder, filename))
+                files += 1
+        return entries, files
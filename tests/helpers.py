@@ -0,0 +1,87 @@
+"""
+helpers.py
+
+Shared set-up for the unit tests, which are run from the repository root with:
+
+    python -m unittest discover -s tests
+
+Adds the repository root and the benchmarks folder to sys.path, so that the tests can import the scripts and use the
+stand-ins written for the benchmarks (fake_genapp.py, fake_databases.py) in place of GENAPP01, Moka and Geneworks.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+
+for path in (BENCHMARK_DIR, REPO_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+class TempDirTestCase(unittest.TestCase):
+    '''TestCase with a temporary folder (self.tempdir) that is removed after each test'''
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir, True)
+
+def start_genapp(root, demographics=None, summary_pdf=''):
+    """
+    Starts a FakeGenapp server serving files under root. Returns the server, which must be closed by the caller.
+    """
+    from fake_genapp import FakeGenapp
+    return FakeGenapp(root=root, demographics=demographics or {}, summary_pdf=summary_pdf)
+
+def genapp_session(genapp):
+    """
+    Returns a GenappSession connected to a FakeGenapp server, with its own circuit breaker so that failures in one
+    test don't affect others
+    """
+    from genapp_session import GenappSession
+    from resilience import CircuitBreaker
+    return GenappSession('127.0.0.1', 'test', 'test', genapp.port, breaker=CircuitBreaker('GENAPP01'))
+
+def set_config(testcase, section, **options):
+    """
+    Sets options in the shared config.ini settings for the duration of a test, or removes them if the value is None.
+    The previous values are restored, and the section is removed if it was added, when the test finishes.
+    """
+    from app_config import get_config
+    config = get_config()
+    if not config.has_section(section):
+        config.add_section(section)
+        testcase.addCleanup(config.remove_section, section)
+    for option, value in options.items():
+        if config.has_option(section, option):
+            testcase.addCleanup(config.set, section, option, config.get(section, option, raw=True))
+        else:
+            testcase.addCleanup(config.remove_option, section, option)
+        if value is None:
+            config.remove_option(section, option)
+        else:
+            config.set(section, option, value)
+
+def create_fake_databases(testcase, tests):
+    """
+    Creates fake Moka and Geneworks databases in testcase.tempdir populated with the given tests (see
+    run_benchmarks.make_tests), and points the config and connection pools at them for the duration of the test.
+    Returns the paths of the Moka and Geneworks SQLite files.
+    """
+    import fake_databases
+    import db_connections
+    fake_databases.install()
+    moka_path = os.path.join(testcase.tempdir, 'moka.sqlite')
+    geneworks_path = os.path.join(testcase.tempdir, 'geneworks.sqlite')
+    fake_databases.create_databases(moka_path, geneworks_path, tests, checker_username='test')
+    set_config(testcase, 'MOKA', SERVER='localhost', DATABASE=moka_path)
+    set_config(testcase, 'GENEWORKS', SERVER='localhost', DATABASE=geneworks_path, USER='test', PASSWORD='test', **fake_databases.GENEWORKS_VIEW_NAMES)
+    # Pools keep the connection string they were created with, so start and finish the test without any
+    def reset_pools():
+        db_connections.close_pools()
+        db_connections._pools.clear()
+    reset_pools()
+    testcase.addCleanup(reset_pools)
+    return moka_path, geneworks_path
@@ -0,0 +1,61 @@
+"""
+Tests for creating many cover PDFs with one wkhtmltopdf invocation per batch, using the stand-in for wkhtmltopdf
+"""
+import os
+import unittest
+import helpers
+import timing
+import fake_wkhtmltopdf
+from gel_cover_report import GelReportGenerator
+
+# Cover that runs onto a second page if long is set
+TEMPLATE = (
+    '<html><body><p>cover {{ ngs_test_id }}</p>'
+    '{% if long %}<p style="' + fake_wkhtmltopdf.PAGE_BREAK + '">continued {{ ngs_test_id }}</p>{% endif %}'
+    '</body></html>\n'
+)
+
+class CreateCoverPdfsTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(CreateCoverPdfsTest, self).setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+        self.template = os.path.join(self.tempdir, 'cover.html')
+        with open(self.template, 'w') as template:
+            template.write(TEMPLATE)
+        self.generator = GelReportGenerator(fake_wkhtmltopdf.install(self.tempdir))
+
+    def pages(self, cover_pdf):
+        """
+        Returns the text of each page of an in-memory cover PDF
+        """
+        from PyPDF2 import PdfFileReader
+        reader = PdfFileReader(cover_pdf)
+        return [reader.getPage(page_number).getContents().getData() for page_number in range(reader.getNumPages())]
+
+    def wkhtmltopdf_calls(self):
+        return timing.summary()['wkhtmltopdf']['count']
+
+    def test_batches_split_into_covers(self):
+        data_list = [{'ngs_test_id': ngs_test_id} for ngs_test_id in range(1, 6)]
+        cover_pdfs = self.generator.create_cover_pdfs(data_list, self.template, batch_size=2)
+        self.assertEqual(self.wkhtmltopdf_calls(), 3)
+        self.assertEqual(len(cover_pdfs), 5)
+        for data, cover_pdf in zip(data_list, cover_pdfs):
+            pages = self.pages(cover_pdf)
+            self.assertEqual(len(pages), 1)
+            self.assertIn('cover {ngs_test_id}</p>'.format(**data), pages[0])
+
+    def test_multi_page_cover_created_individually(self):
+        # The second cover runs onto two pages, so the pages of the first batch can't be matched to its covers
+        data_list = [{'ngs_test_id': ngs_test_id, 'long': ngs_test_id == 2} for ngs_test_id in range(1, 5)]
+        cover_pdfs = self.generator.create_cover_pdfs(data_list, self.template, batch_size=3)
+        # One call for each batch, then one for each cover in the first batch
+        self.assertEqual(self.wkhtmltopdf_calls(), 5)
+        self.assertEqual([len(self.pages(cover_pdf)) for cover_pdf in cover_pdfs], [1, 2, 1, 1])
+        for data, cover_pdf in zip(data_list, cover_pdfs):
+            self.assertIn('cover {ngs_test_id}</p>'.format(**data), self.pages(cover_pdf)[0])
+        self.assertIn('continued 2', self.pages(cover_pdfs[1])[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests for the database connection pools: the maximum pool size and checking idle connections
+"""
+import os
+import time
+import threading
+import unittest
+import helpers
+import fake_databases
+from resilience import TransientError
+from db_connections import ConnectionPool
+
+class CountingPool(ConnectionPool):
+    '''ConnectionPool that counts the liveness checks made'''
+    def __init__(self, *args, **kwargs):
+        super(CountingPool, self).__init__(*args, **kwargs)
+        self.liveness_checks = 0
+
+    def _is_alive(self, cnxn):
+        self.liveness_checks += 1
+        return super(CountingPool, self)._is_alive(cnxn)
+
+class ConnectionPoolTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        fake_databases.install()
+        self.connection_string = 'DATABASE={path};'.format(path=os.path.join(self.tempdir, 'moka.sqlite'))
+
+    def pool(self, **kwargs):
+        pool = CountingPool('MOKA', self.connection_string, retries=0, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connections_reused(self):
+        pool = self.pool()
+        for i in range(3):
+            with pool.connection() as cnxn:
+                cnxn.cursor().execute('SELECT 1;')
+        self.assertEqual((pool.connects, pool.checkouts), (1, 3))
+
+    def test_waits_for_checkin_at_max_size(self):
+        pool = self.pool(max_size=2)
+        held = [pool.checkout(), pool.checkout()]
+        checked_out = []
+        waiter = threading.Thread(target=lambda: checked_out.append(pool.checkout()))
+        waiter.start()
+        time.sleep(0.1)
+        # No third connection is opened while two are checked out
+        self.assertEqual((pool.connects, checked_out), (2, []))
+        pool.checkin(held[0])
+        waiter.join(5)
+        self.assertEqual(checked_out, [held[0]])
+        self.assertEqual(pool.connects, 2)
+
+    def test_gives_up_after_query_timeout(self):
+        pool = self.pool(max_size=1, query_timeout=0.1)
+        pool.checkout()
+        with self.assertRaises(TransientError) as context:
+            pool.checkout()
+        self.assertEqual(str(context.exception), 'No MOKA connections available: all 1 are in use')
+
+    def test_failed_connect_frees_slot(self):
+        pool = self.pool(max_size=1)
+        pool.connection_string = 'no database'
+        self.assertRaises(TransientError, pool.checkout)
+        pool.connection_string = self.connection_string
+        pool.checkin(pool.checkout())
+        self.assertEqual(pool.connects, 1)
+
+    def test_recently_used_connections_not_checked(self):
+        pool = self.pool(idle_check=60)
+        for i in range(3):
+            pool.checkin(pool.checkout())
+        self.assertEqual(pool.liveness_checks, 0)
+
+    def test_idle_connections_checked(self):
+        pool = self.pool(idle_check=0)
+        pool.checkin(pool.checkout())
+        pool.checkin(pool.checkout())
+        self.assertEqual((pool.liveness_checks, pool.connects), (1, 1))
+
+    def test_dropped_connection_replaced(self):
+        pool = self.pool(max_size=1, idle_check=0)
+        cnxn = pool.checkout()
+        pool.checkin(cnxn)
+        # Make the liveness query fail, as it would on a connection dropped by the server
+        pool.liveness_sql = 'SELECT 1 FROM dropped;'
+        replacement = pool.checkout()
+        self.assertIsNot(replacement, cnxn)
+        self.assertEqual(pool.connects, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for writing emails as .eml files, and for generating many emails from a manifest with generate_email.py
+"""
+import os
+import sys
+import json
+import email
+import subprocess
+import unittest
+from StringIO import StringIO
+import helpers
+from generate_email import EmlMailer, read_manifest
+
+SCRIPT = os.path.join(helpers.REPO_DIR, 'generate_email.py')
+REPORT = '%PDF-1.4\nreport\n%%EOF\n'
+
+class EmlMailerTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(EmlMailerTest, self).setUp()
+        self.outbox = os.path.join(self.tempdir, 'outbox')
+        self.attachment = os.path.join(self.tempdir, 'report.pdf')
+        with open(self.attachment, 'wb') as attachment:
+            attachment.write(REPORT)
+
+    def read_eml(self, path):
+        with open(path, 'rb') as eml:
+            return email.message_from_file(eml)
+
+    def test_eml_round_trip(self):
+        mailer = EmlMailer(self.outbox)
+        path = mailer.add('clinician@example.com', 'GeL report: 12345', u'<p>Report for Zo\xeb</p>', [self.attachment])
+        self.assertEqual(os.listdir(self.outbox), [os.path.basename(path)])
+        self.assertTrue(path.endswith('GeL_report_12345.eml'))
+        message = self.read_eml(path)
+        self.assertEqual((message['To'], message['Subject'], message['X-Unsent']), ('clinician@example.com', 'GeL report: 12345', '1'))
+        body, attachment = message.get_payload()
+        self.assertEqual(body.get_content_type(), 'text/html')
+        self.assertEqual(body.get_payload(decode=True).decode('utf-8'), u'<p>Report for Zo\xeb</p>')
+        self.assertEqual((attachment.get_content_type(), attachment.get_filename()), ('application/pdf', 'report.pdf'))
+        self.assertEqual(attachment.get_payload(decode=True), REPORT)
+        self.assertEqual(mailer.created, 1)
+
+    def test_same_subject_written_to_separate_files(self):
+        mailer = EmlMailer(self.outbox)
+        paths = [mailer.add('clinician@example.com', 'GeL report', 'body', []) for i in range(3)]
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual(sorted(os.listdir(self.outbox)), sorted(os.path.basename(path) for path in paths))
+
+class ManifestTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(ManifestTest, self).setUp()
+        self.outbox = os.path.join(self.tempdir, 'outbox')
+        self.emails = [
+            {'to': 'first@example.com', 'subject': 'First', 'body': '<p>first</p>'},
+            {'to': 'second@example.com', 'subject': 'Second', 'body': '<p>second</p>', 'attachments': [SCRIPT]},
+        ]
+        self.manifest = ''.join(json.dumps(message) + '\n' for message in self.emails)
+
+    def run_script(self, args, stdin=None):
+        process = subprocess.Popen([sys.executable, SCRIPT] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(stdin)
+        return process.returncode, stdout, stderr
+
+    def recipients(self):
+        recipients = []
+        for filename in os.listdir(self.outbox):
+            with open(os.path.join(self.outbox, filename), 'rb') as eml:
+                message = email.message_from_file(eml)
+            recipients.append((message['To'], message['Subject'], len(message.get_payload())))
+        return sorted(recipients)
+
+    def test_read_manifest(self):
+        self.assertEqual(read_manifest(StringIO(self.manifest + '\n')), [
+            ('first@example.com', 'First', '<p>first</p>', []),
+            ('second@example.com', 'Second', '<p>second</p>', [SCRIPT]),
+        ])
+        with self.assertRaises(ValueError) as context:
+            read_manifest(StringIO(self.manifest + '{"to": "third@example.com"}\n'))
+        self.assertIn('line 3', str(context.exception))
+
+    def test_manifest_file(self):
+        manifest_path = os.path.join(self.tempdir, 'manifest.jsonl')
+        with open(manifest_path, 'w') as manifest:
+            manifest.write(self.manifest)
+        returncode, stdout, stderr = self.run_script(['-m', manifest_path, '--backend', 'eml', '--outbox', self.outbox])
+        self.assertEqual(returncode, 0, stderr)
+        self.assertEqual(self.recipients(), [('first@example.com', 'First', 1), ('second@example.com', 'Second', 2)])
+        self.assertEqual(stdout.splitlines()[-1], 'INFO\tEmails: 2 written to {outbox}'.format(outbox=self.outbox))
+
+    def test_manifest_stdin(self):
+        returncode, stdout, stderr = self.run_script(['-m', '-', '--backend', 'eml', '--outbox', self.outbox], stdin=self.manifest)
+        self.assertEqual(returncode, 0, stderr)
+        self.assertEqual(len(self.recipients()), 2)
+
+    def test_invalid_arguments(self):
+        for args in (
+                ['-m', '-', '-t', 'first@example.com', '--backend', 'eml', '--outbox', self.outbox],
+                ['-t', 'first@example.com', '--backend', 'eml', '--outbox', self.outbox],
+                ['-m', '-', '--backend', 'eml'],
+                ):
+            returncode, stdout, stderr = self.run_script(args, stdin=self.manifest)
+            self.assertEqual(returncode, 2, args)
+        self.assertFalse(os.path.exists(self.outbox))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Tests for entering GeL charges into Geneworks for all tests in a run
+"""
+import sys
+import sqlite3
+import unittest
+from StringIO import StringIO
+import helpers
+import timing
+from run_benchmarks import make_tests
+from gel_cover_report import GeLGeneworksChargeBatch
+
+class GeneworksChargeBatchTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(GeneworksChargeBatchTest, self).setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def create_charges(self, tests, **kwargs):
+        """
+        Creates the fake databases for tests, and returns a GeLGeneworksChargeBatch with a charge for each test
+        """
+        self.moka_path, self.geneworks_path = helpers.create_fake_databases(self, tests)
+        charges = GeLGeneworksChargeBatch(**kwargs)
+        for test in tests:
+            charges.add(test['pru'], 'WGS No Variants', 71, ngs_test_id=test['ngs_test_id'], irid=test['irid'])
+        return charges
+
+    def geneworks(self, sql, *params):
+        cnxn = sqlite3.connect(self.geneworks_path)
+        try:
+            rows = cnxn.execute(sql, params).fetchall()
+            cnxn.commit()
+            return rows
+        finally:
+            cnxn.close()
+
+    def inserted_charges(self):
+        """
+        Returns the (SpecimenNo, TestID) of the charge inserted for each record number
+        """
+        return dict((record_no, (specimen_no, test_id)) for record_no, specimen_no, test_id in self.geneworks('SELECT RecordNo, SpecimenNo, TestID FROM LabReportCostDetail'))
+
+    def test_prus_queried_in_chunks(self):
+        tests = make_tests(1001)
+        charges = self.create_charges(tests)
+        charges.get_test_details()
+        # 500 PRUs per query
+        self.assertEqual(timing.summary()['geneworks_gel_tests']['count'], 3)
+        for i, charge in enumerate(charges.charges):
+            # The fake Geneworks test and specimen for tests[i] have ID i + 1
+            self.assertEqual((charge['ngs_test_id'], charge['test_id'], charge['specimen_id'], charge['error']), (tests[i]['ngs_test_id'], i + 1, 'S{i:07d}'.format(i=i + 1), None))
+
+    def test_record_numbers_mapped_to_tests(self):
+        charges = self.create_charges(make_tests(7), batch_size=3)
+        # Charges already entered for other patients, so that record numbers don't follow the order of the tests
+        self.geneworks('INSERT INTO LabReportCostDetail (RecordNo, SpecimenNo, TestType, Cost, TestID) VALUES (3, \'S0000999\', \'Other\', 10, 999)')
+        charges.get_test_details()
+        charges.insert_charges()
+        inserted = self.inserted_charges()
+        self.assertEqual(len(inserted), 8)
+        self.assertEqual(sorted(charge['record_no'] for charge in charges.charges), range(4, 11))
+        for charge in charges.charges:
+            self.assertEqual(inserted[charge['record_no']], (charge['specimen_id'], charge['test_id']))
+
+    def test_partial_failure(self):
+        tests = make_tests(6)
+        charges = self.create_charges(tests, batch_size=2)
+        # Patient 2 is missing from Geneworks, patient 3 has two GeL tests, and inserting the charge for test 5 fails
+        self.geneworks('DELETE FROM "gwv-patient" WHERE PatientID = 2')
+        self.geneworks('INSERT INTO "gwv-specimen" (SpecimenID, PatientID, SpecimenTrustID) VALUES (101, 3, \'S0000101\')')
+        self.geneworks('INSERT INTO "gwv-test" (TestID, SpecimenID) VALUES (101, 101)')
+        self.geneworks('INSERT INTO "gwv-dnatestrequest" (TestID, DisorderID, TestDescriptionID) VALUES (101, 60, 18)')
+        self.geneworks('INSERT INTO "gwv-dnanumber" (SpecimenID, DNANumber) VALUES (101, \'D0000101\')')
+        self.geneworks('CREATE TRIGGER reject_charge BEFORE INSERT ON LabReportCostDetail WHEN NEW.TestID = 5 BEGIN SELECT RAISE(ABORT, \'rejected\'); END')
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            charges.run()
+        finally:
+            sys.stdout = stdout
+        errors = [charge['error'] for charge in charges.charges]
+        self.assertEqual(errors[1], 'Unable to find GeL test in Geneworks for {pru}.'.format(pru=tests[1]['pru']))
+        self.assertEqual(errors[2], 'Multiple GeL tests found in Geneworks for {pru}.'.format(pru=tests[2]['pru']))
+        self.assertEqual(errors[4], 'Encountered error when inserting charge for {pru}.'.format(pru=tests[4]['pru']))
+        self.assertEqual([errors[i] for i in (0, 3, 5)], [None, None, None])
+        # The other charges, including the one in the same batch as the failed insert, are committed
+        inserted = self.inserted_charges()
+        self.assertEqual(sorted(test_id for specimen_no, test_id in inserted.values()), [1, 4, 6])
+        self.assertEqual([charges.charges[i]['record_no'] in inserted for i in (0, 3, 5)], [True, True, True])
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line.split('\t')[0] for line in lines], ['SUCCESS', 'ERROR', 'ERROR', 'SUCCESS', 'ERROR', 'SUCCESS'])
+        self.assertIn('(NGSTestID {ngs_test_id})'.format(ngs_test_id=tests[4]['ngs_test_id']), lines[4])
+
+if __name__ == '__main__':
+    unittest.main()
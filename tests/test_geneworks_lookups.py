@@ -0,0 +1,93 @@
+"""
+Tests that reading Geneworks directly gives the same records as the joins to the linked gwv-*linked views in Moka
+that gel_cover_report.py used previously
+"""
+import sqlite3
+import unittest
+import helpers
+from resilience import RemoteCallError
+from run_benchmarks import make_tests
+from gel_cover_report import MokaQueryExecuter, GeneworksQueryExecuter, trust_id_key
+
+# The cover page query previously run against Moka, joining to the linked patient view
+LINKED_DATA_SQL = (
+    'SELECT NGSTest.NGSTestID, NGSTest.BlockAutomatedReporting, NGSTest.InternalPatientID, NGSTest.ResultCode, Checker.Name AS clinician_name, Checker.ReportEmail, Item_Address.Item AS clinician_address, '
+    '"gwv-patientlinked".FirstName, "gwv-patientlinked".LastName, "gwv-patientlinked".DoB, "gwv-patientlinked".Gender, "gwv-patientlinked".NHSNo, '
+    '"gwv-patientlinked".PatientTrustID, NGSTest.GELProbandID, NGSTest.IRID, Patients.s_StatusOverall '
+    'FROM (((NGSTest INNER JOIN Patients ON NGSTest.InternalPatientID = Patients.InternalPatientID) '
+    'INNER JOIN "gwv-patientlinked" ON "gwv-patientlinked".PatientTrustID = Patients.PatientID) INNER JOIN Checker ON NGSTest.BookBy = Checker.Check1ID) '
+    'INNER JOIN Item AS Item_Address ON Checker.Address = Item_Address.ItemID'
+)
+
+# The charge details query previously run against Moka, joining the linked views
+LINKED_CHARGE_SQL = (
+    'SELECT "gwv-patientlinked".PatientTrustID, "gwv-testlinked".TestID, "gwv-specimenlinked".SpecimenTrustID '
+    'FROM ("gwv-dnatestrequestlinked" INNER JOIN (("gwv-testlinked" INNER JOIN "gwv-specimenlinked" ON "gwv-testlinked".SpecimenID = "gwv-specimenlinked".SpecimenID) '
+    'INNER JOIN "gwv-patientlinked" ON "gwv-specimenlinked".PatientID = "gwv-patientlinked".PatientID) ON "gwv-dnatestrequestlinked".TestID = "gwv-testlinked".TestID) '
+    'INNER JOIN "gwv-dnanumberlinked" ON "gwv-specimenlinked".SpecimenID = "gwv-dnanumberlinked".SpecimenID '
+    'WHERE "gwv-patientlinked".PatientTrustID IN ({prus}) AND "gwv-dnatestrequestlinked".DisorderID = 60 AND "gwv-dnatestrequestlinked".TestDescriptionID = 18'
+)
+
+# Changes made to both the Geneworks views and the linked views in Moka, covering the cases the joins handle
+EDGE_CASES = [
+    # Patient missing from Geneworks: the test is excluded
+    'DELETE FROM "gwv-patient{linked}" WHERE PatientID = 5',
+    # No gender recorded
+    'UPDATE "gwv-patient{linked}" SET Gender = NULL WHERE PatientID = 6',
+    # A second GeL specimen with a DNA number, and a third without one (which isn't matched)
+    'INSERT INTO "gwv-specimen{linked}" (SpecimenID, PatientID, SpecimenTrustID) VALUES (101, 7, \'S0000101\'), (102, 7, \'S0000102\')',
+    'INSERT INTO "gwv-test{linked}" (TestID, SpecimenID) VALUES (101, 101), (102, 102)',
+    'INSERT INTO "gwv-dnatestrequest{linked}" (TestID, DisorderID, TestDescriptionID) VALUES (101, 60, 18), (102, 60, 18)',
+    'INSERT INTO "gwv-dnanumber{linked}" (SpecimenID, DNANumber) VALUES (101, \'D0000101\')',
+    # A test that isn't GeL whole genome sequencing
+    'UPDATE "gwv-dnatestrequest{linked}" SET DisorderID = 61 WHERE TestID = 8',
+]
+
+class GeneworksLookupTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(GeneworksLookupTest, self).setUp()
+        self.tests = make_tests(12)
+        moka_path, geneworks_path = helpers.create_fake_databases(self, self.tests)
+        for path, linked in ((moka_path, 'linked'), (geneworks_path, '')):
+            cnxn = sqlite3.connect(path)
+            for sql in EDGE_CASES:
+                cnxn.execute(sql.format(linked=linked))
+            cnxn.commit()
+            cnxn.close()
+        self.moka = MokaQueryExecuter()
+        self.addCleanup(self.moka.close)
+
+    def test_cover_page_data(self):
+        linked = {}
+        for row in self.moka.cursor.execute(LINKED_DATA_SQL).fetchall():
+            linked[row.NGSTestID] = self.moka._row_to_data(row, row)
+        # Chunks smaller than the number of tests, so records are joined across several queries
+        data = self.moka.get_data_many([test['ngs_test_id'] for test in self.tests], chunk_size=5)
+        self.assertEqual(data, linked)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[self.tests[5]['ngs_test_id']]['sex'], 'Unknown')
+
+    def test_charge_details(self):
+        linked = {}
+        prus = ', '.join("'{pru}'".format(pru=test['pru']) for test in self.tests)
+        for row in self.moka.cursor.execute(LINKED_CHARGE_SQL.format(prus=prus)).fetchall():
+            linked.setdefault(trust_id_key(row.PatientTrustID), []).append((row.PatientTrustID, row.TestID, row.SpecimenTrustID))
+        rows_by_pru = GeneworksQueryExecuter().get_gel_tests([test['pru'] for test in self.tests], chunk_size=5)
+        direct = dict((pru, [(row.PatientTrustID, row.TestID, row.SpecimenTrustID) for row in rows]) for pru, rows in rows_by_pru.items())
+        self.assertEqual(dict((pru, sorted(rows)) for pru, rows in direct.items()), dict((pru, sorted(rows)) for pru, rows in linked.items()))
+        # Patient 7 has two GeL specimens with DNA numbers, and patient 8 has no GeL test
+        self.assertEqual(len(direct[trust_id_key(self.tests[6]['pru'])]), 2)
+        self.assertNotIn(trust_id_key(self.tests[7]['pru']), direct)
+
+    def test_check_access(self):
+        GeneworksQueryExecuter().check_access()
+        # A view the login can't read, or that doesn't exist
+        helpers.set_config(self, 'GENEWORKS', SPECIMEN_VIEW='gwv-missing')
+        with self.assertRaises(RemoteCallError) as context:
+            GeneworksQueryExecuter().check_access()
+        self.assertIn('needs SELECT permission', str(context.exception))
+        helpers.set_config(self, 'GENEWORKS', SPECIMEN_VIEW=None)
+        self.assertRaises(ValueError, GeneworksQueryExecuter().check_access)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Tests for the local cache of LabKey demographics
+"""
+import os
+import time
+import sqlite3
+import unittest
+import helpers
+from labkey_cache import LabKeyCache
+
+class LabKeyCacheTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(LabKeyCacheTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'labkey_cache.sqlite')
+
+    def cache(self, **kwargs):
+        cache = LabKeyCache(self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_and_put(self):
+        cache = self.cache()
+        self.assertIsNone(cache.get('111'))
+        cache.put('111', 'Jane Doe', '01/01/1980', '9000000001')
+        self.assertEqual(cache.get('111'), ('', '01/01/1980', '9000000001'))
+        self.assertEqual(str(cache), 'LabKey cache: 1 hits, 1 misses')
+
+    def test_names(self):
+        cache = self.cache(include_names=True)
+        cache.put('111', 'Jane Doe', '01/01/1980', '9000000001')
+        self.assertEqual(cache.get('111'), ('Jane Doe', '01/01/1980', '9000000001'))
+
+    def test_expired(self):
+        cache = self.cache(ttl_hours=1)
+        cache.put('111', '', '01/01/1980', '9000000001')
+        cache.write('UPDATE demographics SET retrieved = ?', (time.time() - 7200,))
+        self.assertIsNone(cache.get('111'))
+
+    def test_invalidate(self):
+        cache = self.cache()
+        for participant_id in ('111', '222', '333'):
+            cache.put(participant_id, '', '01/01/1980', '9000000001')
+        self.assertEqual(cache.invalidate(['111', '999']), 1)
+        self.assertIsNone(cache.get('111'))
+        self.assertEqual(cache.invalidate(), 2)
+        self.assertIsNone(cache.get('222'))
+
+    def test_read_only(self):
+        self.cache().put('111', '', '01/01/1980', '9000000001')
+        cache = self.cache(read_only=True)
+        cache.put('222', '', '02/02/1980', '9000000002')
+        self.assertEqual(cache.invalidate(), 0)
+        self.assertIsNotNone(cache.get('111'))
+        self.assertIsNone(cache.get('222'))
+
+    def test_read_only_without_table(self):
+        # e.g. an empty file, or one that another program has created
+        sqlite3.connect(self.path).close()
+        cache = self.cache(read_only=True)
+        self.assertIsNone(cache.get('111'))
+        self.assertEqual(cache.misses, 1)
+        self.assertFalse(cache.has_table('demographics'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests for applying the Moka updates for reported tests in batched transactions
+"""
+import datetime
+import unittest
+import helpers
+import fake_databases
+from run_benchmarks import make_tests
+from gel_cover_report import MokaQueryExecuter, MokaWriteBack
+
+class MokaWriteBackTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(MokaWriteBackTest, self).setUp()
+        self.tests = make_tests(4)
+        self.moka_path, geneworks_path = helpers.create_fake_databases(self, self.tests)
+        self.moka = MokaQueryExecuter()
+        self.addCleanup(self.moka.close)
+        # NGSTestIDs passed to the on_commit callbacks, and messages passed to the on_error callbacks
+        self.committed = []
+        self.errors = []
+
+    def writes(self, index, fail=False):
+        """
+        Returns the updates for a test. If fail is True, the last update has the wrong number of parameters.
+        """
+        ngs_test_id = self.tests[index]['ngs_test_id']
+        writes = [
+            ('ngstestfile_insert', (ngs_test_id, 'report.pdf', datetime.datetime.now())),
+            ('patients_update', (index + 1,)),
+        ]
+        if fail:
+            writes.append(('patientlog_insert', (index + 1, 'log entry')))
+        return writes
+
+    def add(self, write_back, index, fail=False):
+        ngs_test_id = self.tests[index]['ngs_test_id']
+        return write_back.add(ngs_test_id, self.writes(index, fail), self.moka, on_commit=lambda: self.committed.append(ngs_test_id), on_error=self.errors.append)
+
+    def files(self):
+        return fake_databases.count_rows(self.moka_path, 'NGSTestFile')
+
+    def test_applied_in_batches(self):
+        write_back = MokaWriteBack(batch_size=3)
+        self.assertTrue(self.add(write_back, 0))
+        self.assertTrue(self.add(write_back, 1))
+        # Nothing is written until the batch is full
+        self.assertEqual((self.files(), self.committed), (0, []))
+        self.assertTrue(self.add(write_back, 2))
+        self.assertEqual(self.files(), 3)
+        self.assertTrue(self.add(write_back, 3))
+        write_back.flush(self.moka)
+        self.assertEqual(self.files(), 4)
+        self.assertEqual(self.committed, [test['ngs_test_id'] for test in self.tests])
+        self.assertEqual(self.moka.cursor.fast_executemany, True)
+
+    def test_failed_test_rolled_back(self):
+        write_back = MokaWriteBack(batch_size=1)
+        # The NGSTestFile row inserted before the failed update is rolled back
+        self.assertFalse(self.add(write_back, 0, fail=True))
+        self.assertEqual((self.files(), self.committed), (0, []))
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue(self.errors[0].startswith('ERROR\tMoka updates for NGSTestID 10000 failed and have been rolled back: '))
+        # The connection can still be used
+        self.assertTrue(self.add(write_back, 1))
+        self.assertEqual(self.files(), 1)
+
+    def test_tests_retried_after_batch_fails(self):
+        write_back = MokaWriteBack(batch_size=3)
+        self.add(write_back, 0)
+        self.add(write_back, 1, fail=True)
+        # The batch is applied when the third test is added. The test that filled the batch succeeds on its own.
+        self.assertTrue(self.add(write_back, 2))
+        self.assertEqual(self.files(), 2)
+        self.assertEqual(sorted(self.committed), [self.tests[0]['ngs_test_id'], self.tests[2]['ngs_test_id']])
+        # Only the failed test's error is reported, through its own callback
+        self.assertEqual(len(self.errors), 1)
+        self.assertIn('NGSTestID {ngs_test_id} failed'.format(ngs_test_id=self.tests[1]['ngs_test_id']), self.errors[0])
+        ngs_test_ids = [row[0] for row in self.moka.cursor.execute('SELECT NGSTestID FROM NGSTestFile ORDER BY NGSTestID').fetchall()]
+        self.assertEqual(ngs_test_ids, [self.tests[0]['ngs_test_id'], self.tests[2]['ngs_test_id']])
+
+    def test_filling_test_fails(self):
+        write_back = MokaWriteBack(batch_size=2)
+        self.add(write_back, 0)
+        self.assertFalse(self.add(write_back, 1, fail=True))
+        self.assertEqual(self.committed, [self.tests[0]['ngs_test_id']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Tests for publishing reports to the output folder through a temporary file that is renamed once complete
+"""
+import os
+import hashlib
+import unittest
+import helpers
+from gel_cover_report import publish_file
+
+REPORT = '%PDF-1.4\n' + 'report\n' * 1000 + '%%EOF\n'
+
+class PublishFileTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(PublishFileTest, self).setUp()
+        self.local_file = os.path.join(self.tempdir, 'local.pdf')
+        with open(self.local_file, 'wb') as local:
+            local.write(REPORT)
+        self.output_folder = os.path.join(self.tempdir, 'output')
+        os.mkdir(self.output_folder)
+        self.output_file = os.path.join(self.output_folder, 'report.pdf')
+
+    def read_output(self):
+        with open(self.output_file, 'rb') as output:
+            return output.read()
+
+    def test_published_via_temporary_file(self):
+        written = []
+        fsync = os.fsync
+        def check_fsync(fd):
+            # The report is only in the temporary file until it has been written to disk
+            written.append((os.listdir(self.output_folder), os.path.getsize(self.output_file + '.partial')))
+            fsync(fd)
+        os.fsync = check_fsync
+        self.addCleanup(setattr, os, 'fsync', fsync)
+        checksum = publish_file(self.local_file, self.output_file, chunk_size=100)
+        self.assertEqual(written, [(['report.pdf.partial'], len(REPORT))])
+        self.assertEqual(checksum, hashlib.sha256(REPORT).hexdigest())
+        self.assertEqual(self.read_output(), REPORT)
+        self.assertEqual(os.listdir(self.output_folder), ['report.pdf'])
+
+    def test_overwrites_existing_report(self):
+        with open(self.output_file, 'wb') as output:
+            output.write('previous version')
+        publish_file(self.local_file, self.output_file)
+        self.assertEqual(self.read_output(), REPORT)
+        self.assertEqual(os.listdir(self.output_folder), ['report.pdf'])
+
+    def test_failed_write_leaves_no_partial_file(self):
+        with open(self.output_file, 'wb') as output:
+            output.write('previous version')
+        fsync = os.fsync
+        def failing_fsync(fd):
+            raise OSError(5, 'Input/output error')
+        os.fsync = failing_fsync
+        self.addCleanup(setattr, os, 'fsync', fsync)
+        self.assertRaises(OSError, publish_file, self.local_file, self.output_file, chunk_size=100)
+        # The previous version is left in place and the temporary file is removed
+        self.assertEqual(os.listdir(self.output_folder), ['report.pdf'])
+        self.assertEqual(self.read_output(), 'previous version')
+
+    def test_missing_output_folder(self):
+        self.assertRaises(IOError, publish_file, self.local_file, os.path.join(self.tempdir, 'missing', 'report.pdf'))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'missing')))
+
+if __name__ == '__main__':
+    unittest.main()
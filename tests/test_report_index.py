@@ -0,0 +1,83 @@
+"""
+Tests for the index of summary of findings PDFs in the technical reports folder
+"""
+import os
+import json
+import unittest
+import helpers
+from report_index import ReportIndex
+
+class ReportIndexTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(ReportIndexTest, self).setUp()
+        self.folder = os.path.join(self.tempdir, 'technical_reports')
+        os.mkdir(self.folder)
+
+    def save_report(self, filename, mtime=None):
+        open(os.path.join(self.folder, filename), 'wb').close()
+        # Set the folder's modification time explicitly, as it may not change within the filesystem's resolution
+        if mtime is not None:
+            os.utime(self.folder, (mtime, mtime))
+
+    def test_find(self):
+        self.save_report('Summary_of_Findings_123-1-1.pdf')
+        self.save_report('summary_of_findings_456-2-1.PDF')
+        self.save_report('Summary_of_Findings_123-1-10.pdf')
+        self.save_report('notes.txt')
+        index = ReportIndex(self.folder)
+        self.assertEqual(index.find('123-1'), ['Summary_of_Findings_123-1-1.pdf'])
+        self.assertEqual(index.find('456-2'), ['summary_of_findings_456-2-1.PDF'])
+        self.assertEqual(index.find('789-1'), [])
+
+    def test_multiple_versions(self):
+        self.save_report('Summary_of_Findings_123-1-2.pdf')
+        self.save_report('Summary_of_Findings_123-1-1.pdf')
+        self.assertEqual(ReportIndex(self.folder).find('123-1'), ['Summary_of_Findings_123-1-1.pdf', 'Summary_of_Findings_123-1-2.pdf'])
+
+    def test_new_report_found_when_folder_changes(self):
+        index = ReportIndex(self.folder)
+        self.save_report('Summary_of_Findings_123-1-1.pdf', mtime=1000)
+        self.assertEqual(index.find('123-1'), ['Summary_of_Findings_123-1-1.pdf'])
+
+    def test_deleted_report_not_returned(self):
+        self.save_report('Summary_of_Findings_123-1-1.pdf', mtime=1000)
+        index = ReportIndex(self.folder)
+        # Replace the report with another version without changing the folder's modification time
+        os.remove(os.path.join(self.folder, 'Summary_of_Findings_123-1-1.pdf'))
+        self.save_report('Summary_of_Findings_123-1-2.pdf', mtime=1000)
+        self.assertEqual(index.find('123-1'), ['Summary_of_Findings_123-1-2.pdf'])
+
+    def test_refresh_if_changed(self):
+        self.save_report('Summary_of_Findings_123-1-1.pdf', mtime=1000)
+        index = ReportIndex(self.folder)
+        self.assertFalse(index.refresh_if_changed())
+        # A second version saved alongside the indexed one is picked up once the folder has changed
+        self.save_report('Summary_of_Findings_123-1-2.pdf', mtime=2000)
+        self.assertTrue(index.refresh_if_changed())
+        self.assertEqual(len(index.find('123-1')), 2)
+
+    def test_add(self):
+        index = ReportIndex(self.folder)
+        self.save_report('Summary_of_Findings_123-1-1.pdf')
+        index.add(os.path.join(self.folder, 'Summary_of_Findings_123-1-1.pdf'))
+        # Files saved in other folders aren't added
+        index.add(os.path.join(self.tempdir, 'Summary_of_Findings_456-1-1.pdf'))
+        self.assertEqual(index.reports, {'123-1': ['Summary_of_Findings_123-1-1.pdf']})
+
+    def test_cache_file(self):
+        cache_file = os.path.join(self.tempdir, 'index.json')
+        self.save_report('Summary_of_Findings_123-1-1.pdf', mtime=1000)
+        ReportIndex(self.folder, cache_file=cache_file)
+        # The cached index is used while the folder is unchanged...
+        with open(cache_file) as cache:
+            cached = json.load(cache)
+        cached['reports']['456-1'] = ['Summary_of_Findings_456-1-1.pdf']
+        with open(cache_file, 'w') as cache:
+            json.dump(cached, cache)
+        self.assertIn('456-1', ReportIndex(self.folder, cache_file=cache_file).reports)
+        # ...and the folder is listed again once it has changed
+        os.utime(self.folder, (2000, 2000))
+        self.assertNotIn('456-1', ReportIndex(self.folder, cache_file=cache_file).reports)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""
+Tests for retrying transient failures and the circuit breakers for remote services
+"""
+import sys
+import time
+import threading
+import unittest
+from StringIO import StringIO
+import helpers
+from resilience import CircuitBreaker, CircuitOpenError, RemoteCallError, TransientError, retry_call, backoff_delay
+
+class FlakyCall(object):
+    '''Callable that raises the given exceptions in turn, then returns 'done' '''
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'done'
+
+class RetryCallTest(unittest.TestCase):
+    def setUp(self):
+        # Messages passed to the log function before each retry
+        self.messages = []
+
+    def test_success_not_retried(self):
+        call = FlakyCall()
+        self.assertEqual(retry_call(call, attempts=3, base_delay=0, log=self.messages.append), 'done')
+        self.assertEqual(call.calls, 1)
+        self.assertEqual(self.messages, [])
+
+    def test_retries_transient_errors(self):
+        call = FlakyCall(TransientError('timed out'), TransientError('timed out'))
+        self.assertEqual(retry_call(call, attempts=3, base_delay=0, description='LabKey', log=self.messages.append), 'done')
+        self.assertEqual(call.calls, 3)
+        self.assertEqual(len(self.messages), 2)
+        self.assertTrue(self.messages[0].startswith('INFO\tRetrying LabKey'))
+        self.assertIn('attempt 2 of 3 failed: timed out', self.messages[1])
+
+    def test_nothing_printed_without_log(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            retry_call(FlakyCall(TransientError('timed out')), attempts=2, base_delay=0)
+            self.assertEqual(sys.stdout.getvalue(), '')
+        finally:
+            sys.stdout = stdout
+
+    def test_raises_last_error_after_all_attempts(self):
+        call = FlakyCall(TransientError('first'), TransientError('second'), TransientError('third'))
+        with self.assertRaises(TransientError) as context:
+            retry_call(call, attempts=2, base_delay=0)
+        self.assertEqual(str(context.exception), 'second')
+        self.assertEqual(call.calls, 2)
+
+    def test_other_errors_not_retried(self):
+        for error in (RemoteCallError('failed'), CircuitOpenError('open'), ValueError('bad')):
+            call = FlakyCall(error)
+            self.assertRaises(type(error), retry_call, call, attempts=3, base_delay=0)
+            self.assertEqual(call.calls, 1)
+
+    def test_backoff_delay(self):
+        for attempt in range(1, 10):
+            delay = backoff_delay(attempt, base_delay=1.0, max_delay=5.0)
+            self.assertTrue(0 <= delay <= min(5.0, 2 ** (attempt - 1)))
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('GENAPP01', failure_threshold=3, reset_timeout=300)
+        for i in range(3):
+            self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        self.assertEqual(breaker.opened, 1)
+        # Calls fail immediately while the breaker is open
+        call = FlakyCall()
+        self.assertRaises(CircuitOpenError, breaker.call, call)
+        self.assertEqual(call.calls, 0)
+        self.assertEqual(str(breaker), 'GENAPP01 circuit breaker: opened 1 times')
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker('MOKA', failure_threshold=3)
+        for i in range(2):
+            self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        self.assertEqual(breaker.call(FlakyCall()), 'done')
+        self.assertEqual(breaker.failures, 0)
+        self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        self.assertEqual(breaker.opened, 0)
+
+    def test_other_errors_not_counted(self):
+        breaker = CircuitBreaker('GENEWORKS', failure_threshold=1)
+        self.assertRaises(RemoteCallError, breaker.call, FlakyCall(RemoteCallError('no such file')))
+        self.assertRaises(ValueError, breaker.call, FlakyCall(ValueError('bad')))
+        self.assertEqual((breaker.failures, breaker.opened), (0, 0))
+
+    def test_trial_call_after_reset_timeout(self):
+        breaker = CircuitBreaker('GENAPP01', failure_threshold=1, reset_timeout=0.05)
+        self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        self.assertRaises(CircuitOpenError, breaker.call, FlakyCall())
+        time.sleep(0.1)
+        # A failed trial opens the breaker again, without counting as a new opening
+        self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        self.assertRaises(CircuitOpenError, breaker.call, FlakyCall())
+        self.assertEqual(breaker.opened, 1)
+        time.sleep(0.1)
+        # A successful trial closes it
+        self.assertEqual(breaker.call(FlakyCall()), 'done')
+        self.assertEqual(breaker.call(FlakyCall()), 'done')
+
+    def test_single_trial_call(self):
+        breaker = CircuitBreaker('GENAPP01', failure_threshold=1, reset_timeout=0.05)
+        self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        time.sleep(0.1)
+        # Hold the trial call open while other calls are made
+        started = threading.Event()
+        finish = threading.Event()
+        def trial():
+            started.set()
+            finish.wait(5)
+            return 'trial'
+        results = []
+        thread = threading.Thread(target=lambda: results.append(breaker.call(trial)))
+        thread.start()
+        started.wait(5)
+        call = FlakyCall()
+        with self.assertRaises(CircuitOpenError) as context:
+            breaker.call(call)
+        self.assertIn('Waiting for a trial call to finish', str(context.exception))
+        self.assertEqual(call.calls, 0)
+        finish.set()
+        thread.join(5)
+        # The successful trial closes the breaker
+        self.assertEqual(results, ['trial'])
+        self.assertEqual(breaker.call(call), 'done')
+
+    def test_trial_released_after_other_error(self):
+        breaker = CircuitBreaker('GENAPP01', failure_threshold=1, reset_timeout=0.05)
+        self.assertRaises(TransientError, breaker.call, FlakyCall(TransientError('timed out')))
+        time.sleep(0.1)
+        # An error that isn't a transient failure doesn't close or reopen the breaker, and the next call is the trial
+        self.assertRaises(ValueError, breaker.call, FlakyCall(ValueError('bad')))
+        self.assertEqual(breaker.call(FlakyCall()), 'done')
+        self.assertEqual(breaker.failures, 0)
+
+    def test_retry_through_breaker(self):
+        breaker = CircuitBreaker('GENAPP01', failure_threshold=2, reset_timeout=300)
+        call = FlakyCall(TransientError('timed out'), TransientError('timed out'), TransientError('timed out'))
+        # Once the breaker opens, the remaining attempts aren't made
+        self.assertRaises(CircuitOpenError, retry_call, lambda: breaker.call(call), attempts=5, base_delay=0)
+        self.assertEqual(call.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
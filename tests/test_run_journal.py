@@ -0,0 +1,60 @@
+"""
+Tests for the journal of completed stages used to resume runs
+"""
+import os
+import threading
+import unittest
+import helpers
+from run_journal import RunJournal
+
+class RunJournalTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(RunJournalTest, self).setUp()
+        self.path = os.path.join(self.tempdir, 'journal.sqlite')
+        self.journal = RunJournal(self.path)
+        self.addCleanup(self.journal.close)
+
+    def test_record(self):
+        self.assertFalse(self.journal.is_done(1001, '123-1', 'merged'))
+        self.journal.record(1001, '123-1', 'merged', '/reports/combined.pdf')
+        self.assertTrue(self.journal.is_done(1001, '123-1', 'merged'))
+        self.assertEqual(self.journal.get_detail(1001, '123-1', 'merged'), '/reports/combined.pdf')
+
+    def test_stages_are_per_test_and_irid(self):
+        self.journal.record(1001, '123-1', 'charged', 42)
+        self.assertFalse(self.journal.is_done(1002, '123-1', 'charged'))
+        # A new version of the interpretation request is a new case
+        self.assertFalse(self.journal.is_done(1001, '123-2', 'charged'))
+        self.assertFalse(self.journal.is_done(1001, '123-1', 'emailed'))
+        self.assertEqual(self.journal.get_detail(1001, '123-1', 'charged'), '42')
+
+    def test_detail_optional(self):
+        self.journal.record(1001, '123-1', 'validated')
+        self.assertTrue(self.journal.is_done(1001, '123-1', 'validated'))
+        self.assertIsNone(self.journal.get_detail(1001, '123-1', 'validated'))
+        self.assertIsNone(self.journal.get_detail(1001, '123-1', 'emailed'))
+
+    def test_unknown_stage(self):
+        self.assertRaises(ValueError, self.journal.record, 1001, '123-1', 'reported')
+
+    def test_persists_between_runs(self):
+        self.journal.record(1001, '123-1', 'exit_q_submitted')
+        # Recording the stage again replaces the detail rather than failing
+        self.journal.record(1001, '123-1', 'summary_downloaded', 'first.pdf')
+        self.journal.record(1001, '123-1', 'summary_downloaded', 'second.pdf')
+        self.journal.close()
+        journal = RunJournal(self.path)
+        self.addCleanup(journal.close)
+        self.assertTrue(journal.is_done(1001, '123-1', 'exit_q_submitted'))
+        self.assertEqual(journal.get_detail(1001, '123-1', 'summary_downloaded'), 'second.pdf')
+
+    def test_record_from_threads(self):
+        threads = [threading.Thread(target=self.journal.record, args=(ngs_test_id, '123-1', 'moka_updated')) for ngs_test_id in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(self.journal.is_done(ngs_test_id, '123-1', 'moka_updated') for ngs_test_id in range(20)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests for pipelined SFTP transfers from GENAPP01, resuming partial copies and verifying checksums
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+import helpers
+from resilience import RemoteCallError, TransientError
+from sftp_transfer import SftpTransfer
+
+# Not a multiple of the block size, so that the last read is short
+DATA = ''.join(chr(i % 251) for i in range(50000))
+
+class SftpTransferTest(helpers.TempDirTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        with open(os.path.join(cls.root, 'report.pdf'), 'wb') as remote_file:
+            remote_file.write(DATA)
+        cls.genapp = helpers.start_genapp(root=cls.root)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.genapp.close()
+        shutil.rmtree(cls.root, True)
+
+    def setUp(self):
+        super(SftpTransferTest, self).setUp()
+        self.session = helpers.genapp_session(self.genapp)
+        self.addCleanup(self.session.close)
+        self.genapp.commands = {}
+        self.local_path = os.path.join(self.tempdir, 'report.pdf')
+        self.partial_path = self.local_path + '.partial'
+
+    def transfer(self, **kwargs):
+        return SftpTransfer(session=self.session, window=4, block_size=4096, **kwargs)
+
+    def write_partial(self, data):
+        with open(self.partial_path, 'wb') as partial:
+            partial.write(data)
+
+    def assertCopied(self):
+        with open(self.local_path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), DATA)
+        self.assertFalse(os.path.exists(self.partial_path))
+
+    def test_copy(self):
+        transfer = self.transfer()
+        self.assertEqual(transfer.get('/report.pdf', self.local_path), len(DATA))
+        self.assertCopied()
+        self.assertEqual((transfer.total_bytes, transfer.resumed_from), (len(DATA), 0))
+        self.assertEqual(transfer.sha256, hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(self.genapp.commands['sha256sum'], 1)
+        self.assertIn('Copied /report.pdf: 50000 bytes in', str(transfer))
+
+    def test_resume(self):
+        self.write_partial(DATA[:20000])
+        transfer = self.transfer()
+        self.assertEqual(transfer.get('/report.pdf', self.local_path), len(DATA) - 20000)
+        self.assertCopied()
+        self.assertEqual(transfer.resumed_from, 20000)
+        self.assertIn('(resumed from 20000)', str(transfer))
+
+    def test_corrupt_partial_copied_again(self):
+        # The partial file doesn't match the start of the remote file, e.g. because the file was regenerated
+        self.write_partial('x' * 20000)
+        transfer = self.transfer()
+        self.assertEqual(transfer.get('/report.pdf', self.local_path), len(DATA))
+        self.assertCopied()
+        self.assertEqual(transfer.resumed_from, 0)
+        self.assertEqual(transfer.transferred_bytes, len(DATA))
+
+    def test_partial_larger_than_remote(self):
+        self.write_partial(DATA + 'extra')
+        self.assertEqual(self.transfer().get('/report.pdf', self.local_path), len(DATA))
+        self.assertCopied()
+
+    def test_no_resume(self):
+        self.write_partial(DATA[:20000])
+        transfer = self.transfer(resume=False)
+        self.assertEqual(transfer.get('/report.pdf', self.local_path), len(DATA))
+        self.assertEqual(transfer.resumed_from, 0)
+        self.assertCopied()
+
+    def test_replaces_existing_file(self):
+        with open(self.local_path, 'wb') as local_file:
+            local_file.write('old')
+        self.transfer().get('/report.pdf', self.local_path)
+        self.assertCopied()
+
+    def test_checksum_mismatch(self):
+        transfer = self.transfer()
+        transfer.server_sha256 = lambda remotepath: '0' * 64
+        self.assertRaises(TransientError, transfer.get, '/report.pdf', self.local_path)
+        # The corrupt copy is removed, so that a retry starts again
+        self.assertFalse(os.path.exists(self.partial_path))
+        self.assertFalse(os.path.exists(self.local_path))
+
+    def test_no_verify(self):
+        self.transfer(verify=False).get('/report.pdf', self.local_path)
+        self.assertCopied()
+        self.assertNotIn('sha256sum', self.genapp.commands)
+
+    def test_missing_remote_file(self):
+        # Not a TransientError, as retrying won't help
+        for call in (lambda: self.transfer().get('/missing.pdf', self.local_path), lambda: self.transfer().server_sha256('/missing.pdf')):
+            with self.assertRaises(RemoteCallError) as context:
+                call()
+            self.assertNotIsInstance(context.exception, TransientError)
+
+if __name__ == '__main__':
+    unittest.main()
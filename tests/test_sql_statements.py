@@ -0,0 +1,65 @@
+"""
+Tests for the named, parameterised SQL statements
+"""
+import sqlite3
+import unittest
+import helpers
+import fake_databases
+import sql_statements
+
+class InListTest(unittest.TestCase):
+    def setUp(self):
+        helpers.set_config(self, 'GENEWORKS', **fake_databases.GENEWORKS_VIEW_NAMES)
+
+    def test_padded_to_power_of_two(self):
+        for count, size in ((1, 1), (2, 2), (3, 4), (4, 4), (5, 8), (100, 128), (500, 512)):
+            sql, params = sql_statements.in_list('moka_test_data', range(count))
+            self.assertEqual(sql.count('?'), size)
+            self.assertEqual(len(params), size)
+            # Padding repeats the last value
+            self.assertEqual(params, range(count) + [count - 1] * (size - count))
+
+    def test_same_text_for_same_size(self):
+        texts = set(sql_statements.in_list('geneworks_patients', ['RJ1'] * count)[0] for count in (5, 6, 7, 8))
+        self.assertEqual(len(texts), 1)
+
+    def test_padding_matches_same_rows(self):
+        cnxn = sqlite3.connect(':memory:')
+        cnxn.execute('CREATE TABLE t (id INTEGER)')
+        cnxn.executemany('INSERT INTO t VALUES (?)', [(i,) for i in range(10)])
+        sql, params = sql_statements.in_list('moka_test_data', [2, 3, 5])
+        where = sql[sql.index('WHERE'):].replace('NGSTestID', 'id')
+        self.assertEqual(sorted(row[0] for row in cnxn.execute('SELECT id FROM t ' + where, params)), [2, 3, 5])
+
+    def test_no_values_in_sql(self):
+        sql, params = sql_statements.in_list('geneworks_gel_tests', ["RJ1'; DROP TABLE x; --"])
+        self.assertNotIn('DROP', sql)
+
+class GetTest(unittest.TestCase):
+    def setUp(self):
+        helpers.set_config(self, 'GENEWORKS', **fake_databases.GENEWORKS_VIEW_NAMES)
+
+    def test_get(self):
+        self.assertEqual(sql_statements.get('patients_update').count('?'), 1)
+        self.assertEqual(sql_statements.get('geneworks_insert_charge').count('?'), 4)
+        self.assertRaises(KeyError, sql_statements.get, 'unknown')
+
+    def test_geneworks_view_names(self):
+        self.assertIn('"gwv-patient" AS patient', sql_statements.in_list('geneworks_patients', [1])[0])
+        # View names can be set in the GENEWORKS section of the config file
+        helpers.set_config(self, 'GENEWORKS', PATIENT_VIEW='patient_view')
+        sql = sql_statements.in_list('geneworks_gel_tests', [1])[0]
+        self.assertIn('"patient_view" AS patient', sql)
+        self.assertIn('"gwv-specimen" AS specimen', sql)
+        self.assertNotIn('gwv-patient', sql)
+
+    def test_geneworks_view_names_required(self):
+        helpers.set_config(self, 'GENEWORKS', PATIENT_VIEW=None, DNANUMBER_VIEW=None)
+        with self.assertRaises(ValueError) as context:
+            sql_statements.in_list('geneworks_gel_tests', [1])
+        self.assertEqual(str(context.exception), 'Geneworks view names not set in the GENEWORKS section of config.ini: DNANUMBER_VIEW, PATIENT_VIEW (see example_config.ini)')
+        # Moka statements don't need them
+        self.assertIn('NGSTestFile', sql_statements.get('ngstestfile_insert'))
+
+if __name__ == '__main__':
+    unittest.main()
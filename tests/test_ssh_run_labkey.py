@@ -0,0 +1,136 @@
+"""
+Tests for parsing LabKey.py output and for running LabKey.py for many participants in one remote invocation
+"""
+import os
+import sys
+import subprocess
+import unittest
+from StringIO import StringIO
+from distutils.spawn import find_executable
+import helpers
+import timing
+import ssh_run_labkey
+from resilience import RemoteCallError
+from labkey_cache import LabKeyCache
+from ssh_run_labkey import parse_labkey_output, LabKeyRecord, LabKeyBatch_SSH, LABKEY_BATCH_RUNNER
+
+# Stand-in for LabKey.py, run by the batch runner. 'missing' exits with an error message and 'broken' raises.
+FAKE_LABKEY_SCRIPT = """
+import sys
+pid = sys.argv[sys.argv.index('-i') + 1]
+if pid == 'missing':
+    sys.exit('Participant not found')
+if pid == 'broken':
+    raise ValueError('LabKey unavailable')
+print("'Name {pid},01/01/1980,{pid}'".format(pid=pid))
+"""
+
+class ParseLabKeyOutputTest(unittest.TestCase):
+    def test_parses_quoted_output(self):
+        self.assertEqual(parse_labkey_output("'Joe Bloggs,01/01/1980,9000000000'\n"), ('Joe Bloggs', '01/01/1980', '9000000000'))
+
+    def test_allows_missing_name(self):
+        self.assertEqual(parse_labkey_output(",01/01/1980,9000000000"), ('', '01/01/1980', '9000000000'))
+
+    def test_rejects_wrong_number_of_fields(self):
+        for raw_string in ('', 'Joe Bloggs,01/01/1980', 'Joe,Bloggs,01/01/1980,9000000000'):
+            self.assertRaises(ValueError, parse_labkey_output, raw_string)
+
+    def test_record(self):
+        record = LabKeyRecord('111', "'Joe Bloggs,01/01/1980,9000000000'")
+        self.assertEqual((record.name, record.dob, record.nhsid), ('Joe Bloggs', '01/01/1980', '9000000000'))
+        self.assertEqual(str(record), 'Joe Bloggs,01/01/1980,9000000000')
+
+@unittest.skipUnless(find_executable('python3'), 'python3 is needed to run the batch runner')
+class BatchRunnerTest(helpers.TempDirTestCase):
+    '''Runs LABKEY_BATCH_RUNNER with a local Python 3 interpreter, as it is run on GENAPP01'''
+    def run_batch(self, participant_ids):
+        script = os.path.join(self.tempdir, 'LabKey.py')
+        with open(script, 'w') as script_file:
+            script_file.write(FAKE_LABKEY_SCRIPT)
+        process = subprocess.Popen(['python3', '-', script] + participant_ids, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(LABKEY_BATCH_RUNNER)
+        self.assertEqual(process.returncode, 0, stderr)
+        return [line.split('\t') for line in stdout.splitlines()]
+
+    def test_one_line_per_participant(self):
+        lines = self.run_batch(['111', 'missing', 'broken', '222'])
+        self.assertEqual([line[:2] for line in lines], [['111', 'OK'], ['missing', 'ERROR'], ['broken', 'ERROR'], ['222', 'OK']])
+        self.assertEqual(parse_labkey_output(lines[0][2]), ('Name 111', '01/01/1980', '111'))
+        self.assertEqual(lines[1][2], 'Participant not found')
+        self.assertIn('LabKey unavailable', lines[2][2])
+
+class LabKeyBatchTest(helpers.TempDirTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.genapp = helpers.start_genapp(root='/nonexistent', demographics={
+            '111': ('', '01/01/1980', '9000000001'),
+            '222': ('', '02/02/1980', '9000000002'),
+            '333': ('', '03/03/1980', '9000000003'),
+        })
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.genapp.close()
+
+    def setUp(self):
+        super(LabKeyBatchTest, self).setUp()
+        self.session = helpers.genapp_session(self.genapp)
+        self.addCleanup(self.session.close)
+        self.genapp.commands = {}
+
+    def test_records_and_errors(self):
+        batch = LabKeyBatch_SSH(['111', '222', '999', '111'], session=self.session)
+        self.assertEqual(batch.participant_ids, ['111', '222', '999'])
+        self.assertEqual(sorted(batch.records), ['111', '222'])
+        self.assertEqual(batch.records['222'].dob, '02/02/1980')
+        self.assertEqual(batch.errors, {'999': 'Participant not found'})
+        self.assertEqual(self.genapp.commands['LabKey.py'], 1)
+
+    def test_chunks(self):
+        batch = LabKeyBatch_SSH(['111', '222', '333'], session=self.session, chunk_size=2)
+        self.assertEqual(sorted(batch.records), ['111', '222', '333'])
+        self.assertEqual(self.genapp.commands['LabKey.py'], 2)
+
+    def test_cached_participants_not_sent(self):
+        cache = LabKeyCache(os.path.join(self.tempdir, 'labkey_cache.sqlite'))
+        self.addCleanup(cache.close)
+        cache.put('111', 'Cached Name', '01/01/1980', '9000000001')
+        batch = LabKeyBatch_SSH(['111', '222'], session=self.session, cache=cache)
+        self.assertEqual(str(batch.records['111']), ',01/01/1980,9000000001')
+        self.assertEqual(self.genapp.commands['LabKey.py'], 1)
+        # The participant retrieved from LabKey is added to the cache
+        self.assertEqual(cache.get('222'), ('', '02/02/1980', '9000000002'))
+
+class MainProfileTest(unittest.TestCase):
+    '''Checks that --profile prints the timings however main() exits'''
+    def setUp(self):
+        timing.reset()
+        self.addCleanup(timing.reset)
+        labkey_ssh = ssh_run_labkey.LabKey_SSH
+        self.addCleanup(setattr, ssh_run_labkey, 'LabKey_SSH', labkey_ssh)
+        argv = sys.argv
+        self.addCleanup(setattr, sys, 'argv', argv)
+
+    def run_main(self, *args):
+        sys.argv = ['ssh_run_labkey.py', '--profile'] + list(args)
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            with self.assertRaises(SystemExit) as context:
+                ssh_run_labkey.main()
+        finally:
+            sys.stdout = stdout
+        return context.exception, output.getvalue()
+
+    def test_single_participant_error(self):
+        def failing_labkey_ssh(participant_id, cache=None):
+            timing.record('labkey', 0, 0.5)
+            raise RemoteCallError('LabKey unavailable')
+        ssh_run_labkey.LabKey_SSH = failing_labkey_ssh
+        exception, output = self.run_main('-i', '111')
+        self.assertEqual(exception.code, 'LabKey unavailable')
+        self.assertEqual(output.splitlines()[-1].split()[:2], ['labkey', '1'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Tests for streaming the summary of findings PDF back over the SSH command's output
+"""
+import os
+import hashlib
+import unittest
+from StringIO import StringIO
+import helpers
+from ssh_run_summary_findings import StreamedFile, SummaryFindings_SSH
+
+PDF = '%PDF-1.4\n' + '\x00\xff\n' * 1000 + '%%EOF\n'
+HEADER = '{size} {sha256}\n'.format(size=len(PDF), sha256=hashlib.sha256(PDF).hexdigest())
+
+class StreamedFileTest(unittest.TestCase):
+    def stream(self, chunks):
+        output_file = StringIO()
+        streamed = StreamedFile(output_file)
+        for chunk in chunks:
+            streamed.write(chunk)
+        return streamed, output_file.getvalue()
+
+    def check(self, streamed, data):
+        self.assertEqual(data, PDF)
+        self.assertEqual(streamed.expected_bytes, len(PDF))
+        self.assertEqual(streamed.transferred_bytes, len(PDF))
+        self.assertEqual(streamed.sha256, streamed.expected_sha256)
+
+    def test_single_write(self):
+        self.check(*self.stream([HEADER + PDF]))
+
+    def test_header_split_across_writes(self):
+        output = HEADER + PDF
+        # Split part way through the size, the checksum and just after the newline
+        self.check(*self.stream([output[:3], output[3:40], output[40:len(HEADER)], output[len(HEADER):]]))
+
+    def test_one_byte_writes(self):
+        output = HEADER + PDF[:50]
+        streamed, data = self.stream(list(output))
+        self.assertEqual(data, PDF[:50])
+        self.assertEqual(streamed.expected_bytes, len(PDF))
+        self.assertEqual(streamed.transferred_bytes, 50)
+        self.assertEqual(streamed.sha256, hashlib.sha256(PDF[:50]).hexdigest())
+
+    def test_no_header_yet(self):
+        streamed, data = self.stream([HEADER[:10]])
+        self.assertIsNone(streamed.expected_bytes)
+        self.assertEqual(data, '')
+
+    def test_invalid_header(self):
+        for output in ('Traceback (most recent call last):\n', 'abc {sha256}\n'.format(sha256='0' * 64), '\n'):
+            self.assertRaises(ValueError, self.stream, [output + PDF])
+
+    def test_corrupt_data(self):
+        streamed, data = self.stream([HEADER + PDF[:-1] + 'x'])
+        self.assertEqual(streamed.transferred_bytes, len(PDF))
+        self.assertNotEqual(streamed.sha256, streamed.expected_sha256)
+
+class StreamSummaryFindingsTest(helpers.TempDirTestCase):
+    def test_stream(self):
+        genapp = helpers.start_genapp(root=os.path.join(self.tempdir, 'genapp01'), summary_pdf=PDF)
+        self.addCleanup(genapp.close)
+        session = helpers.genapp_session(genapp)
+        self.addCleanup(session.close)
+        output_path = os.path.join(self.tempdir, 'summary.pdf')
+        summary = SummaryFindings_SSH('123', '1', output_path, header=None, session=session, stream=True)
+        with open(output_path, 'rb') as pdf:
+            self.assertEqual(pdf.read(), PDF)
+        self.assertEqual(summary.transferred_bytes, len(PDF))
+        self.assertFalse(os.path.exists(output_path + '.partial'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the local cache of summary of findings PDFs downloaded from GENAPP01
+"""
+import os
+import time
+import unittest
+import helpers
+from summary_cache import SummaryCache
+
+PDF = '%PDF-1.4\n' + 'summary of findings\n' * 100 + '%%EOF\n'
+HEADER = 'Patient: Jane Doe    DoB: 01/01/1970'
+
+class SummaryCacheTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(SummaryCacheTest, self).setUp()
+        self.cache = SummaryCache(os.path.join(self.tempdir, 'cache'))
+        self.addCleanup(self.cache.close)
+        self.download_path = os.path.join(self.tempdir, 'download.pdf')
+        with open(self.download_path, 'wb') as download:
+            download.write(PDF)
+        self.output_path = os.path.join(self.tempdir, 'output.pdf')
+
+    def fetch(self, header=HEADER):
+        return self.cache.fetch('1234', '1', header, self.output_path)
+
+    def corrupt_blob(self, data):
+        blob, = [os.path.join(self.cache.blob_folder, filename) for filename in os.listdir(self.cache.blob_folder)]
+        with open(blob, 'wb') as blob_file:
+            blob_file.write(data)
+
+    def test_miss_then_hit(self):
+        self.assertFalse(self.fetch())
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.assertTrue(self.fetch())
+        with open(self.output_path, 'rb') as output:
+            self.assertEqual(output.read(), PDF)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(str(self.cache), 'Summary of findings cache: 1 hits, 1 misses')
+
+    def test_keyed_by_version_and_header(self):
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.assertFalse(self.cache.fetch('1234', '2', HEADER, self.output_path))
+        self.assertFalse(self.fetch(header='Patient: John Doe'))
+
+    def test_non_ascii_header(self):
+        # Headers are byte strings read from Moka, or unicode, and may include accented names
+        header = u'Patient: Zoë Brontë'
+        self.cache.store('1234', '1', header.encode('utf-8'), self.download_path)
+        self.assertTrue(self.fetch(header=header))
+        self.assertTrue(self.fetch(header=header.encode('utf-8')))
+        self.assertNotEqual(SummaryCache.cache_key('1234', '1', header), SummaryCache.cache_key('1234', '1', u'Patient: Zoe Bronte'))
+
+    def test_truncated_file_fetched_again(self):
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.corrupt_blob(PDF[:100])
+        self.assertFalse(self.fetch())
+        self.assertFalse(os.path.exists(self.output_path))
+        # The entry is discarded, so the report is downloaded and stored again
+        self.assertEqual(os.listdir(self.cache.blob_folder), [])
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.assertTrue(self.fetch())
+        with open(self.output_path, 'rb') as output:
+            self.assertEqual(output.read(), PDF)
+
+    def test_corrupt_file_fetched_again(self):
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        # Same size, different content
+        self.corrupt_blob(PDF[:-2] + 'x\n')
+        self.assertFalse(self.fetch())
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_identical_pdfs_stored_once(self):
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.cache.store('5678', '1', HEADER, self.download_path)
+        self.assertEqual(len(os.listdir(self.cache.blob_folder)), 1)
+
+    def test_prune(self):
+        self.cache.store('1234', '1', HEADER, self.download_path)
+        self.assertEqual(self.cache.prune(1), (0, 0))
+        self.cache.write('UPDATE summaries SET last_used = ?', (time.time() - 2 * 86400,))
+        self.assertEqual(self.cache.prune(1), (1, 1))
+        self.assertFalse(self.fetch())
+
+if __name__ == '__main__':
+    unittest.main()
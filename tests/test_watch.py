@@ -0,0 +1,51 @@
+"""
+Tests for the per-poll reporting of cache counts and timings in watch mode
+"""
+import os
+import sys
+import argparse
+import unittest
+from StringIO import StringIO
+import helpers
+import timing
+from labkey_cache import LabKeyCache
+from gel_cover_report import report_poll_stats
+
+class ReportPollStatsTest(helpers.TempDirTestCase):
+    def setUp(self):
+        super(ReportPollStatsTest, self).setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+        self.labkey_cache = LabKeyCache(os.path.join(self.tempdir, 'labkey_cache.sqlite'))
+        self.addCleanup(self.labkey_cache.close)
+        self.report_run = argparse.Namespace(args=argparse.Namespace(profile=True), labkey_cache=self.labkey_cache, summary_cache=None)
+
+    def poll(self):
+        """
+        Records the lookups and timings for one poll, then returns the output of report_poll_stats()
+        """
+        self.labkey_cache.get('111')
+        timing.record('labkey', 0, 1.5)
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            report_poll_stats(self.report_run)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
+
+    def test_each_poll_reported_separately(self):
+        for poll in range(2):
+            output = self.poll()
+            self.assertIn('INFO\tLabKey cache: 0 hits, 1 misses', output)
+            self.assertEqual(timing.summary(), {})
+            self.assertEqual(output.splitlines()[-1].split()[:3], ['labkey', '1', '1.500'])
+
+    def test_timings_reset_without_profile(self):
+        self.report_run.args.profile = False
+        self.assertNotIn('labkey ', self.poll())
+        self.assertEqual(timing.summary(), {})
+        self.assertEqual((self.labkey_cache.hits, self.labkey_cache.misses), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""
+Tests for reading the NGSTestIDs to report from a worklist file
+"""
+import os
+import sys
+import argparse
+import unittest
+from StringIO import StringIO
+import helpers
+from gel_cover_report import read_worklist, get_worklist
+
+class ReadWorklistTest(unittest.TestCase):
+    def test_one_per_line(self):
+        self.assertEqual(read_worklist(StringIO('1001\n1002\r\n1003')), [1001, 1002, 1003])
+
+    def test_separators(self):
+        self.assertEqual(read_worklist(StringIO('1001, 1002 1003,1004\t1005\n\n  1006  \n')), [1001, 1002, 1003, 1004, 1005, 1006])
+
+    def test_order_and_duplicates_kept(self):
+        self.assertEqual(read_worklist(StringIO('1003\n1001\n1003\n')), [1003, 1001, 1003])
+
+    def test_comments(self):
+        worklist = StringIO('# Worklist for 01/01/2020\n1001 # repeat of failed test\n1002,1003# no space\n   # indented comment\n')
+        self.assertEqual(read_worklist(worklist), [1001, 1002, 1003])
+
+    def test_empty(self):
+        self.assertEqual(read_worklist(StringIO('')), [])
+        self.assertEqual(read_worklist(StringIO('# nothing to report\n\n')), [])
+
+    def test_invalid_id(self):
+        with self.assertRaises(ValueError) as context:
+            read_worklist(StringIO('1001\n1002 10O3\n'))
+        self.assertEqual(str(context.exception), 'Invalid NGSTestID "10O3" on line 2 of worklist')
+        self.assertRaises(ValueError, read_worklist, StringIO('-1001\n'))
+
+class GetWorklistTest(helpers.TempDirTestCase):
+    def args(self, n=None, worklist=None):
+        return argparse.Namespace(n=n, worklist=worklist, ready=False)
+
+    def test_ids_from_arguments(self):
+        self.assertEqual(get_worklist(self.args(n=[1001, 1002])), [1001, 1002])
+
+    def test_file(self):
+        path = os.path.join(self.tempdir, 'worklist.txt')
+        with open(path, 'w') as worklist:
+            worklist.write('1001\n1002 # comment\n')
+        self.assertEqual(get_worklist(self.args(worklist=path)), [1001, 1002])
+
+    def test_stdin(self):
+        stdin = sys.stdin
+        sys.stdin = StringIO('1001,1002\n')
+        try:
+            self.assertEqual(get_worklist(self.args(worklist='-')), [1001, 1002])
+        finally:
+            sys.stdin = stdin
+
+    def test_missing_file(self):
+        self.assertRaises(IOError, get_worklist, self.args(worklist=os.path.join(self.tempdir, 'missing.txt')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+timing.py
+
+Timing spans for the stages of a run, e.g. Moka queries, LabKey and other SSH calls to GENAPP01, PDF creation and
+Geneworks charges.
+
+Code to be timed is wrapped in a span:
+
+    with span('labkey', participants=10):
+        ...
+
+Every span is recorded so that a summary of the time spent in each stage can be printed at the end of the run. If
+configure() is given a file, each span is also written to it as a JSON line as soon as it finishes. Fields set with
+context() (e.g. the NGSTestID being processed) are added to every span recorded by the same thread.
+"""
+import sys
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+# Durations recorded for each stage, keyed by stage name
+_durations = {}
+# File that spans are written to as JSON lines, if set by configure()
+_json_file = None
+_lock = threading.Lock()
+# Fields added to the spans recorded by each thread, set by context()
+_context = threading.local()
+
+def configure(json_path=None):
+    """
+    Write each span to json_path as a JSON line as soon as it finishes. Use '-' to write to stderr.
+    """
+    global _json_file
+    with _lock:
+        if _json_file not in (None, sys.stderr):
+            _json_file.close()
+        if json_path == '-':
+            _json_file = sys.stderr
+        elif json_path:
+            _json_file = open(json_path, 'a')
+        else:
+            _json_file = None
+
+@contextmanager
+def context(**fields):
+    """
+    Context manager adding fields to every span recorded by the current thread while it is active
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Context manager recording the time taken by the code it wraps against a stage name.
+    Any keyword arguments (e.g. ngs_test_id) are included in the JSON line for the span.
+    If the wrapped code raises an exception, the span is still recorded, with ok set to false.
+    """
+    start = time.time()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        record(stage, start, time.time() - start, ok, **fields)
+
+def record(stage, start, duration, ok=True, **fields):
+    """
+    Record a span that has already been timed
+    """
+    with _lock:
+        _durations.setdefault(stage, []).append(duration)
+        if _json_file is not None:
+            line = dict(getattr(_context, 'fields', {}), **fields)
+            line.update({
+                'stage': stage,
+                'start': datetime.datetime.fromtimestamp(start).isoformat(),
+                'seconds': round(duration, 6),
+                'ok': ok,
+                'thread': threading.current_thread().name,
+            })
+            _json_file.write(json.dumps(line, sort_keys=True) + '\n')
+            _json_file.flush()
+
+def percentile(values, percent):
+    """
+    Returns the value at the given percentile of a list of values, using the nearest rank method
+    """
+    ordered = sorted(values)
+    rank = int(-(-len(ordered) * percent // 100))
+    return ordered[max(rank, 1) - 1]
+
+def summary():
+    """
+    Returns a dictionary of the number of spans and the total, p50, p95 and max duration (in seconds) for each stage
+    """
+    with _lock:
+        durations = dict((stage, list(values)) for stage, values in _durations.items())
+    return dict((stage, {
+        'count': len(values),
+        'total': sum(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': max(values),
+    }) for stage, values in durations.items())
+
+def summary_table():
+    """
+    Returns a table of the number of spans and the total, p50, p95 and max duration (in seconds) for each stage
+    """
+    stages = summary()
+    width = max([len('stage')] + [len(stage) for stage in stages])
+    lines = ['{stage:<{width}} {count:>6} {total:>9} {p50:>8} {p95:>8} {max:>8}'.format(
+        stage='stage', width=width, count='count', total='total', p50='p50', p95='p95', max='max'
+    )]
+    for stage in sorted(stages):
+        lines.append('{stage:<{width}} {count:>6} {total:>9.3f} {p50:>8.3f} {p95:>8.3f} {max:>8.3f}'.format(stage=stage, width=width, **stages[stage]))
+    return '\n'.join(lines)
+
+def reset():
+    """
+    Remove all recorded spans
+    """
+    with _lock:
+        _durations.clear()